@@ -2,22 +2,65 @@
 Clients for databases
 """
 
+import os
+import threading
+
 import pymongo
 from redis import Redis
 from services.env_man import ENVS
 
+# process-wide mongo client, see get_mongo_client
+_mongo_client: pymongo.MongoClient | None = None
+_mongo_pid: int | None = None
+_mongo_lock = threading.Lock()
+
 
-def get_mongo_db(db: str = "mongo") -> pymongo.MongoClient:
+def get_mongo_client() -> pymongo.MongoClient:
     """
-    Get a mongo client
-    Args:
-        db (str, optional): database name. Defaults to "mongo".
+    Get the process' mongo client, created on first use.
+    The client holds the connection pool, and is shared by every thread.
+    MongoClient is not fork-safe, a forked process, ex. a celery worker,
+    creates its own client instead of using its parent's.
+    Pool sizes are set by MONGO_MAX_POOL_SIZE, and MONGO_MIN_POOL_SIZE
     Returns:
         pymongo.MongoClient: mongo client
     """
-    client = pymongo.MongoClient(ENVS["MONGO_URI"])
+    global _mongo_client, _mongo_pid
+    pid = os.getpid()
+    if _mongo_client is None or _mongo_pid != pid:
+        with _mongo_lock:
+            if _mongo_client is None or _mongo_pid != pid:
+                _mongo_client = pymongo.MongoClient(
+                    ENVS["MONGO_URI"],
+                    maxPoolSize=ENVS["MONGO_MAX_POOL_SIZE"],
+                    minPoolSize=ENVS["MONGO_MIN_POOL_SIZE"],
+                    connect=False,
+                )
+                _mongo_pid = pid
 
-    return client["mongo"]
+    return _mongo_client
+
+
+def close_mongo_client() -> None:
+    """
+    Close the process' mongo client, a new one is created on next use
+    """
+    global _mongo_client
+    with _mongo_lock:
+        if _mongo_client is not None and _mongo_pid == os.getpid():
+            _mongo_client.close()
+        _mongo_client = None
+
+
+def get_mongo_db(db: str = "mongo") -> pymongo.database.Database:
+    """
+    Get a mongo database, from the process' client, see get_mongo_client
+    Args:
+        db (str, optional): database name. Defaults to "mongo".
+    Returns:
+        pymongo.database.Database: mongo database
+    """
+    return get_mongo_client()[db]
 
 
 rdb = Redis(
@@ -27,3 +70,12 @@ rdb = Redis(
     password=ENVS["CACHE_REDIS_PASSWORD"],
     decode_responses=True,
 )
+
+# same redis as rdb, for binary values such as packed vectors
+rdb_bytes = Redis(
+    host=ENVS["CACHE_REDIS_HOST"],
+    port=ENVS["CACHE_REDIS_PORT"],
+    db=ENVS["CACHE_REDIS_DB"],
+    password=ENVS["CACHE_REDIS_PASSWORD"],
+    decode_responses=False,
+)
@@ -0,0 +1,161 @@
+"""
+Handles documents collections
+A document is a unique file content, identified by its md5.
+Vectors in Pinecone are stored once per document, and shared by its owners.
+Ownership is granted when an owner's upload is OCR'd, see tasks.ocrs
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Literal
+
+import pymongo
+from db.clients import get_mongo_db
+from pydantic import BaseModel
+
+
+class IDocuments(BaseModel):
+    """
+    Documents schema, prevents incorrect data from being inserted
+    md5: md5 of the file
+    owners: user ids allowed to query the document's vectors
+    ocr_status: ocr status of the document's vectors, shared by every owner
+    claimed_at: when the ingestion was claimed, or its claim last renewed
+    rev: incremented on every ocr status change, invalidates cached answers,
+    see services.oai.caches.SemanticCache
+    schema_version: schema version number for future changes
+    """
+
+    md5: str
+    owners: list[str] = []
+    ocr_status: Literal["NOT_STARTED", "IN_PROGRESS", "SUCCESS"] = "NOT_STARTED"
+    claimed_at: datetime | None = None
+    rev: int = 0
+    schema_version: int
+
+
+def create_indexes() -> None:
+    """
+    Create indexes of the documents collection, idempotent
+    md5 must be unique for claim_document to be atomic
+    """
+    documents_col = get_mongo_db()["documents"]
+    documents_col.create_index("md5", unique=True)
+
+
+def claim_document(
+    md5: str, user_id: str, lease: int = 1800
+) -> tuple[bool, IDocuments]:
+    """
+    Add user_id to the document's owners, creating the document if needed,
+    and claim the document's ingestion if it has not started yet.
+    Only one caller claims a document, others should wait for its ocr_status.
+    A claim older than `lease` is taken over, its worker is assumed dead,
+    ex. killed before its errback could reset the document, see renew_claim
+    Args:
+        md5 (str): md5 hash
+        user_id (str): user id
+        lease (int): seconds a claim is held without being renewed
+    Returns:
+        tuple[bool, IDocuments]: True if claimed, and the document after the claim
+    """
+    documents_col = get_mongo_db()["documents"]
+    documents_col.update_one(
+        {"md5": md5},
+        {
+            "$addToSet": {"owners": user_id},
+            "$setOnInsert": {"ocr_status": "NOT_STARTED", "schema_version": 1},
+        },
+        upsert=True,
+    )
+    now = datetime.now(timezone.utc)
+    row = documents_col.find_one_and_update(
+        {
+            "md5": md5,
+            "$or": [
+                {"ocr_status": "NOT_STARTED"},
+                {
+                    "ocr_status": "IN_PROGRESS",
+                    "$or": [
+                        {"claimed_at": None},
+                        {"claimed_at": {"$lt": now - timedelta(seconds=lease)}},
+                    ],
+                },
+            ],
+        },
+        {"$set": {"ocr_status": "IN_PROGRESS", "claimed_at": now}, "$inc": {"rev": 1}},
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+    if row is not None:
+        return True, IDocuments(**row)
+
+    return False, IDocuments(**documents_col.find_one({"md5": md5}))
+
+
+def renew_claim(md5: str) -> bool:
+    """
+    Renew the claim of a document being ingested, so it is not taken over
+    Args:
+        md5 (str): md5 hash
+    Returns:
+        bool: True if the document is still being ingested
+    """
+    documents_col = get_mongo_db()["documents"]
+    result = documents_col.update_one(
+        {"md5": md5, "ocr_status": "IN_PROGRESS"},
+        {"$set": {"claimed_at": datetime.now(timezone.utc)}},
+    )
+
+    return result.matched_count > 0
+
+
+def is_document_owner(md5: str, user_id: str) -> bool:
+    """
+    Check if a user may query a document's vectors
+    Args:
+        md5 (str): md5 hash
+        user_id (str): user id
+    Returns:
+        bool: True if user_id is an owner
+    """
+    documents_col = get_mongo_db()["documents"]
+    row = documents_col.find_one({"md5": md5, "owners": user_id}, {"_id": 1})
+
+    return row is not None
+
+
+def get_document_rev(md5: str, user_id: str) -> int | None:
+    """
+    Get a document's rev, if the user may query its vectors
+    Args:
+        md5 (str): md5 hash
+        user_id (str): user id
+    Returns:
+        int | None: rev, see IDocuments, None if user_id is not an owner
+    """
+    documents_col = get_mongo_db()["documents"]
+    row = documents_col.find_one({"md5": md5, "owners": user_id}, {"rev": 1})
+    if row is None:
+        return None
+
+    return row.get("rev", 0)
+
+
+def set_document_status(
+    md5: str,
+    status: Literal["NOT_STARTED", "IN_PROGRESS", "SUCCESS"],
+) -> bool:
+    """
+    Set the ocr status of a document, and increment its rev
+    Args:
+        md5 (str): md5 hash
+        status (Literal["NOT_STARTED", "IN_PROGRESS", "SUCCESS"]): ocr status
+    Returns:
+        bool: True if successful
+    """
+    documents_col = get_mongo_db()["documents"]
+    documents_col.update_one(
+        {"md5": md5},
+        {"$set": {"ocr_status": status}, "$inc": {"rev": 1}},
+    )
+
+    return True
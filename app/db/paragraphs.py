@@ -0,0 +1,96 @@
+"""
+Handles paragraphs collections
+Paragraphs of embedded documents, keyed by their vector id f"{md5}:{n}".
+Pinecone only keeps the vector ids, and the fields queries are filtered by,
+/extract fetches the matched paragraphs here, in one round trip.
+"""
+
+import pymongo
+from db.clients import get_mongo_db
+from pydantic import BaseModel
+from services.ocrs.parsers import BoundingRegion, Paragraph, Span
+
+
+class IParagraphs(BaseModel):
+    """
+    Paragraphs schema, prevents incorrect data from being inserted
+    id: vector id, f"{md5}:{position}", stored as _id
+    md5: md5 of the document
+    position: position of the paragraph in the document, see ParagraphStore
+    spans, boundingRegions, content: see Paragraph
+    schema_version: schema version number for future changes
+    """
+
+    id: str
+    md5: str
+    position: int
+    spans: list[Span]
+    boundingRegions: list[BoundingRegion]
+    content: str
+    schema_version: int
+
+    def to_paragraph(self) -> Paragraph:
+        return Paragraph(
+            spans=self.spans,
+            boundingRegions=self.boundingRegions,
+            content=self.content,
+        )
+
+
+def create_indexes() -> None:
+    """
+    Create indexes of the paragraphs collection, idempotent
+    Paragraphs are fetched by _id, md5 is indexed to drop a document's paragraphs
+    """
+    paragraphs_col = get_mongo_db()["paragraphs"]
+    paragraphs_col.create_index("md5")
+
+
+def insert_paragraphs(md5: str, start: int, paragraphs: list[Paragraph]) -> int:
+    """
+    Insert, or replace, a bundle of paragraphs, so retried bundles are idempotent
+    Args:
+        md5 (str): md5 hash
+        start (int): position of the first paragraph in the document
+        paragraphs (list[Paragraph]): paragraphs
+    Returns:
+        int: number of paragraphs written
+    """
+    if not paragraphs:
+        return 0
+    paragraphs_col = get_mongo_db()["paragraphs"]
+    requests = []
+    for n, p in enumerate(paragraphs, start):
+        row = IParagraphs(
+            id=f"{md5}:{n}",
+            md5=md5,
+            position=n,
+            spans=p.spans,
+            boundingRegions=p.boundingRegions,
+            content=p.content,
+            schema_version=1,
+        ).model_dump(exclude={"id"})
+        requests.append(
+            pymongo.ReplaceOne({"_id": f"{md5}:{n}"}, row, upsert=True)
+        )
+    paragraphs_col.bulk_write(requests, ordered=False)
+
+    return len(requests)
+
+
+def get_paragraphs(ids: list[str]) -> dict[str, Paragraph]:
+    """
+    Get paragraphs by vector id, in one query
+    Args:
+        ids (list[str]): vector ids
+    Returns:
+        dict[str, Paragraph]: paragraphs by vector id, missing ids are left out
+    """
+    if not ids:
+        return {}
+    paragraphs_col = get_mongo_db()["paragraphs"]
+    rows = paragraphs_col.find({"_id": {"$in": ids}})
+
+    return {
+        row["_id"]: IParagraphs(id=row["_id"], **row).to_paragraph() for row in rows
+    }
@@ -4,6 +4,7 @@ Handles upload collections
 
 from typing import Literal
 
+import pymongo
 from db.clients import get_mongo_db
 from pydantic import BaseModel
 
@@ -17,7 +18,8 @@ class IUploads(BaseModel):
     filename: original filename
     url: cdn url
     user_id: owner's user id
-    ocr_status: ocr status
+    ocr_status: ocr status, FAILED may be requested again
+    ocr_rev: incremented on every ocr status change, invalidates cached responses
     schema_version: schema version number for future changes
     """
 
@@ -27,12 +29,32 @@ class IUploads(BaseModel):
     file_name: str
     url: str
     user_id: str
-    ocr_status: Literal["NOT_STARTED", "PENDING", "IN_PROGRESS", "SUCCESS"] = (
-        "NOT_STARTED"
-    )
+    ocr_status: Literal[
+        "NOT_STARTED", "PENDING", "IN_PROGRESS", "SUCCESS", "FAILED"
+    ] = "NOT_STARTED"
+    ocr_rev: int = 0
     schema_version: int
 
 
+def create_indexes() -> None:
+    """
+    Create indexes of the uploads collection, idempotent
+    - user_id, id, ocr_status: uploads by id, see routers.ocrs, and services.storages
+    - md5, user_id: uploads by content, see tasks.ocrs, and set_ocr_status
+    """
+    uploads_col = get_mongo_db()["uploads"]
+    uploads_col.create_index(
+        [
+            ("user_id", pymongo.ASCENDING),
+            ("id", pymongo.ASCENDING),
+            ("ocr_status", pymongo.ASCENDING),
+        ]
+    )
+    uploads_col.create_index(
+        [("md5", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)]
+    )
+
+
 def insert_upload(p: IUploads) -> bool:
     """
     Insert an upload record
@@ -66,21 +88,22 @@ def query_upload_by(**kwargs) -> IUploads | None:
 def set_ocr_status(
     md5: str,
     user_id: str,
-    status: Literal["NOT_STARTED", "PENDING", "SUCCESS"],
+    status: Literal["NOT_STARTED", "PENDING", "IN_PROGRESS", "SUCCESS", "FAILED"],
 ) -> bool:
     """
-    Set the ocr status of an upload record
+    Set the ocr status of an upload record, and increment its ocr_rev,
+    so responses cached for the previous state are not served, see ExtractCache
     Args:
         md5 (str): md5 hash
         user_id (str): user id
-        status (Literal["NOT_STARTED", "PENDING", "SUCCESS"]): ocr status
+        status (str): ocr status, see IUploads
     Returns:
         bool: True if successful
     """
     uploads_col = get_mongo_db()["uploads"]
     uploads_col.update_one(
         {"md5": md5, "user_id": user_id},
-        {"$set": {"ocr_status": status}},
+        {"$set": {"ocr_status": status}, "$inc": {"ocr_rev": 1}},
     )
 
     return True
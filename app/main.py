@@ -2,6 +2,10 @@
 FastAPI entrypoint see: README.md
 """
 
+from contextlib import asynccontextmanager
+
+from db import documents, paragraphs, uploads
+from db.clients import close_mongo_client
 from fastapi import FastAPI
 from routers import auths, healths, ocrs, users
 from services import logs  # noqa
@@ -16,9 +20,23 @@ Files with MD5 hashes not in the sample will be denied.
 You may test uploading files, extractions, and other routes
 """
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Runs once per gateway process before serving requests
+    """
+    documents.create_indexes()
+    paragraphs.create_indexes()
+    uploads.create_indexes()
+    yield
+    close_mongo_client()
+
+
 app = FastAPI(
     debug=ENVS["DEBUG"],
     description=description,
+    lifespan=lifespan,
 )
 app.include_router(ocrs.router)
 app.include_router(auths.router)
@@ -3,6 +3,12 @@ Handles app health routes
 """
 
 from fastapi import APIRouter
+from services.oai.caches import (
+    embedding_cache,
+    extract_cache,
+    query_embedding_cache,
+    semantic_cache,
+)
 
 router = APIRouter(prefix="/health", tags=["health"])
 
@@ -14,3 +20,20 @@ def get_live():
     Returns 200 {"status": "ok"} if the server is live
     """
     return {"status": "ok"}
+
+
+@router.get("/caches")
+def get_caches():
+    """
+    Cache hit, and miss counters
+    - embeddings: paragraphs, see services.oai.caches.EmbeddingCache.stats
+    - queries: /extract queries
+    - extracts: /extract responses, see services.oai.caches.ExtractCache
+    - semantic: /extract answers to paraphrased queries, see SemanticCache
+    """
+    return {
+        "embeddings": embedding_cache.stats(),
+        "queries": query_embedding_cache.stats(),
+        "extracts": extract_cache.stats(),
+        "semantic": semantic_cache.stats(),
+    }
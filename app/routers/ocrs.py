@@ -3,26 +3,54 @@ Handles OCR functionalities, and extractions
 """
 
 import asyncio
-from typing import Annotated
+import json
+from typing import Annotated, Any, AsyncIterator
 
 from celery.result import AsyncResult
 from constants.limits import UserLimit
-from db.uploads import query_upload_by
-from fastapi import APIRouter, Body, Depends, HTTPException, UploadFile
+from db.uploads import IUploads, query_upload_by
+from fastapi import APIRouter, Body, Depends, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from scheduler import app
 from serializers.commons import GenericErrorResp
 from serializers.ocrs import (
+    ExtractBatchPostIn,
+    ExtractBatchPostOut,
     ExtractPostIn,
     ExtractPostOut,
+    FileMeta,
     OcrPostIn,
     OcrPostOut,
     OcrStatusGetOut,
+    QueryResponse,
     UploadPostOut,
+    UploadPreflightIn,
+    UploadPreflightOut,
+    UploadSessionOut,
+    UploadSessionPostIn,
 )
 from services.auths import User, get_current_active_user
 from services.limits import is_rate_limited
-from services.oai.rags import get_ai_response
-from services.storages import handle_file_upload
+from services.oai.caches import extract_cache
+from services.oai.rags import (
+    get_ai_response,
+    get_batch_ai_response,
+    stream_ai_response,
+)
+from services.storages import (
+    handle_file_upload,
+    preflight_upload,
+    resolve_upload,
+)
+from services.uploads import (
+    abort_upload_session,
+    complete_upload_session,
+    create_upload_session,
+    get_part_size,
+    get_upload_session,
+    put_upload_part,
+)
 from tasks.ocrs import mock_ocr_and_embed_to_pc
 from validators.ocrs import validate_files
 
@@ -53,10 +81,13 @@ async def post_upload(
     # Upload
     - Validate the file(s)
     - Only sample files are allowed
-    - Rename the file to a unique web-safe name
+    - Name the file by its md5, a web-safe name shared by identical files
     - Calculate the md5 hash of the file
-    - Upload the file to a S3 bucket
+    - Upload the file to a S3 bucket, large files in parallel parts,
+    at a content-addressed key, files already stored are not stored again
+    - Call POST /upload/preflight first to skip sending them at all
     - Store file's metadata in mongodb
+    - Files are uploaded concurrently, off the event loop
 
     # Note
     Take Home Assignment dictates that the endpoint should accept
@@ -66,7 +97,9 @@ async def post_upload(
     So, progress bar for each upload is possible.<br>
     This endpoint follows the Take Home Assignment's instructions.
     """
-    if is_rate_limited(f"{user.user_id}:upload", **UserLimit.UPLOAD):
+    if await run_in_threadpool(
+        is_rate_limited, f"{user.user_id}:upload", **UserLimit.UPLOAD
+    ):
         raise HTTPException(
             status_code=429,
             detail="Rate limit exceeded",
@@ -76,12 +109,12 @@ async def post_upload(
             status_code=406,
             detail="No file(s) uploaded",
         )
-    validate_files(files)
-
-    async def _task(file, user_id):
-        return handle_file_upload(file, user_id)
+    await run_in_threadpool(validate_files, files)
 
-    res = await asyncio.gather(*[_task(file, user.user_id) for file in files])
+    # uploads are blocking, each file is uploaded in its own thread, concurrently
+    res = await asyncio.gather(
+        *[run_in_threadpool(handle_file_upload, file, user.user_id) for file in files]
+    )
 
     if not all(res):
         raise HTTPException(
@@ -92,6 +125,182 @@ async def post_upload(
     return UploadPostOut(files=res)
 
 
+@router.post("/upload/preflight")
+def post_upload_preflight(
+    user: Annotated[User, Depends(get_current_active_user)],
+    payload: UploadPreflightIn = Body(...),
+) -> UploadPreflightOut:
+    """
+    Check a file before uploading it, from its md5, and size computed by the client,
+    so rejected, and already stored files are never sent.
+    - `rejected`: the file is too large, or is not a sample file, see `detail`
+    - `exists`: the user already uploaded the file, `file` is its metadata,
+    as returned by POST /upload
+    - `proceed`: upload the file with POST /upload
+
+    Files are stored once per content, at `<namespace>/<md5>.<ext>`.
+    A file another user uploaded must still be sent, an md5 alone does not prove
+    the file is held, it is not stored again once its bytes are hashed.
+    """
+    if is_rate_limited(f"{user.user_id}:core", **UserLimit.CORE):
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+        )
+    status, detail, file = preflight_upload(
+        payload.md5, payload.size, user.user_id, payload.file_name
+    )
+
+    return UploadPreflightOut(status=status, detail=detail, file=file)
+
+
+@router.post(
+    "/upload/sessions",
+    responses={
+        413: {"model": GenericErrorResp},
+        429: {"model": GenericErrorResp},
+    },
+)
+def post_upload_session(
+    user: Annotated[User, Depends(get_current_active_user)],
+    payload: UploadSessionPostIn = Body(...),
+) -> UploadSessionOut:
+    """
+    Start a resumable upload, for large files over unreliable connections.
+
+    # Protocol
+    - POST /upload/sessions with the file's name, and size
+    - PUT each part to /upload/sessions/:session_id/parts/:number, numbered from 1,
+    `part_size` bytes each, the last part holds the rest of the file.
+    Parts may be sent in any order, in parallel, and sent again if they failed
+    - GET /upload/sessions/:session_id lists the parts `received`, to resume
+    - POST /upload/sessions/:session_id/complete once every part is received,
+    returns the file's metadata, as POST /upload does
+    - DELETE /upload/sessions/:session_id abandons the upload
+
+    Sessions expire 24 hours after their last part.
+    """
+    if is_rate_limited(f"{user.user_id}:upload", **UserLimit.UPLOAD):
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+        )
+
+    return create_upload_session(user.user_id, payload.file_name, payload.size)
+
+
+@router.get("/upload/sessions/{session_id}")
+def get_upload_session_status(
+    user: Annotated[User, Depends(get_current_active_user)],
+    session_id: str,
+) -> UploadSessionOut:
+    """
+    Get an upload session, and the parts received so far
+    """
+    if is_rate_limited(f"{user.user_id}:core", **UserLimit.CORE):
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+        )
+
+    return get_upload_session(session_id, user.user_id)
+
+
+@router.put(
+    "/upload/sessions/{session_id}/parts/{number}",
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/octet-stream": {}},
+            "required": True,
+        }
+    },
+)
+async def put_upload_session_part(
+    user: Annotated[User, Depends(get_current_active_user)],
+    session_id: str,
+    number: int,
+    request: Request,
+) -> UploadSessionOut:
+    """
+    Upload a part of a file, the request body is the part's bytes
+    A part sent again replaces the previous one.
+    - 411 without Content-Length, 400 if the part's size is not its expected size,
+    see `part_size`, the body is not read past it
+    """
+    if await run_in_threadpool(
+        is_rate_limited, f"{user.user_id}:core", **UserLimit.CORE
+    ):
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+        )
+    expected = await run_in_threadpool(
+        get_part_size, session_id, user.user_id, number
+    )
+    content_length = request.headers.get("content-length")
+    if content_length is None:
+        raise HTTPException(
+            status_code=411,
+            detail="Content-Length required",
+        )
+    if not content_length.isdigit() or int(content_length) != expected:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Part {number} must be {expected} bytes",
+        )
+    # Content-Length is not trusted, the body is read up to one byte past the part
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > expected:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Part {number} must be {expected} bytes",
+            )
+
+    return await run_in_threadpool(
+        put_upload_part, session_id, user.user_id, number, bytes(body)
+    )
+
+
+@router.post("/upload/sessions/{session_id}/complete")
+def post_upload_session_complete(
+    user: Annotated[User, Depends(get_current_active_user)],
+    session_id: str,
+) -> FileMeta:
+    """
+    Complete an upload once every part is received.
+    The file is hashed, checked, and stored as with POST /upload,
+    a file already stored is not stored again.
+    - 409 if parts are missing, see `received`
+    - 413 if the file is not a sample file, 406 if its type is not allowed,
+    the session is then dropped
+    """
+    if is_rate_limited(f"{user.user_id}:core", **UserLimit.CORE):
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+        )
+
+    return complete_upload_session(session_id, user.user_id)
+
+
+@router.delete("/upload/sessions/{session_id}")
+def delete_upload_session(
+    user: Annotated[User, Depends(get_current_active_user)],
+    session_id: str,
+) -> None:
+    """
+    Abandon an upload, parts received are deleted
+    """
+    if is_rate_limited(f"{user.user_id}:core", **UserLimit.CORE):
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+        )
+    abort_upload_session(session_id, user.user_id)
+
+
 @router.post("/ocr")
 def post_ocr(
     user: Annotated[User, Depends(get_current_active_user)],
@@ -108,6 +317,9 @@ def post_ocr(
     - If the file is not uploaded, being processed, or failed, the status in
     `AsyncResult(task_id, app=app).get()` will have a not None error object
     - If the file is uploaded, mock the ocr result and embed to Pinecone
+    - `file_id`, or a url to the bucket, is resolved to the upload record, so the
+    task does not download the file, other urls are downloaded by the task
+    - If `file_id` is not one of the user's uploads return 404
     - File can only be OCR'd once
     - While OCR is pending, user can't request another OCR of the same file
     user can be notified immediately if we implement POST /document/:doc_id/ocr
@@ -117,7 +329,15 @@ def post_ocr(
             status_code=429,
             detail="Rate limit exceeded",
         )
-    result = mock_ocr_and_embed_to_pc.s(payload.url, user.user_id).delay()
+    upload = resolve_upload(user.user_id, url=payload.url, file_id=payload.file_id)
+    if upload is None and payload.url is None:
+        raise HTTPException(
+            status_code=404,
+            detail="File not found",
+        )
+    url = payload.url if upload is None else upload.url
+    md5_hash = None if upload is None else upload.md5
+    result = mock_ocr_and_embed_to_pc.s(url, user.user_id, md5_hash=md5_hash).delay()
     return {"task_id": result.id}
 
 
@@ -129,6 +349,8 @@ def get_ocr_status(
     """
     Check the status of the OCR task.
     Return the status of the OCR task given the task_id
+    The OCR task is replaced by a chord of per-bundle tasks which inherits
+    the task_id, so the status reports on the whole document.
     """
     if is_rate_limited(f"{user.user_id}:core", **UserLimit.CORE):
         raise HTTPException(
@@ -139,8 +361,47 @@ def get_ocr_status(
     return {"status": result}
 
 
+def _get_extract_upload(
+    user_id: str,
+    payload: ExtractPostIn,
+) -> tuple[IUploads, str | None]:
+    """
+    Sync lookups of POST /extract, run in one threadpool hop
+    - rate limit, the user's upload, and the cached response,
+    template answers are not cached, they are as fast to render
+    Returns:
+        tuple[IUploads, str | None]: upload, and the cached response JSON if any
+    """
+    if is_rate_limited(f"{user_id}:extract", **UserLimit.EXTRACT):
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+        )
+    upload = query_upload_by(
+        user_id=user_id,
+        id=payload.file_id,
+        ocr_status="SUCCESS",
+    )
+    if upload is None:
+        raise HTTPException(
+            status_code=404,
+            detail="File not found or OCR not done",
+        )
+    if payload.answer == "template":
+        return upload, None
+    cached = extract_cache.get(
+        user_id,
+        upload.md5,
+        upload.ocr_rev,
+        payload.query,
+        payload.mode,
+    )
+
+    return upload, cached
+
+
 @router.post("/extract")
-def post_extract(
+async def post_extract(
     user: Annotated[User, Depends(get_current_active_user)],
     payload: ExtractPostIn = Body(),
 ) -> ExtractPostOut:
@@ -149,18 +410,60 @@ def post_extract(
     - If the file is not uploaded, being processed, or failed return 404
     - `chatbot_response` is natural language response from AI
     - `query_responses` is the raw response from Pinecone
+    - `mode` selects the search: `vector` (default), `lexical` for exact references,
+    which skips the query embedding, or `hybrid`, see rags.retrieve_paragraphs
+    - `answer`: `chatbot` (default), or `template` to skip the chatbot,
+    `chatbot_response` then lists the page, offset, and a snippet of each result
+    with the query in bold, see services.oai.renders
+    - Responses are cached per user, file, and normalized query, until the
+    file's ocr status changes, see services.oai.caches.ExtractCache
+    - The route is async, OpenAI and Pinecone are awaited on the event loop,
+    so waiting extractions do not hold threadpool threads
 
     Note:
-    Embedding of the query can be cached.
-    This entire endpoint can also be cached, depending on the FE use case
+    Embedding of the query is cached, see services.oai.rags.get_query_embedding
+    """
+    upload, cached = await run_in_threadpool(_get_extract_upload, user.user_id, payload)
+    if cached is not None:
+        return ExtractPostOut.model_validate_json(cached)
+    resp = ExtractPostOut.model_validate(
+        await get_ai_response(
+            payload.query,
+            user.user_id,
+            upload.md5,
+            payload.mode,
+            payload.answer,
+        )
+    )
+    if payload.answer == "template":
+        return resp
+    await run_in_threadpool(
+        extract_cache.set,
+        user.user_id,
+        upload.md5,
+        upload.ocr_rev,
+        payload.query,
+        resp.model_dump_json(),
+        payload.mode,
+    )
+
+    return resp
+
+
+def _get_batch_upload(user_id: str, payload: ExtractBatchPostIn) -> IUploads:
     """
-    if is_rate_limited(f"{user.user_id}:extract", **UserLimit.EXTRACT):
+    Sync lookups of POST /extract/batch, run in one threadpool hop
+    - rate limit, one unit per query, and the user's upload
+    """
+    if is_rate_limited(
+        f"{user_id}:extract", **UserLimit.EXTRACT, cost=len(payload.queries)
+    ):
         raise HTTPException(
             status_code=429,
             detail="Rate limit exceeded",
         )
     upload = query_upload_by(
-        user_id=user.user_id,
+        user_id=user_id,
         id=payload.file_id,
         ocr_status="SUCCESS",
     )
@@ -169,9 +472,131 @@ def post_extract(
             status_code=404,
             detail="File not found or OCR not done",
         )
-    resp = get_ai_response(
-        payload.query,
-        user.user_id,
-        upload.md5,
+
+    return upload
+
+
+@router.post(
+    "/extract/batch",
+    responses={
+        404: {"model": GenericErrorResp},
+        429: {"model": GenericErrorResp},
+    },
+)
+async def post_extract_batch(
+    user: Annotated[User, Depends(get_current_active_user)],
+    payload: ExtractBatchPostIn = Body(),
+) -> ExtractBatchPostOut:
+    """
+    Extract text from a document for many queries at once.
+    - Each query counts against the rate limit of POST /extract
+    - The upload is looked up once, queries are embedded in a single OpenAI request,
+    and searched concurrently, see rags.retrieve_many
+    - `results` holds the raw matches of each query, in the order of `queries`
+    - `chatbot_response` describes the results of every query if `summarize`,
+    null otherwise
+    - If the file is not uploaded, being processed, or failed return 404
+    """
+    upload = await run_in_threadpool(_get_batch_upload, user.user_id, payload)
+
+    return ExtractBatchPostOut.model_validate(
+        await get_batch_ai_response(
+            payload.queries,
+            user.user_id,
+            upload.md5,
+            payload.mode,
+            payload.summarize,
+        )
+    )
+
+
+def _sse(event: str, data: Any) -> str:
+    """
+    Formats a server-sent event, data is JSON encoded
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post(
+    "/extract/stream",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {"text/event-stream": {}},
+            "description": "Server-sent events",
+        },
+        404: {"model": GenericErrorResp},
+        429: {"model": GenericErrorResp},
+    },
+)
+async def post_extract_stream(
+    user: Annotated[User, Depends(get_current_active_user)],
+    payload: ExtractPostIn = Body(),
+) -> StreamingResponse:
+    """
+    Streaming variant of POST /extract, as server-sent events.
+    Errors are returned as with POST /extract, before the stream starts.
+
+    # Events
+    - `query_responses`: the raw response from Pinecone, sent once retrieved
+    - `token`: part of `chatbot_response`, sent as it is generated
+    - `done`: `{}`, the response is complete
+
+    Cached responses, and template answers, are streamed as a single `token` event,
+    complete responses are cached for POST /extract too.
+    """
+    upload, cached = await run_in_threadpool(_get_extract_upload, user.user_id, payload)
+    if payload.answer == "template":
+        cached = ExtractPostOut.model_validate(
+            await get_ai_response(
+                payload.query,
+                user.user_id,
+                upload.md5,
+                payload.mode,
+                payload.answer,
+            )
+        ).model_dump_json()
+    if cached is not None:
+        resp = ExtractPostOut.model_validate_json(cached)
+        matches = resp.model_dump()["query_responses"]
+        tokens = None
+    else:
+        matches, tokens = await stream_ai_response(
+            payload.query,
+            user.user_id,
+            upload.md5,
+            payload.mode,
+        )
+        matches = [QueryResponse.model_validate(m).model_dump() for m in matches]
+
+    async def _events() -> AsyncIterator[str]:
+        yield _sse("query_responses", matches)
+        if tokens is None:
+            yield _sse("token", resp.chatbot_response)
+            yield _sse("done", {})
+            return
+        parts = []
+        async for token in tokens:
+            parts.append(token)
+            yield _sse("token", token)
+        streamed = ExtractPostOut(
+            chatbot_response="".join(parts),
+            query_responses=matches,
+        )
+        await run_in_threadpool(
+            extract_cache.set,
+            user.user_id,
+            upload.md5,
+            upload.ocr_rev,
+            payload.query,
+            streamed.model_dump_json(),
+            payload.mode,
+        )
+        yield _sse("done", {})
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        # nginx must not buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    return resp
@@ -6,10 +6,14 @@ to avoid external service rate limit
 """
 
 from celery import Celery
+from celery.signals import worker_init
+from db import documents, paragraphs, uploads
+from db.clients import close_mongo_client
 from services.env_man import ENVS
 
 TASK_ANNOTATIONS = {
     "tasks.ocrs.mock_ocr_and_embed_to_pc": {"rate_limit": "10/s"},
+    "tasks.ocrs.embed_bundles": {"rate_limit": "10/s"},
 }
 INCLUDE = ["tasks.ocrs"]
 
@@ -27,5 +31,19 @@ app.conf.update(
 )
 
 
+@worker_init.connect
+def create_indexes(**kwargs):
+    """
+    Runs once per worker before its processes are forked, as main.lifespan does
+    for the gateway, a worker may start first, or against a fresh database.
+    claim_document is only atomic once the documents' unique md5 index exists.
+    """
+    documents.create_indexes()
+    paragraphs.create_indexes()
+    uploads.create_indexes()
+    # forked processes create their own client, see db.clients.get_mongo_client
+    close_mongo_client()
+
+
 if __name__ == "__main__":
     app.start()
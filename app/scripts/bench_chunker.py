@@ -0,0 +1,88 @@
+"""
+Micro-benchmark of paragraph bundling on the sample documents in MOCK_DATA_MAP
+Compares:
+- legacy: tiktoken.get_encoding per paragraph, deque pop and push-back
+- chunker: cached encoder, one encode_batch pass, single linear sweep
+Run from app/ with `python -m scripts.bench_chunker`
+"""
+
+import json
+import logging
+import os
+import time
+from collections import deque
+
+import tiktoken
+from data.data_map import MOCK_DATA_MAP
+from services.ocrs.chunkers import bundle_paragraphs
+from services.ocrs.parsers import OcrResult, Paragraph
+
+logger = logging.getLogger(__name__)
+
+ROUNDS = 5
+MAX_TOKEN = 4000
+ENCODING_NAME = "cl100k_base"
+
+
+def legacy_bundle_paragraphs(paragraphs: list[Paragraph]) -> list[list[Paragraph]]:
+    """
+    Bundling as done before services.ocrs.chunkers, without oversized paragraph handling
+    """
+    queue = deque(paragraphs)
+    bundles = []
+    while queue:
+        total_tokens = 0
+        bundle = []
+        while queue:
+            paragraph = queue.popleft()
+            encoding = tiktoken.get_encoding(ENCODING_NAME)
+            token_count = len(encoding.encode(paragraph.content))
+            if total_tokens + token_count > MAX_TOKEN:
+                queue.appendleft(paragraph)
+                break
+            total_tokens += token_count
+            bundle.append(paragraph)
+        if not bundle:
+            raise ValueError("paragraph larger than MAX_TOKEN")
+        bundles.append(bundle)
+
+    return bundles
+
+
+def timeit(fn, *args) -> tuple[float, object]:
+    """
+    Returns the best wall time of ROUNDS runs in ms, and the last result
+    """
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return best * 1000, result
+
+
+def main():
+    for md5_hash, fp in MOCK_DATA_MAP.items():
+        if not os.path.exists(fp):
+            logger.warning(f"{md5_hash=} {fp} not found, skipped")
+            continue
+        with open(fp, "r") as f:
+            paragraphs = OcrResult(**json.load(f)).analyzeResult.paragraphs
+        # warm up the encoder cache, so both sides are measured without loading it
+        tiktoken.get_encoding(ENCODING_NAME)
+        bundle_paragraphs(paragraphs[:1])
+
+        legacy_ms, legacy = timeit(legacy_bundle_paragraphs, paragraphs)
+        chunker_ms, bundles = timeit(bundle_paragraphs, paragraphs, MAX_TOKEN)
+        print(
+            f"{fp}: {len(paragraphs)} paragraphs\n"
+            f"  legacy  {legacy_ms:8.2f} ms {len(legacy)} bundles\n"
+            f"  chunker {chunker_ms:8.2f} ms {len(bundles)} bundles\n"
+            f"  speedup {legacy_ms / chunker_ms:8.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
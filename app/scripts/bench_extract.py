@@ -0,0 +1,61 @@
+"""
+Benchmark of /extract answers, chatbot vs template
+Runs get_ai_response over a document the user owns, with each answer mode,
+and prints p50, and p99 latency. Query embeddings are cached after the first run,
+the semantic answer cache is disabled, so every chatbot answer is generated.
+Run from app/ with `python -m scripts.bench_extract user_id md5 [runs]`
+"""
+
+import asyncio
+import sys
+import time
+
+import numpy as np
+from services.oai.caches import semantic_cache
+from services.oai.rags import get_ai_response
+
+QUERIES = [
+    "第一節の二 適用区域",
+    "適用区域",
+    "第一条の二",
+    "目的",
+    "定義",
+]
+
+
+def percentiles(samples: list[float]) -> str:
+    p50, p99 = np.percentile(np.asarray(samples) * 1000, [50, 99])
+    return f"p50 {p50:9.1f} ms  p99 {p99:9.1f} ms"
+
+
+async def bench(user_id: str, md5_hash: str, answer: str, runs: int) -> str:
+    samples = []
+    for n in range(runs):
+        start = time.perf_counter()
+        await get_ai_response(
+            QUERIES[n % len(QUERIES)], user_id, md5_hash, "vector", answer
+        )
+        samples.append(time.perf_counter() - start)
+
+    return percentiles(samples)
+
+
+async def run(user_id: str, md5_hash: str, runs: int) -> None:
+    # embeds the queries once, so both modes are timed with cached embeddings
+    await bench(user_id, md5_hash, "template", len(QUERIES))
+    for answer in ("chatbot", "template"):
+        print(f"{answer:>8}: {await bench(user_id, md5_hash, answer, runs)}")
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        return
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    semantic_cache.threshold = 2.0
+    # async clients are shared per process, so every run shares one event loop
+    asyncio.run(run(sys.argv[1], sys.argv[2], runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of upload lookups, as done on every /extract, see db.uploads.query_upload_by
+Compares, on a scratch database of MONGO_URI, dropped afterwards:
+- per-call: a new MongoClient per lookup, as get_mongo_db did before
+- pooled: the process' client, see db.clients.get_mongo_client
+- pooled, with the uploads indexes, see db.uploads.create_indexes
+Run from app/ against a local mongod with `python -m scripts.bench_mongo [uploads]`
+"""
+
+import sys
+import time
+
+import nanoid
+import numpy as np
+import pymongo
+from db import uploads
+from db.clients import get_mongo_client
+from services.env_man import ENVS
+
+DB = "bench_mongo"
+LOOKUPS = 200
+
+
+def percentiles(samples: list[float]) -> str:
+    p50, p99 = np.percentile(np.asarray(samples) * 1000, [50, 99])
+    return f"p50 {p50:8.3f} ms  p99 {p99:8.3f} ms"
+
+
+def seed(col, count: int) -> list[dict]:
+    rows = [
+        {
+            "id": nanoid.generate(),
+            "ext": "pdf",
+            "md5": nanoid.generate(),
+            "file_name": "file_name",
+            "url": "url",
+            "user_id": f"user{n % 100}",
+            "ocr_status": "SUCCESS",
+            "ocr_rev": 1,
+            "schema_version": 1,
+        }
+        for n in range(count)
+    ]
+    col.insert_many([dict(r) for r in rows])
+
+    return rows
+
+
+def bench(get_col, rows: list[dict]) -> str:
+    samples = []
+    for n in range(LOOKUPS):
+        row = rows[(n * 7919) % len(rows)]
+        start = time.perf_counter()
+        get_col().find_one(
+            {"user_id": row["user_id"], "id": row["id"], "ocr_status": "SUCCESS"}
+        )
+        samples.append(time.perf_counter() - start)
+
+    return percentiles(samples)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    client = get_mongo_client()
+    client.drop_database(DB)
+    col = client[DB]["uploads"]
+    try:
+        rows = seed(col, count)
+        clients = []
+
+        def per_call():
+            c = pymongo.MongoClient(ENVS["MONGO_URI"])
+            clients.append(c)
+            return c[DB]["uploads"]
+
+        print(f"{count} uploads")
+        print(f"per-call, no index: {bench(per_call, rows)}")
+        for c in clients:
+            c.close()
+        print(f"  pooled, no index: {bench(lambda: col, rows)}")
+        get_db = uploads.get_mongo_db
+        uploads.get_mongo_db = lambda db="mongo": client[DB]
+        try:
+            uploads.create_indexes()
+        finally:
+            uploads.get_mongo_db = get_db
+        print(f"  pooled,  indexed: {bench(lambda: col, rows)}")
+    finally:
+        client.drop_database(DB)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of loading a document's paragraphs, and token counts, on the sample
+documents in MOCK_DATA_MAP
+Compares:
+- json: json.load, OcrResult validation, and token counting
+- store: opening the compiled paragraph store, and reading every paragraph
+Run from app/ with `python -m scripts.bench_paragraph_store`
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+from data.data_map import MOCK_DATA_MAP
+from services.ocrs.chunkers import iter_chunks
+from services.ocrs.parsers import OcrResult
+from services.ocrs.stores import ParagraphStore, compile_paragraph_store
+
+logger = logging.getLogger(__name__)
+
+ROUNDS = 5
+
+
+def load_json(fp: str) -> tuple[int, int]:
+    with open(fp, "r") as f:
+        ocr_result = OcrResult(**json.load(f))
+    chunks = list(iter_chunks(ocr_result.analyzeResult.paragraphs))
+
+    return len(chunks), sum(c.token_count for c in chunks)
+
+
+def load_store(path: str) -> tuple[int, int]:
+    with ParagraphStore(path) as store:
+        paragraphs = list(store.iter_range(0, len(store)))
+        token_counts = store.token_counts()
+
+    return len(paragraphs), sum(token_counts)
+
+
+def timeit(fn, *args) -> tuple[float, object]:
+    """
+    Returns the best wall time of ROUNDS runs in ms, and the last result
+    """
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return best * 1000, result
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        for md5_hash, fp in MOCK_DATA_MAP.items():
+            if not os.path.exists(fp):
+                logger.warning(f"{md5_hash=} {fp} not found, skipped")
+                continue
+            path = os.path.join(tmp, f"{md5_hash}.pgs")
+            start = time.perf_counter()
+            compile_paragraph_store(fp, path)
+            compile_ms = (time.perf_counter() - start) * 1000
+
+            json_ms, json_result = timeit(load_json, fp)
+            store_ms, store_result = timeit(load_store, path)
+            assert json_result == store_result
+            print(
+                f"{fp}: {json_result[0]} paragraphs, {json_result[1]} tokens\n"
+                f"  json    {os.path.getsize(fp):>10} bytes {json_ms:8.2f} ms\n"
+                f"  store   {os.path.getsize(path):>10} bytes {store_ms:8.2f} ms"
+                f" (compiled once in {compile_ms:.2f} ms)\n"
+                f"  speedup {json_ms / store_ms:8.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
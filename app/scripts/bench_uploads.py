@@ -0,0 +1,65 @@
+"""
+Benchmark of S3 uploads, as done by POST /upload for 5 files
+Compares, on random files uploaded to AWS_BUCKET_NAME under bench/, deleted afterwards:
+- before: a new client per file, one put_object per file, files one after another
+- after: the process' client, multipart uploads of S3_PART_SIZE parts,
+streamed as read, files uploaded concurrently, see services.storages.MultipartUpload
+Run from app/ against a local S3 stand-in, ex. minio, with AWS_ENDPOINT_URL set,
+`python -m scripts.bench_uploads [megabytes per file]`
+"""
+
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from services.env_man import ENVS
+from services.storages import DOWNLOAD_CHUNK_SIZE, MultipartUpload, get_s3_client
+
+FILES = 5
+RUNS = 3
+
+
+def before(bucket: str, keys: list[str], bodies: list[bytes]) -> None:
+    for key, body in zip(keys, bodies):
+        boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=io.BytesIO(body))
+
+
+def stream_upload(bucket: str, key: str, body: bytes) -> None:
+    upload = MultipartUpload(bucket, key, "application/octet-stream")
+    for i in range(0, len(body), DOWNLOAD_CHUNK_SIZE):
+        upload.write(body[i : i + DOWNLOAD_CHUNK_SIZE])
+    upload.complete()
+
+
+def after(bucket: str, keys: list[str], bodies: list[bytes]) -> None:
+    with ThreadPoolExecutor(max_workers=FILES) as pool:
+        list(pool.map(lambda kb: stream_upload(bucket, *kb), zip(keys, bodies)))
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    bucket = ENVS["AWS_BUCKET_NAME"]
+    bodies = [os.urandom(megabytes << 20) for _ in range(FILES)]
+    keys = [f"bench/{n}.bin" for n in range(FILES)]
+    print(f"{FILES} files of {megabytes}MB, part size {ENVS['S3_PART_SIZE'] >> 20}MB")
+    try:
+        for name, upload in (("before", before), ("after", after)):
+            samples = []
+            for _ in range(RUNS):
+                start = time.perf_counter()
+                upload(bucket, keys, bodies)
+                samples.append(time.perf_counter() - start)
+            best = min(samples)
+            mbps = FILES * megabytes / best
+            print(f"{name:>6}: best {best:7.3f} s  {mbps:8.1f} MB/s")
+    finally:
+        get_s3_client().delete_objects(
+            Bucket=bucket, Delete={"Objects": [{"Key": k} for k in keys]}
+        )
+
+
+if __name__ == "__main__":
+    main()
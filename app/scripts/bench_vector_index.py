@@ -0,0 +1,107 @@
+"""
+Benchmark of per-document vector search
+Compares, on random unit vectors of text-embedding-3-small's 1536 dimensions:
+- brute: NumPy brute-force top-k over the memory-mapped matrix
+- hnsw: HNSW index, if hnswlib is installed
+With a document's md5 as argument, also compares the local index of that
+document with Pinecone's metadata-filtered query, both through query_embeddings.
+Run from app/ with `python -m scripts.bench_vector_index [md5]`
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from services.env_man import ENVS
+from services.oai import indexes
+from services.oai.indexes import (
+    compile_vector_index,
+    open_vector_index,
+    write_fragment,
+)
+
+DIMENSIONS = 1536
+SIZES = [1000, 5000, 20000]
+QUERIES = 200
+TOP_K = 3
+
+
+def percentiles(samples: list[float]) -> str:
+    p50, p99 = np.percentile(np.asarray(samples) * 1000, [50, 99])
+    return f"p50 {p50:8.3f} ms  p99 {p99:8.3f} ms"
+
+
+def bench_local(size: int, use_hnsw: bool) -> str:
+    rng = np.random.default_rng(size)
+    vectors = rng.normal(size=(size, DIMENSIONS)).astype(np.float32)
+    queries = rng.normal(size=(QUERIES, DIMENSIONS)).astype(np.float32)
+    md5_hash = f"bench{size}"
+    min_vectors = indexes.HNSW_MIN_VECTORS
+    indexes.HNSW_MIN_VECTORS = 0 if use_hnsw else size + 1
+    try:
+        for start in range(0, size, 1000):
+            stop = min(start + 1000, size)
+            write_fragment(md5_hash, list(range(start, stop)), vectors[start:stop])
+        compile_vector_index(md5_hash, size)
+    finally:
+        indexes.HNSW_MIN_VECTORS = min_vectors
+    index = open_vector_index(md5_hash)
+    samples = []
+    for q in queries:
+        start = time.perf_counter()
+        index.query(q, TOP_K)
+        samples.append(time.perf_counter() - start)
+    indexes._open_indexes.pop(md5_hash)
+
+    return percentiles(samples)
+
+
+async def bench_document(md5_hash: str, backend: str) -> str:
+    from services.oai.rags import get_query_embedding, query_embeddings
+
+    ENVS["VECTOR_BACKEND"] = backend
+    vector = await get_query_embedding("第一節の二 適用区域")
+    samples = []
+    for _ in range(QUERIES // 10):
+        start = time.perf_counter()
+        await query_embeddings(
+            index="default",
+            vector=vector,
+            top_k=TOP_K,
+            d_filter={"md5_hash": {"$eq": md5_hash}},
+        )
+        samples.append(time.perf_counter() - start)
+
+    return percentiles(samples)
+
+
+def main():
+    if len(sys.argv) > 1:
+        md5_hash = sys.argv[1]
+        if open_vector_index(md5_hash) is None:
+            print(f"{md5_hash} has no local index in {ENVS['ARTIFACT_DIR']}")
+            return
+        for backend in ("pinecone", "local"):
+            result = asyncio.run(bench_document(md5_hash, backend))
+            print(f"{md5_hash} {backend:>8}: {result}")
+        return
+
+    artifact_dir = ENVS["ARTIFACT_DIR"]
+    with tempfile.TemporaryDirectory() as tmp:
+        ENVS["ARTIFACT_DIR"] = tmp
+        try:
+            for size in SIZES:
+                print(f"{size:>6} vectors  brute: {bench_local(size, False)}")
+                if indexes.hnswlib is not None:
+                    print(f"{size:>6} vectors   hnsw: {bench_local(size, True)}")
+                for name in os.listdir(tmp):
+                    os.remove(os.path.join(tmp, name))
+        finally:
+            ENVS["ARTIFACT_DIR"] = artifact_dir
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,8 @@ Handles serializers for ocrs endpoints
 
 from typing import Literal
 
-from pydantic import BaseModel, Field, field_validator
+from constants.limits import UserLimit
+from pydantic import BaseModel, Field, field_validator, model_validator
 from pydantic_core import Url
 
 
@@ -30,8 +31,66 @@ class UploadPostOut(BaseModel):
     files: list[FileMeta]
 
 
+class UploadPreflightIn(BaseModel):
+    md5: str = Field(
+        ...,
+        pattern=r"^[0-9a-f]{32}$",
+        description="md5 hash of the file, hex encoded",
+    )
+    size: int = Field(..., ge=0, description="Size of the file in bytes")
+    file_name: str = Field(..., min_length=1, description="Original file name")
+
+
+class UploadSessionPostIn(BaseModel):
+    file_name: str = Field(..., min_length=1, description="Original file name")
+    size: int = Field(..., ge=0, description="Size of the file in bytes")
+
+
+class UploadSessionOut(BaseModel):
+    """
+    session_id: id of the upload session
+    size: size of the file in bytes
+    part_size: bytes of every part, except the last one which holds the rest
+    part_count: number of parts
+    received: part numbers received so far
+    """
+
+    session_id: str
+    size: int
+    part_size: int
+    part_count: int
+    received: list[int]
+
+
+class UploadPreflightOut(BaseModel):
+    """
+    status:
+    - rejected: the upload would be rejected, see detail
+    - exists: the user already uploaded the file, file is its metadata
+    - proceed: upload the file with POST /upload
+    """
+
+    status: Literal["rejected", "exists", "proceed"]
+    detail: str | None = None
+    file: FileMeta | None = None
+
+
 class OcrPostIn(BaseModel):
-    url: str
+    url: str | None = Field(
+        None,
+        description="Url to the file, uploaded files are resolved without a download",
+    )
+    file_id: str | None = Field(
+        None,
+        description="File id of an upload, instead of its url",
+        examples=["9TMF2cDwGHg1yAz3aNtg_"],
+    )
+
+    @model_validator(mode="after")
+    def url_or_file_id_validator(self):
+        if self.url is None and self.file_id is None:
+            raise ValueError("Either url or file_id is required")
+        return self
 
 
 class OcrPostOut(BaseModel):
@@ -61,22 +120,77 @@ class ExtractPostIn(BaseModel):
             "9TMF2cDwGHg1yAz3aNtg_",
         ],
     )
+    mode: Literal["vector", "lexical", "hybrid"] = Field(
+        "vector",
+        description=(
+            "vector: embedding search, lexical: BM25 over character bigrams, "
+            "without embedding the query, hybrid: both rankings fused"
+        ),
+    )
+    answer: Literal["chatbot", "template"] = Field(
+        "chatbot",
+        description=(
+            "chatbot: results described by the chatbot, template: page, offset, "
+            "and a highlighted snippet of each result, rendered without the chatbot"
+        ),
+    )
 
     @field_validator("query")
     def query_validator(cls, value):
-        if len(value) < 2:
-            raise ValueError("Query must be at least 2 characters long")
-        if len(value) > 30:
-            raise ValueError("Query must be at most 30 characters long")
-        return value
+        return validate_query(value)
+
+
+def validate_query(value: str) -> str:
+    if len(value) < 2:
+        raise ValueError("Query must be at least 2 characters long")
+    if len(value) > 30:
+        raise ValueError("Query must be at most 30 characters long")
+    return value
+
+
+class ExtractBatchPostIn(BaseModel):
+    """
+    Each query counts against the extract rate limit, so a batch has at most
+    as many queries as the limit allows per window
+    """
+
+    queries: list[str] = Field(
+        ...,
+        min_length=1,
+        max_length=UserLimit.EXTRACT["limit"],
+        description="Queries to search for",
+        examples=[["第一節の二 適用区域(第一条の二)", "第二節"]],
+    )
+    file_id: str = Field(
+        ...,
+        description="File id to search in",
+        examples=[
+            "9TMF2cDwGHg1yAz3aNtg_",
+        ],
+    )
+    mode: Literal["vector", "lexical", "hybrid"] = Field(
+        "vector",
+        description="See POST /extract",
+    )
+    summarize: bool = Field(
+        False,
+        description="Describe the results of every query in one chatbot response",
+    )
+
+    @field_validator("queries")
+    def queries_validator(cls, value):
+        return [validate_query(q) for q in value]
 
 
 class MetaData(BaseModel):
+    """
+    user_id is only set on vectors embedded before vectors were shared per document
+    """
+
     md5_hash: str
     meta: str
-    user_id: str
     model: str
-    user_id: str
+    user_id: str | None = None
 
 
 class QueryResponse(BaseModel):
@@ -88,3 +202,13 @@ class QueryResponse(BaseModel):
 class ExtractPostOut(BaseModel):
     chatbot_response: str
     query_responses: list[QueryResponse]
+
+
+class ExtractBatchResult(BaseModel):
+    query: str
+    query_responses: list[QueryResponse]
+
+
+class ExtractBatchPostOut(BaseModel):
+    results: list[ExtractBatchResult]
+    chatbot_response: str | None = None
@@ -0,0 +1,164 @@
+"""
+Handles generic caches
+- LRUCache: in-process, size bounded, least recently used entries are evicted first
+- RedisLRUCache: shared across processes, size bounded by a recency index in redis
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from redis import Redis
+
+
+class LRUCache:
+    """
+    In-process LRU cache, safe to share between threads.
+    Args:
+        maxsize (int): maximum number of entries
+        ttl (int | None): seconds before an entry expires, None never expires
+    """
+
+    def __init__(self, maxsize: int, ttl: int | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any | None:
+        """
+        Get an entry, and mark it as recently used
+        Returns:
+            Any | None: value, None if not found or expired
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Set an entry, the least recently used entries are evicted if full
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self) -> list[tuple[Hashable, Any]]:
+        """
+        Unexpired entries, least recently used first, recency is not changed
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, value)
+                for key, (expires_at, value) in self._data.items()
+                if not expires_at or expires_at >= now
+            ]
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class RedisLRUCache:
+    """
+    Redis cache bounded to max_entries.
+    Values are stored as plain keys with a TTL, a sorted set of the keys scored
+    by last access time is kept, and used to evict the least recently used
+    entries once the cache is over max_entries.
+    Args:
+        client (Redis): redis client, values are returned as stored
+        namespace (str): key prefix
+        max_entries (int): maximum number of entries
+        ttl (int | None): seconds before an entry expires, None never expires
+    """
+
+    def __init__(
+        self,
+        client: Redis,
+        namespace: str,
+        max_entries: int,
+        ttl: int | None = None,
+    ):
+        self.client = client
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_key = f"{namespace}:lru"
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def get_many(self, keys: list[str]) -> list[Any | None]:
+        """
+        Get entries, and mark the found ones as recently used
+        Returns:
+            list[Any | None]: values in the order of keys, None if not found
+        """
+        if not keys:
+            return []
+        values = self.client.mget([self._key(k) for k in keys])
+        found = {self._key(k): time.time() for k, v in zip(keys, values) if v}
+        if found:
+            self.client.zadd(self.index_key, found)
+
+        return values
+
+    def get(self, key: str) -> Any | None:
+        return self.get_many([key])[0]
+
+    def set_many(self, items: dict[str, Any]) -> None:
+        """
+        Set entries, then evict the least recently used entries if over max_entries
+        """
+        if not items:
+            return
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(self._key(key), value, ex=self.ttl)
+        pipe.zadd(self.index_key, {self._key(k): now for k in items})
+        pipe.zcard(self.index_key)
+        size = pipe.execute()[-1]
+        if size > self.max_entries:
+            self.evict(size - self.max_entries)
+
+    def set(self, key: str, value: Any) -> None:
+        self.set_many({key: value})
+
+    def evict(self, count: int) -> int:
+        """
+        Evict the count least recently used entries
+        Returns:
+            int: number of evicted entries
+        """
+        evicted = [k for k, _ in self.client.zpopmin(self.index_key, count)]
+        if evicted:
+            self.client.delete(*evicted)
+
+        return len(evicted)
+
+    def delete(self, key: str) -> None:
+        pipe = self.client.pipeline(transaction=False)
+        pipe.delete(self._key(key))
+        pipe.zrem(self.index_key, self._key(key))
+        pipe.execute()
@@ -2,6 +2,7 @@
 This module is responsible for loading the environment variables,
 and converting them to the correct type.
 - Prevents the app from staring if the environment variables are not found.
+- Optional environment variables in ENV_DEFAULTS fall back to their default.
 - Ignored if the app is running in the build environment.
 """
 
@@ -27,6 +28,64 @@ ENV_NAMES = [
     "PINECONE_API_KEY",
 ]
 
+# Optional environment variables, and their default values
+ENV_DEFAULTS = {
+    "EMBED_CACHE_MEMORY_SIZE": "10000",  # entries kept per process
+    "EMBED_CACHE_REDIS_SIZE": "500000",  # entries kept in redis
+    "EMBED_CACHE_TTL": "2592000",  # seconds, 30 days
+    "QUERY_CACHE_MEMORY_SIZE": "2000",  # query entries kept per process
+    "QUERY_CACHE_REDIS_SIZE": "100000",  # query entries kept in redis
+    "QUERY_CACHE_TTL": "604800",  # seconds, 7 days
+    "EXTRACT_CACHE_SIZE": "50000",  # /extract responses kept in redis
+    "EXTRACT_CACHE_TTL": "86400",  # seconds, 1 day
+    "SEMANTIC_CACHE_DOCUMENTS": "1000",  # documents with cached answers, per process
+    "SEMANTIC_CACHE_SIZE": "256",  # answers kept per document, and search mode
+    "SEMANTIC_CACHE_TTL": "86400",  # seconds, 1 day
+    "SEMANTIC_CACHE_THRESHOLD": "0.92",  # cosine similarity of a paraphrase
+    "MONGO_MAX_POOL_SIZE": "100",  # connections per process
+    "MONGO_MIN_POOL_SIZE": "0",  # connections kept open per process when idle
+    "S3_MAX_POOL_CONNECTIONS": "20",  # connections of the S3 client, per process
+    "S3_PART_SIZE": "8388608",  # bytes, 8MB, larger uploads are multipart
+    "S3_UPLOAD_CONCURRENCY": "4",  # parts uploaded at once, per file
+    "RATE_LIMIT_LOCAL_SIZE": "10000",  # rejected keys remembered per process
+    "ARTIFACT_DIR": "data/compiled",  # compiled per-document artifacts
+    "VECTOR_BACKEND": "pinecone",  # pinecone, local, or both, see services.oai.rags
+    "DOCUMENT_CLAIM_LEASE": "1800",  # seconds before a stale ingestion is taken over
+    "BUNDLES_PER_TASK": "8",  # bundles pipelined by one embed_bundles task
+    "EMBED_CONCURRENCY": "2",  # bundles being embedded at once, per task
+    "UPSERT_CONCURRENCY": "2",  # bundles being upserted at once, per task
+    "PIPELINE_QUEUE_SIZE": "2",  # embedded bundles waiting to be upserted, per task
+}
+
+INT_ENVS = [
+    "RATE_LIMIT_LOCAL_SIZE",
+    "MONGO_MAX_POOL_SIZE",
+    "MONGO_MIN_POOL_SIZE",
+    "S3_MAX_POOL_CONNECTIONS",
+    "S3_PART_SIZE",
+    "S3_UPLOAD_CONCURRENCY",
+    "EMBED_CACHE_MEMORY_SIZE",
+    "EMBED_CACHE_REDIS_SIZE",
+    "EMBED_CACHE_TTL",
+    "QUERY_CACHE_MEMORY_SIZE",
+    "QUERY_CACHE_REDIS_SIZE",
+    "QUERY_CACHE_TTL",
+    "EXTRACT_CACHE_SIZE",
+    "EXTRACT_CACHE_TTL",
+    "SEMANTIC_CACHE_DOCUMENTS",
+    "SEMANTIC_CACHE_SIZE",
+    "SEMANTIC_CACHE_TTL",
+    "DOCUMENT_CLAIM_LEASE",
+    "BUNDLES_PER_TASK",
+    "EMBED_CONCURRENCY",
+    "UPSERT_CONCURRENCY",
+    "PIPELINE_QUEUE_SIZE",
+]
+
+FLOAT_ENVS = [
+    "SEMANTIC_CACHE_THRESHOLD",
+]
+
 ENVS: dict[str, Any] = {}
 errs: list[str] = []
 
@@ -44,6 +103,10 @@ def convert_env(env: str, value: str) -> Any:
     match env:
         case "DEBUG":
             return value.lower() == "true"
+        case _ if env in INT_ENVS:
+            return int(value)
+        case _ if env in FLOAT_ENVS:
+            return float(value)
         case _:
             return value
 
@@ -54,6 +117,8 @@ if os.environ.get("DEPLOYENV") not in ["build"]:
             ENVS[env] = convert_env(env, os.environ[env])
         except KeyError as e:
             errs.append(str(e).strip("'"))
+    for env, default in ENV_DEFAULTS.items():
+        ENVS[env] = convert_env(env, os.environ.get(env, default))
 
     if errs:
         raise EnvironmentError(f'Envs not found: {", ".join(errs)}')
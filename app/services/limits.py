@@ -1,33 +1,143 @@
 """
 Handles rate limiting
+Limits are counted in redis, shared by every gateway replica. Each call is a single
+atomic lua script, so concurrent calls never exceed a limit:
+- sliding_window: counts of the current and previous fixed windows, the previous
+one weighted by its overlap with the sliding window, no burst at window edges
+- token_bucket: `limit` tokens, refilled continuously over `window` seconds
+Rejected keys are remembered in process, see RateLimiter
 """
 
+import time
+from typing import Literal
+
 from db.clients import rdb
 from fastapi import HTTPException
 from pydantic import validate_call
+from redis import Redis
+from services.caches import LRUCache
+from services.env_man import ENVS
+
+# KEYS[1]: key, ARGV: limit, window in seconds, cost
+# Returns: {1 if limited, milliseconds before the call can succeed, at least}
+SLIDING_WINDOW = """
+local limit, cost = tonumber(ARGV[1]), tonumber(ARGV[3])
+local window = tonumber(ARGV[2]) * 1000
+local t = redis.call("TIME")
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local index = math.floor(now / window)
+local state = redis.call("HMGET", KEYS[1], "index", "curr", "prev")
+local last = tonumber(state[1])
+local curr, prev = tonumber(state[2]) or 0, tonumber(state[3]) or 0
+if last ~= index then
+    if last == index - 1 then prev = curr else prev = 0 end
+    curr = 0
+end
+local elapsed = now - index * window
+if prev * (window - elapsed) / window + curr + cost > limit then
+    if curr + cost > limit then
+        return {1, math.ceil(window - elapsed)}
+    end
+    return {1, math.ceil(window * (1 - (limit - curr - cost) / prev) - elapsed)}
+end
+redis.call("HSET", KEYS[1], "index", index, "curr", curr + cost, "prev", prev)
+redis.call("PEXPIRE", KEYS[1], window * 2)
+return {0, 0}
+"""
+
+TOKEN_BUCKET = """
+local limit, cost = tonumber(ARGV[1]), tonumber(ARGV[3])
+local window = tonumber(ARGV[2]) * 1000
+local t = redis.call("TIME")
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local rate = limit / window
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens, ts = tonumber(state[1]) or limit, tonumber(state[2]) or now
+tokens = math.min(limit, tokens + math.max(0, now - ts) * rate)
+if tokens < cost then
+    return {1, math.ceil((cost - tokens) / rate)}
+end
+redis.call("HSET", KEYS[1], "tokens", tokens - cost, "ts", now)
+local refill = math.ceil((limit - tokens + cost) / rate)
+redis.call("PEXPIRE", KEYS[1], math.max(1, refill))
+return {0, 0}
+"""
+
+Algorithm = Literal["sliding_window", "token_bucket"]
+
+
+class RateLimiter:
+    """
+    Rate limiter running one lua script per call, a single round trip to redis.
+    A rejection's retry delay is remembered in process, calls of the same cost,
+    or more, are rejected without redis until it passes. Other replicas only
+    consume more, so the pre-check never rejects a call redis would allow.
+    Args:
+        name (str): prefix of the redis keys
+        script (str): lua script, see SLIDING_WINDOW, and TOKEN_BUCKET
+        local_size (int): rejected keys remembered in process, 0 disables it
+        client (Redis): redis client
+    """
+
+    def __init__(self, name: str, script: str, local_size: int, client: Redis = rdb):
+        self.name = name
+        self._script = client.register_script(script)
+        self._local = LRUCache(local_size) if local_size else None
+
+    def hit(self, key: str, limit: int, window: int, cost: int = 1) -> bool:
+        """
+        Consume `cost` units of a key's limit
+        Args:
+            key (str): key to rate limit
+            limit (int): limit allowed within the window
+            window (int): window in seconds
+            cost (int): units consumed by the call
+        Returns:
+            bool: True if rate limited, nothing is consumed when limited
+        """
+        if cost > limit:
+            return True
+        local_key = (key, limit, window)
+        if self._local is not None:
+            rejected = self._local.get(local_key)
+            if rejected and cost >= rejected[1] and time.monotonic() < rejected[0]:
+                return True
+
+        limited, retry_after = self._script(
+            keys=[f"ratelimit:{self.name}:{key}"], args=[limit, window, cost]
+        )
+        if limited and self._local is not None:
+            self._local.set(local_key, (time.monotonic() + retry_after / 1000, cost))
+
+        return bool(limited)
+
+
+LIMITERS: dict[str, RateLimiter] = {
+    "sliding_window": RateLimiter("sw", SLIDING_WINDOW, ENVS["RATE_LIMIT_LOCAL_SIZE"]),
+    "token_bucket": RateLimiter("tb", TOKEN_BUCKET, ENVS["RATE_LIMIT_LOCAL_SIZE"]),
+}
 
 
 @validate_call
-def is_rate_limited(key: str, limit: int, window: int) -> bool:
+def is_rate_limited(
+    key: str,
+    limit: int,
+    window: int,
+    cost: int = 1,
+    algorithm: Algorithm = "sliding_window",
+) -> bool:
     """
-    Fixed window rate limiting
+    Rate limiting, see RateLimiter
     Args:
         key (str): key to rate limit
         limit (int): limit allowed within the window
         window (int): window in seconds
+        cost (int): units consumed by the call, ex. the number of queries of a batch
+        algorithm (Algorithm): sliding_window, or token_bucket to refill continuously
     Returns:
-        bool: True if rate limited, False otherwise
+        bool: True if rate limited, False otherwise, nothing is consumed when limited
     """
-    cache_key = f"ratelimit:{key}"
-    cache_value = rdb.get(name=cache_key)
-    if cache_value is None:
-        rdb.set(name=cache_key, value=1, ex=window)
-        return False
-    if int(cache_value) >= limit:
-        return True
-    rdb.incr(cache_key)
-
-    return False
+    return LIMITERS[algorithm].hit(key, limit, window, cost)
 
 
 @validate_call
@@ -0,0 +1,485 @@
+"""
+Content-addressed embedding cache, sits in front of OpenAI's embeddings endpoint.
+Entries are keyed by hash(model, dimensions, normalized text), so the same text
+is embedded once, regardless of which user, document or retry asked for it.
+Document paragraphs, and /extract queries are cached apart, so a burst of ingestion
+does not evict the hot queries:
+- embedding_cache: paragraphs, see tasks.ocrs
+- query_embedding_cache: queries, see services.oai.rags.get_query_embedding
+Tiers:
+- memory: per-process LRUCache
+- redis: RedisLRUCache shared by gateway, and workers
+Vectors are stored in redis as packed float32 bytes.
+Stats are counted in redis, and can be read with GET /health/caches
+Whole /extract responses are cached by ExtractCache, see routers.ocrs.post_extract
+and answers to paraphrased queries by SemanticCache, see rags.get_ai_response
+"""
+
+import asyncio
+import logging
+import time
+import unicodedata
+from array import array
+from hashlib import sha256
+from typing import Awaitable, Callable
+
+import numpy as np
+from db.clients import rdb, rdb_bytes
+from redis.exceptions import RedisError
+from services.caches import LRUCache, RedisLRUCache
+from services.env_man import ENVS
+
+STATS_KEY = "embedcache:stats"
+EXTRACT_STATS_KEY = "extractcache:stats"
+SEMANTIC_STATS_KEY = "semanticcache:stats"
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes text so that visually identical texts share a cache entry.
+    NFKC folds full-width, and half-width forms, whitespaces are collapsed.
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def embedding_key(text: str, model: str, dimensions: int | None = None) -> str:
+    """
+    Returns the cache key of a text's embedding
+    """
+    raw = f"{model}\x00{dimensions or ''}\x00{normalize_text(text)}"
+    return sha256(raw.encode()).hexdigest()
+
+
+def pack_vector(vector: list[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(data: bytes) -> list[float]:
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """
+    Two tier embedding cache
+    Args:
+        namespace (str): redis key prefix
+        memory_size (int): entries kept per process
+        redis_size (int): entries kept in redis
+        ttl (int | None): seconds before an entry expires
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        memory_size: int,
+        redis_size: int,
+        ttl: int | None = None,
+    ):
+        self.namespace = namespace
+        self.memory = LRUCache(memory_size, ttl)
+        self.redis = RedisLRUCache(rdb_bytes, namespace, redis_size, ttl)
+        self.stats_key = f"{STATS_KEY}:{namespace}"
+        # stats writes scheduled by aget_or_embed, referenced until done
+        self._pending: set[asyncio.Task] = set()
+
+    def get_or_embed(
+        self,
+        texts: list[str],
+        model: str,
+        dimensions: int | None,
+        embed: Callable[[list[str]], list[list[float]]],
+    ) -> list[list[float]]:
+        """
+        Get embeddings of texts, only the misses are embedded, in one call of embed.
+        The redis tier is skipped if redis is unavailable.
+        Args:
+            texts (list[str]): texts to embed
+            model (str): embedding model
+            dimensions (int | None): embedding dimensions
+            embed (Callable): embeds a list of texts, returns vectors in the same order
+        Returns:
+            list[list[float]]: vectors in the order of texts
+        """
+        keys = [embedding_key(t, model, dimensions) for t in texts]
+        vectors, memory_hits = self._get_memory(keys)
+        redis_hits = self._get_redis(keys, vectors)
+        misses = self._misses(keys, vectors)
+        embedded: list[list[float]] = []
+        miss_seconds = 0.0
+        if misses:
+            start = time.perf_counter()
+            embedded = embed([texts[idx[0]] for idx in misses.values()])
+            miss_seconds = time.perf_counter() - start
+        self._fill(misses, vectors, embedded)
+        self._persist(
+            texts,
+            keys,
+            misses,
+            embedded,
+            memory_hits,
+            redis_hits,
+            miss_seconds,
+        )
+
+        return vectors
+
+    async def aget_or_embed(
+        self,
+        texts: list[str],
+        model: str,
+        dimensions: int | None,
+        embed: Callable[[list[str]], Awaitable[list[list[float]]]],
+    ) -> list[list[float]]:
+        """
+        Async get_or_embed, embed is awaited on the event loop.
+        Redis reads are short, and run in a thread, skipped when memory has every key.
+        Misses, and stats are written to redis in the background, after returning.
+        """
+        keys = [embedding_key(t, model, dimensions) for t in texts]
+        vectors, memory_hits = self._get_memory(keys)
+        redis_hits = 0
+        if memory_hits < len(keys):
+            redis_hits = await asyncio.to_thread(self._get_redis, keys, vectors)
+        misses = self._misses(keys, vectors)
+        embedded: list[list[float]] = []
+        miss_seconds = 0.0
+        if misses:
+            start = time.perf_counter()
+            embedded = await embed([texts[idx[0]] for idx in misses.values()])
+            miss_seconds = time.perf_counter() - start
+        self._fill(misses, vectors, embedded)
+        task = asyncio.create_task(
+            asyncio.to_thread(
+                self._persist,
+                texts,
+                keys,
+                misses,
+                embedded,
+                memory_hits,
+                redis_hits,
+                miss_seconds,
+            )
+        )
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+        return vectors
+
+    def _get_memory(self, keys: list[str]) -> tuple[list[list[float] | None], int]:
+        vectors = [self.memory.get(k) for k in keys]
+        return vectors, sum(v is not None for v in vectors)
+
+    def _get_redis(self, keys: list[str], vectors: list[list[float] | None]) -> int:
+        """
+        Fills vectors missing from memory from the redis tier
+        Returns:
+            int: number of redis hits
+        """
+        pending = [i for i, v in enumerate(vectors) if v is None]
+        if not pending:
+            return 0
+        try:
+            packed = self.redis.get_many([keys[i] for i in pending])
+        except RedisError as e:
+            logger.error(f"{self.namespace} redis tier unavailable: {e}")
+            return 0
+        redis_hits = 0
+        for i, data in zip(pending, packed):
+            if data:
+                vectors[i] = unpack_vector(data)
+                self.memory.set(keys[i], vectors[i])
+                redis_hits += 1
+
+        return redis_hits
+
+    @staticmethod
+    def _misses(
+        keys: list[str], vectors: list[list[float] | None]
+    ) -> dict[str, list[int]]:
+        # identical texts in one request are only embedded once
+        misses: dict[str, list[int]] = {}
+        for i, v in enumerate(vectors):
+            if v is None:
+                misses.setdefault(keys[i], []).append(i)
+
+        return misses
+
+    def _fill(
+        self,
+        misses: dict[str, list[int]],
+        vectors: list[list[float] | None],
+        embedded: list[list[float]],
+    ) -> None:
+        for (key, idx), vector in zip(misses.items(), embedded):
+            self.memory.set(key, vector)
+            for i in idx:
+                vectors[i] = vector
+
+    def _persist(
+        self,
+        texts: list[str],
+        keys: list[str],
+        misses: dict[str, list[int]],
+        embedded: list[list[float]],
+        memory_hits: int,
+        redis_hits: int,
+        miss_seconds: float,
+    ) -> None:
+        """
+        Stores embedded misses in the redis tier, and counts stats
+        """
+        if misses:
+            try:
+                self.redis.set_many(
+                    {key: pack_vector(v) for key, v in zip(misses, embedded)}
+                )
+            except RedisError as e:
+                logger.error(f"{self.namespace} redis tier unavailable: {e}")
+        try:
+            self._count(
+                memory_hits,
+                redis_hits,
+                sum(len(t) for t, k in zip(texts, keys) if k not in misses),
+                len(misses),
+                miss_seconds,
+            )
+        except RedisError as e:
+            logger.error(f"{self.namespace} stats not counted: {e}")
+
+    def _count(
+        self,
+        memory_hits: int,
+        redis_hits: int,
+        hit_chars: int,
+        misses: int,
+        miss_seconds: float,
+    ) -> None:
+        """
+        Counts hits, misses, characters not sent to OpenAI, and time spent embedding
+        misses. Hits are not tokenized again, a hit must stay cheap.
+        """
+        pipe = rdb.pipeline(transaction=False)
+        pipe.hincrby(self.stats_key, "hits_memory", memory_hits)
+        pipe.hincrby(self.stats_key, "hits_redis", redis_hits)
+        pipe.hincrby(self.stats_key, "misses", misses)
+        pipe.hincrby(self.stats_key, "hit_chars", hit_chars)
+        pipe.hincrbyfloat(self.stats_key, "miss_seconds", miss_seconds)
+        pipe.execute()
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns counters shared by every process
+        - hits_memory, hits_redis: texts served from each tier
+        - misses: texts sent to OpenAI
+        - hit_chars: characters not sent to OpenAI, ie. saved spend
+        - miss_seconds: time spent embedding misses,
+        miss_seconds / misses estimates the latency saved per hit
+        """
+        raw = rdb.hgetall(self.stats_key)
+        stats = {k: float(v) for k, v in raw.items()}
+        stats["memory_size"] = len(self.memory)
+
+        return stats
+
+
+class ExtractCache:
+    """
+    Redis cache of /extract responses, bounded to max_entries, see RedisLRUCache
+    Entries are keyed by user id, md5, the upload's ocr_rev, the normalized query,
+    and the search mode.
+    ocr_rev is incremented on every ocr status change, see db.uploads.set_ocr_status,
+    so responses cached before a re-OCR are never read again, and age out.
+    The cache is skipped if redis is unavailable.
+    Args:
+        namespace (str): redis key prefix
+        max_entries (int): entries kept in redis
+        ttl (int | None): seconds before an entry expires
+    """
+
+    def __init__(self, namespace: str, max_entries: int, ttl: int | None = None):
+        self.namespace = namespace
+        self.redis = RedisLRUCache(rdb, namespace, max_entries, ttl)
+
+    @staticmethod
+    def key(
+        user_id: str,
+        md5: str,
+        ocr_rev: int,
+        query: str,
+        mode: str = "vector",
+    ) -> str:
+        raw = f"{user_id}\x00{md5}\x00{ocr_rev}\x00{mode}\x00{normalize_text(query)}"
+        return sha256(raw.encode()).hexdigest()
+
+    def get(
+        self,
+        user_id: str,
+        md5: str,
+        ocr_rev: int,
+        query: str,
+        mode: str = "vector",
+    ) -> str | None:
+        """
+        Returns:
+            str | None: cached response JSON, None on a miss
+        """
+        try:
+            value = self.redis.get(self.key(user_id, md5, ocr_rev, query, mode))
+            rdb.hincrby(EXTRACT_STATS_KEY, "hits" if value else "misses", 1)
+        except RedisError as e:
+            logger.error(f"{self.namespace} unavailable: {e}")
+            return None
+
+        return value
+
+    def set(
+        self,
+        user_id: str,
+        md5: str,
+        ocr_rev: int,
+        query: str,
+        value: str,
+        mode: str = "vector",
+    ) -> None:
+        """
+        Args:
+            value (str): response JSON
+        """
+        try:
+            self.redis.set(self.key(user_id, md5, ocr_rev, query, mode), value)
+        except RedisError as e:
+            logger.error(f"{self.namespace} unavailable: {e}")
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns hits, and misses, shared by every process
+        """
+        return {k: float(v) for k, v in rdb.hgetall(EXTRACT_STATS_KEY).items()}
+
+
+class SemanticCache:
+    """
+    In-process cache of /extract answers, looked up by query embedding similarity,
+    so paraphrases of an answered query, ex. "適用区域" and "適用区域とは",
+    are answered without querying Pinecone, or the chatbot.
+    - answers are grouped per document, its rev, and search mode, at most
+    max_entries each, the least recently hit are evicted first, as are the least
+    recently used documents
+    - rev is incremented on every ocr status change of the document, see
+    db.documents.set_document_status, so answers cached before a re-ingestion
+    are never read again, and age out
+    - a query hits the answered query with the highest cosine similarity,
+    if it is at least threshold
+    - hits, and misses are counted in redis, see stats
+    Args:
+        max_documents (int): documents kept
+        max_entries (int): answers kept per document, and search mode
+        threshold (float): minimum cosine similarity of a hit
+        ttl (int | None): seconds before an answer expires
+    """
+
+    def __init__(
+        self,
+        max_documents: int,
+        max_entries: int,
+        threshold: float,
+        ttl: int | None = None,
+    ):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.documents = LRUCache(max_documents)
+
+    @staticmethod
+    def _normalize(vector: list[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        return v / max(float(np.linalg.norm(v)), 1e-12)
+
+    def get(self, md5: str, rev: int, mode: str, vector: list[float]) -> str | None:
+        """
+        Args:
+            md5 (str): md5 of the document
+            rev (int): rev of the document
+            mode (str): search mode
+            vector (list[float]): query embedding
+        Returns:
+            str | None: answer JSON of the most similar query, None on a miss
+        """
+        value = None
+        entries: LRUCache | None = self.documents.get((md5, rev, mode))
+        items = entries.items() if entries is not None else []
+        if items:
+            scores = np.stack([v for _, (v, _) in items]) @ self._normalize(vector)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                key, (_, value) = items[best]
+                entries.get(key)
+        try:
+            rdb.hincrby(SEMANTIC_STATS_KEY, "hits" if value else "misses", 1)
+        except RedisError as e:
+            logger.error(f"semantic cache stats not counted: {e}")
+
+        return value
+
+    def set(
+        self,
+        md5: str,
+        rev: int,
+        mode: str,
+        query: str,
+        vector: list[float],
+        value: str,
+    ) -> None:
+        """
+        Args:
+            query (str): query, answers to the same normalized query are replaced
+            value (str): answer JSON
+        """
+        entries = self.documents.get((md5, rev, mode))
+        if entries is None:
+            entries = LRUCache(self.max_entries, self.ttl)
+            self.documents.set((md5, rev, mode), entries)
+        entries.set(normalize_text(query), (self._normalize(vector), value))
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns hits, misses, and hit_rate, shared by every process
+        """
+        stats = {k: float(v) for k, v in rdb.hgetall(SEMANTIC_STATS_KEY).items()}
+        lookups = stats.get("hits", 0.0) + stats.get("misses", 0.0)
+        stats["hit_rate"] = stats.get("hits", 0.0) / lookups if lookups else 0.0
+        stats["documents"] = len(self.documents)
+
+        return stats
+
+
+embedding_cache = EmbeddingCache(
+    "embedcache",
+    memory_size=ENVS["EMBED_CACHE_MEMORY_SIZE"],
+    redis_size=ENVS["EMBED_CACHE_REDIS_SIZE"],
+    ttl=ENVS["EMBED_CACHE_TTL"],
+)
+
+query_embedding_cache = EmbeddingCache(
+    "querycache",
+    memory_size=ENVS["QUERY_CACHE_MEMORY_SIZE"],
+    redis_size=ENVS["QUERY_CACHE_REDIS_SIZE"],
+    ttl=ENVS["QUERY_CACHE_TTL"],
+)
+
+extract_cache = ExtractCache(
+    "extractcache",
+    max_entries=ENVS["EXTRACT_CACHE_SIZE"],
+    ttl=ENVS["EXTRACT_CACHE_TTL"],
+)
+
+semantic_cache = SemanticCache(
+    max_documents=ENVS["SEMANTIC_CACHE_DOCUMENTS"],
+    max_entries=ENVS["SEMANTIC_CACHE_SIZE"],
+    threshold=ENVS["SEMANTIC_CACHE_THRESHOLD"],
+    ttl=ENVS["SEMANTIC_CACHE_TTL"],
+)
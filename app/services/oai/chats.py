@@ -2,7 +2,19 @@
 OpenAI's chat completions related services
 """
 
-from openai import OpenAI
+from functools import lru_cache
+from typing import AsyncIterator
+
+from openai import AsyncOpenAI
+
+
+@lru_cache(maxsize=1)
+def get_async_openai_client() -> AsyncOpenAI:
+    """
+    Get the process' async OpenAI client, its connections are shared by every request
+    """
+    return AsyncOpenAI()
+
 
 
 class ChatBot:
@@ -14,7 +26,8 @@ class ChatBot:
     - instantiate the class
     - set a system message if needed using .set_system_message()
     - add user messages using .add_message() if needed
-    - or, just chat using .chat()
+    - or, just chat using await .chat()
+    - or, stream the response using async for token in .chat_stream()
     TODO: Not in current scope. Persists the chat history in a database, across API calls.
     Args:
         model (str): model name
@@ -22,7 +35,7 @@ class ChatBot:
     """
 
     def __init__(self, model="gpt-3.5-turbo", max_hist=15):
-        self.client = OpenAI()
+        self.client = get_async_openai_client()
         self.model = model
         self.messages = []
         self.max_hist = max_hist
@@ -71,7 +84,7 @@ class ChatBot:
         self.messages.append({"role": role, "content": content})
         self._handle_max_hist()
 
-    def chat(self, content: str) -> str:
+    async def chat(self, content: str) -> str:
         """
         Send a message to the chatbot and get a response.
         Args:
@@ -80,7 +93,7 @@ class ChatBot:
             str: response from the chat completion
         """
         self.messages.append({"role": "user", "content": content})
-        r = self.client.chat.completions.create(
+        r = await self.client.chat.completions.create(
             model=self.model,
             messages=self.messages,
         )
@@ -89,3 +102,27 @@ class ChatBot:
         self._handle_max_hist()
 
         return message.content
+
+    async def chat_stream(self, content: str) -> AsyncIterator[str]:
+        """
+        Send a message to the chatbot, and stream the response as it is generated.
+        The full response is added to the history once the stream ends.
+        Args:
+            content (str): content of the message
+        Yields:
+            str: parts of the response from the chat completion
+        """
+        self.messages.append({"role": "user", "content": content})
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=self.messages,
+            stream=True,
+        )
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            parts.append(chunk.choices[0].delta.content)
+            yield parts[-1]
+        self.messages.append({"role": "assistant", "content": "".join(parts)})
+        self._handle_max_hist()
@@ -0,0 +1,183 @@
+"""
+Local vector index, one per document (md5), next to its paragraph store.
+/extract queries are filtered to a single document, a candidate set small enough
+to be searched in-process, without a network round trip to Pinecone.
+- workers write each upserted bundle as a fragment, see write_fragment
+- finalize_ocr compiles the fragments into a float32 matrix, row n being the
+vector f"{md5}:{n}", see compile_vector_index
+- readers memory-map the matrix, and search it by brute force with NumPy,
+or with an HNSW index for large documents, if hnswlib is installed
+Rows are L2 normalized, so the dot product is the cosine similarity, as Pinecone's.
+The backend is selected by VECTOR_BACKEND, see services.oai.rags
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from services.env_man import ENVS
+
+try:
+    import hnswlib
+except ImportError:  # optional, brute force is used without it
+    hnswlib = None
+
+# documents with fewer vectors are always searched by brute force
+HNSW_MIN_VECTORS = 20000
+
+# indexes opened by open_vector_index, by md5
+_open_indexes: dict[str, "LocalVectorIndex"] = {}
+
+
+def matrix_path(md5_hash: str) -> str:
+    return os.path.join(ENVS["ARTIFACT_DIR"], f"{md5_hash}.vec.npy")
+
+
+def hnsw_path(md5_hash: str) -> str:
+    return os.path.join(ENVS["ARTIFACT_DIR"], f"{md5_hash}.hnsw")
+
+
+def fragments_dir(md5_hash: str) -> str:
+    return os.path.join(ENVS["ARTIFACT_DIR"], f"{md5_hash}.vec.d")
+
+
+def _atomic_path(path: str) -> str:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    return tmp_path
+
+
+def write_fragment(
+    md5_hash: str,
+    positions: list[int],
+    vectors: list[list[float]],
+) -> None:
+    """
+    Writes the vectors of a bundle, a retried bundle overwrites its own fragment
+    Args:
+        md5_hash (str): md5 hash of the document
+        positions (list[int]): position of each vector in the document
+        vectors (list[list[float]]): vectors
+    """
+    directory = fragments_dir(md5_hash)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{min(positions)}.npz")
+    tmp_path = _atomic_path(path)
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            positions=np.asarray(positions, dtype=np.int64),
+            vectors=np.asarray(vectors, dtype=np.float32),
+        )
+    os.replace(tmp_path, path)
+
+
+def compile_vector_index(md5_hash: str, count: int) -> int:
+    """
+    Compiles a document's fragments into its matrix, and its HNSW index
+    if the document has at least HNSW_MIN_VECTORS vectors, and hnswlib is installed.
+    Rows without a vector are left at 0, and score 0 to every query.
+    Args:
+        md5_hash (str): md5 hash of the document
+        count (int): number of vectors of the document, see ParagraphStore
+    Returns:
+        int: number of rows written
+    """
+    directory = fragments_dir(md5_hash)
+    if not os.path.isdir(directory):
+        return 0
+    fragments = []
+    for name in os.listdir(directory):
+        with np.load(os.path.join(directory, name)) as fragment:
+            fragments.append((fragment["positions"], fragment["vectors"]))
+    if not fragments:
+        return 0
+    dim = fragments[0][1].shape[1]
+
+    path = matrix_path(md5_hash)
+    tmp_path = _atomic_path(path)
+    matrix = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.float32, shape=(count, dim)
+    )
+    written = 0
+    for positions, vectors in fragments:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        matrix[positions] = vectors / np.maximum(norms, 1e-12)
+        written += len(positions)
+    matrix.flush()
+    if hnswlib is not None and count >= HNSW_MIN_VECTORS:
+        hnsw = hnswlib.Index(space="ip", dim=dim)
+        hnsw.init_index(max_elements=count, ef_construction=200, M=16)
+        hnsw.add_items(matrix, np.arange(count))
+        hnsw_tmp_path = _atomic_path(hnsw_path(md5_hash))
+        hnsw.save_index(hnsw_tmp_path)
+        os.replace(hnsw_tmp_path, hnsw_path(md5_hash))
+    del matrix
+    os.replace(tmp_path, path)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    return written
+
+
+class LocalVectorIndex:
+    """
+    Read-only, memory-mapped vector index of a document, see compile_vector_index
+    Args:
+        md5_hash (str): md5 hash of the document
+    """
+
+    def __init__(self, md5_hash: str):
+        path = matrix_path(md5_hash)
+        self.inode = os.stat(path).st_ino
+        self.matrix = np.load(path, mmap_mode="r")
+        self.hnsw = None
+        if hnswlib is not None and os.path.exists(hnsw_path(md5_hash)):
+            self.hnsw = hnswlib.Index(space="ip", dim=self.matrix.shape[1])
+            self.hnsw.load_index(hnsw_path(md5_hash))
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def query(self, vector: list[float], top_k: int) -> list[tuple[int, float]]:
+        """
+        Finds the rows most similar to vector
+        Args:
+            vector (list[float]): query vector
+            top_k (int): number of results to return
+        Returns:
+            list[tuple[int, float]]: row, and cosine similarity, best first
+        """
+        q = np.asarray(vector, dtype=np.float32)
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        top_k = min(top_k, len(self))
+        if top_k == 0:
+            return []
+        if self.hnsw is not None:
+            self.hnsw.set_ef(max(64, top_k * 2))
+            labels, distances = self.hnsw.knn_query(q, k=top_k)
+            return [(int(n), 1 - float(d)) for n, d in zip(labels[0], distances[0])]
+        scores = self.matrix @ q
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(int(n), float(scores[n])) for n in top]
+
+
+def open_vector_index(md5_hash: str) -> LocalVectorIndex | None:
+    """
+    Opens a document's vector index, kept open per process.
+    The index is reopened if it was recompiled since it was opened.
+    Returns:
+        LocalVectorIndex | None: index, None if the document is not compiled here
+    """
+    try:
+        inode = os.stat(matrix_path(md5_hash)).st_ino
+    except FileNotFoundError:
+        return None
+    index = _open_indexes.get(md5_hash)
+    if index is None or index.inode != inode:
+        index = LocalVectorIndex(md5_hash)
+        _open_indexes[md5_hash] = index
+
+    return index
@@ -5,18 +5,49 @@ SEE:
 - https://platform.openai.com/docs/guides/embeddings/use-cases
 """
 
+import asyncio
 import json
-from typing import Literal
+import logging
+from functools import lru_cache
+from typing import AsyncIterator, Literal
 
+import httpx
 import nanoid
+from db.documents import get_document_rev
+from db.paragraphs import get_paragraphs
+from fastapi import HTTPException
 from openai import OpenAI
 from openai.types.create_embedding_response import Embedding
 from pinecone import Pinecone, ServerlessSpec
 from services.env_man import ENVS
-from services.oai.chats import ChatBot
+from services.oai.caches import (
+    EmbeddingCache,
+    embedding_cache,
+    query_embedding_cache,
+    semantic_cache,
+)
+from services.oai.chats import ChatBot, get_async_openai_client
+from services.oai.indexes import open_vector_index, write_fragment
+from services.oai.renders import render_results
+from services.oai.writers import UpsertWriter
+from services.ocrs.lexicons import ensure_lexical_index
+from services.ocrs.parsers import Paragraph
+from services.ocrs.stores import ensure_paragraph_store, open_paragraph_store
+
+logger = logging.getLogger(__name__)
 
 openai_client = OpenAI()
 pinecone_client = Pinecone(api_key=ENVS["PINECONE_API_KEY"])
+# data plane urls of indexes, see get_index_host
+_index_hosts: dict[str, str] = {}
+
+# matches returned to the chatbot
+TOP_K = 3
+# reciprocal rank fusion constant, see fuse_matches
+RRF_K = 60
+
+SearchMode = Literal["vector", "lexical", "hybrid"]
+AnswerMode = Literal["chatbot", "template"]
 
 
 def create_index(
@@ -43,9 +74,83 @@ def create_index(
     return pinecone_client.create_index(name, dimension, spec, metric)
 
 
-def get_embeddings(texts=list[str], model="text-embedding-3-small"):
+@lru_cache(maxsize=None)
+def get_index(name: str):
+    """
+    Get a Pinecone index handle, reused across calls, its connections are pooled
+    Args:
+        name (str): index name
+    Returns:
+        pinecone.Index: index handle
+    """
+    return pinecone_client.Index(name)
+
+
+def get_embeddings(
+    texts: list[str],
+    model: str = "text-embedding-3-small",
+    dimensions: int | None = None,
+    cache: EmbeddingCache = embedding_cache,
+) -> list[Embedding]:
+    """
+    Embeds texts using OpenAI, through the embedding cache.
+    Only texts not found in the cache are sent to OpenAI, in one request.
+    Args:
+        texts (list[str]): texts to embed
+        model (str): embedding model, defaults to "text-embedding-3-small"
+        dimensions (int | None): embedding dimensions, defaults to the model's
+        cache (EmbeddingCache): cache, defaults to the paragraphs' embedding cache
+    Returns:
+        list[Embedding]: embeddings in the order of texts
+    """
     texts = [t.replace("\n", " ") for t in texts]
-    return openai_client.embeddings.create(input=texts, model=model).data
+
+    def _embed(misses: list[str]) -> list[list[float]]:
+        kwargs = {"dimensions": dimensions} if dimensions else {}
+        data = openai_client.embeddings.create(input=misses, model=model, **kwargs).data
+        return [e.embedding for e in sorted(data, key=lambda e: e.index)]
+
+    vectors = cache.get_or_embed(texts, model, dimensions, _embed)
+
+    return [
+        Embedding(embedding=v, index=i, object="embedding")
+        for i, v in enumerate(vectors)
+    ]
+
+
+async def get_query_embeddings(
+    queries: list[str],
+    model: str = "text-embedding-3-small",
+) -> list[list[float]]:
+    """
+    Embeds queries with the async OpenAI client, through the query embedding cache.
+    Repeated queries, after normalization, are served from memory or redis,
+    the others are embedded in a single request to OpenAI.
+    Args:
+        queries (list[str]): queries
+        model (str): embedding model, defaults to "text-embedding-3-small"
+    Returns:
+        list[list[float]]: query vectors, in the order of queries
+    """
+
+    async def _embed(misses: list[str]) -> list[list[float]]:
+        client = get_async_openai_client()
+        data = (await client.embeddings.create(input=misses, model=model)).data
+        return [e.embedding for e in sorted(data, key=lambda e: e.index)]
+
+    return await query_embedding_cache.aget_or_embed(
+        [q.replace("\n", " ") for q in queries], model, None, _embed
+    )
+
+
+async def get_query_embedding(
+    query: str,
+    model: str = "text-embedding-3-small",
+) -> list[float]:
+    """
+    Embeds a query, see get_query_embeddings
+    """
+    return (await get_query_embeddings([query], model))[0]
 
 
 def insert_embeddings(
@@ -53,34 +158,74 @@ def insert_embeddings(
     metadata: list[dict[str, str]],
     index: str,
     namespace: str = "default",
-) -> dict[Literal["upserted_count"], int]:
+    ids: list[str] | None = None,
+) -> dict[Literal["upserted_count", "batch_count"], int]:
     """
     Inserts embeddings into the Pinecone index
+    Vectors are upserted in concurrent batches under Pinecone's request limits,
+    see services.oai.writers.UpsertWriter
+    Unless VECTOR_BACKEND is "pinecone", vectors with document ids, f"{md5}:{n}",
+    are also written to the document's local index, see services.oai.indexes,
+    and only there if VECTOR_BACKEND is "local"
     Args:
         embeddings (list[Embedding]): embeddings to insert
         metadata (list[dict[str, str]]): metadata to insert
         index (str): index name
         namespace (str): namespace, defaults to "default"
+        ids (list[str] | None): vector ids, random ids if None
     Returns:
-        upsertResponse: ex. {"upserted_count": 2} if successful
+        upsertResponse: ex. {"upserted_count": 2, "batch_count": 1} if successful
     """
-    index = pinecone_client.Index(index)
     vecters = []
     for i, e in enumerate(embeddings):
         payload = {
-            "id": nanoid.generate(),
+            "id": ids[i] if ids else nanoid.generate(),
             "values": e["embedding"],
             "metadata": metadata[i],
         }
         vecters.append(payload)
-    ret = index.upsert(
-        vectors=vecters,
-        namespace=namespace,
+    backend = ENVS["VECTOR_BACKEND"]
+    if backend != "pinecone" and ids:
+        md5_hash = ids[0].rpartition(":")[0]
+        positions = [int(i.rpartition(":")[2]) for i in ids]
+        write_fragment(md5_hash, positions, [v["values"] for v in vecters])
+        if backend == "local":
+            return {"upserted_count": len(vecters), "batch_count": 0}
+    writer = UpsertWriter(get_index(index), namespace=namespace)
+
+    return writer.upsert(vecters)
+
+
+@lru_cache(maxsize=1)
+def get_pinecone_http_client() -> httpx.AsyncClient:
+    """
+    Get the process' async http client to Pinecone's data plane,
+    its connections are shared by every request
+    """
+    return httpx.AsyncClient(
+        headers={"Api-Key": ENVS["PINECONE_API_KEY"]},
+        timeout=httpx.Timeout(10),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
     )
-    return ret.to_dict()
 
 
-def query_embeddings(
+async def get_index_host(name: str) -> str:
+    """
+    Get the data plane url of an index, looked up once per process
+    Args:
+        name (str): index name
+    Returns:
+        str: ex. "https://default-abc123.svc.aped-4627-b74a.pinecone.io"
+    """
+    if name not in _index_hosts:
+        description = await asyncio.to_thread(pinecone_client.describe_index, name)
+        host = description.host
+        _index_hosts[name] = host if "://" in host else f"https://{host}"
+
+    return _index_hosts[name]
+
+
+async def query_embeddings(
     index: str,
     vector: list[float],
     top_k: int = 1,
@@ -90,7 +235,9 @@ def query_embeddings(
     include_metadata: bool = True,
 ) -> dict:
     """
-    Queries the Pinecone index
+    Queries the Pinecone index, with the async http client, see get_pinecone_http_client
+    Unless VECTOR_BACKEND is "pinecone", queries filtered to one document,
+    {"md5_hash": {"$eq": md5}}, are served by its local index if it is on this host
     Args:
         index (str): index name
         vector (list[float]): vector to query
@@ -119,33 +266,115 @@ def query_embeddings(
         "usage": {"read_units": 6},
     }
     """
+    md5_hash = d_filter.get("md5_hash", {}).get("$eq")
+    if ENVS["VECTOR_BACKEND"] != "pinecone" and md5_hash is not None:
+        local_resp = await asyncio.to_thread(
+            query_local_embeddings, md5_hash, vector, top_k, namespace
+        )
+        if local_resp is not None:
+            return local_resp
 
-    index = pinecone_client.Index(index)
-    ret = index.query(
-        namespace=namespace,
-        vector=vector,
-        top_k=top_k,
-        include_values=include_values,
-        include_metadata=include_metadata,
-        filter=d_filter,
+    r = await get_pinecone_http_client().post(
+        f"{await get_index_host(index)}/query",
+        json={
+            "namespace": namespace,
+            "vector": vector,
+            "topK": top_k,
+            "includeValues": include_values,
+            "includeMetadata": include_metadata,
+            "filter": d_filter,
+        },
     )
-    return ret
+    r.raise_for_status()
 
+    return r.json()
 
-def get_ai_response(
-    query: str,
-    user_id: str,
+
+def query_local_embeddings(
     md5_hash: str,
-):
+    vector: list[float],
+    top_k: int = 1,
+    namespace: str = "default",
+) -> dict | None:
     """
-    Get natural language response from AI.
-    If query is not found, AI will respond accordingly.
-    Note:
-        the PROMPT should be further refined, and optimized for reduced token count, and guardrails.
-    - query is embeded using OpenAI's text-embedding-3-small model
-    - then, the embeddings are queried in Pinecone
+    Queries a document's local index, see services.oai.indexes
+    Metadata is rebuilt from the document's paragraph store.
+    Returns:
+        dict | None: response in the shape of query_embeddings',
+        None if the document's index, or paragraph store, is not on this host
+    """
+    local_index = open_vector_index(md5_hash)
+    store = open_paragraph_store(md5_hash)
+    if local_index is None or store is None:
+        return None
+    matches = []
+    for n, score in local_index.query(vector, top_k):
+        metadata = {
+            "md5_hash": md5_hash,
+            "meta": store.paragraph(n).model_dump_json(),
+            "model": "text-embedding-3-small",
+        }
+        matches.append(
+            {
+                "id": f"{md5_hash}:{n}",
+                "score": score,
+                "values": [],
+                "metadata": metadata,
+            }
+        )
+
+    return {"matches": matches, "namespace": namespace, "usage": {"read_units": 0}}
+
+
+def query_lexical(md5_hash: str, query: str, top_k: int = TOP_K) -> list[dict]:
     """
-    PROMPT = """You're a text search engine assistant.
+    Queries a document's lexical index, see services.ocrs.lexicons
+    The index is compiled from the paragraph store if it is not on this host yet.
+    Returns:
+        list[dict]: matches in the shape of query_embeddings', scored by BM25
+    """
+    index = ensure_lexical_index(md5_hash)
+    store = ensure_paragraph_store(md5_hash)
+    matches = []
+    for n, score in index.search(query, top_k):
+        metadata = {
+            "md5_hash": md5_hash,
+            "meta": store.paragraph(n).model_dump_json(),
+            "model": "bm25",
+        }
+        matches.append(
+            {
+                "id": f"{md5_hash}:{n}",
+                "score": score,
+                "values": [],
+                "metadata": metadata,
+            }
+        )
+
+    return matches
+
+
+def fuse_matches(rankings: list[list[dict]], top_k: int = TOP_K) -> list[dict]:
+    """
+    Fuses rankings of matches by reciprocal rank, sum(1 / (RRF_K + rank)).
+    Ranks are used instead of scores, as cosine similarity, and BM25 are not
+    on the same scale. The first ranking's metadata is kept for shared ids.
+    Args:
+        rankings (list[list[dict]]): matches, best first, of each search
+        top_k (int): number of matches to return
+    Returns:
+        list[dict]: matches scored by their fused score, best first
+    """
+    fused: dict[str, dict] = {}
+    for ranking in rankings:
+        for rank, match in enumerate(ranking):
+            entry = fused.setdefault(match["id"], {**match, "score": 0.0})
+            entry["score"] += 1 / (RRF_K + rank + 1)
+
+    return sorted(fused.values(), key=lambda m: m["score"], reverse=True)[:top_k]
+
+
+PROMPT = """You're a text search engine assistant.
         The system will make embeddings query, and return the result to you.
         Your job is to parse the metadata, and return the result to the user.
         You will tell the user the spans, pageNumber, and content of the metadata for each result in natural language.
@@ -153,38 +382,302 @@ def get_ai_response(
         The metadata is a JSON string.
         This is an example of the metadata: [{'spans': [{'offset': 125, 'length': 17}], 'pageNumber': 1, 'content': '第一節の二 適用区域(第一条の二)'}]
         """
-    vector = get_embeddings([query])[0].embedding
-    query_resp = query_embeddings(
-        index="default",
-        vector=vector,
-        top_k=3,
-        include_values=False,
-        include_metadata=True,
-        d_filter={"md5_hash": {"$eq": md5_hash}, "user_id": {"$eq": user_id}},
-    )
 
-    reduced_metas = []
-    for match in query_resp["matches"]:
-        meta = json.loads(match["metadata"]["meta"])
-        reduced_meta = {
-            "spans": meta["spans"],
-            "pageNumber": (
-                meta["boundingRegions"][0]["pageNumber"]
-                if len(meta["boundingRegions"]) > 0
-                else "None"
-            ),
-            "content": meta["content"],
+
+async def _check_owner(md5_hash: str, user_id: str) -> int:
+    """
+    Returns:
+        int: the document's rev, see db.documents.IDocuments
+    Raises:
+        HTTPException: 404 if the user is not an owner of the document
+    """
+    rev = await asyncio.to_thread(get_document_rev, md5_hash, user_id)
+    if rev is None:
+        raise HTTPException(
+            status_code=404,
+            detail="File not found or OCR not done",
+        )
+
+    return rev
+
+
+async def _search(
+    query: str,
+    md5_hash: str,
+    mode: SearchMode,
+    vector: list[float] | None = None,
+) -> list[dict]:
+    """
+    Matches of a query in a document, see retrieve_paragraphs
+    Args:
+        vector (list[float] | None): query vector, embedded here if None
+    """
+
+    async def _vector_matches() -> list[dict]:
+        query_resp = await query_embeddings(
+            index="default",
+            vector=vector if vector is not None else await get_query_embedding(query),
+            top_k=TOP_K,
+            include_values=False,
+            include_metadata=True,
+            d_filter={"md5_hash": {"$eq": md5_hash}},
+        )
+        return query_resp["matches"]
+
+    match mode:
+        case "lexical":
+            return await asyncio.to_thread(query_lexical, md5_hash, query, TOP_K)
+        case "hybrid":
+            vector_matches, lexical_matches = await asyncio.gather(
+                _vector_matches(),
+                asyncio.to_thread(query_lexical, md5_hash, query, TOP_K * 2),
+            )
+            return fuse_matches([vector_matches, lexical_matches], TOP_K)
+        case _:
+            return await _vector_matches()
+
+
+def _reduce(meta: dict) -> dict:
+    return {
+        "spans": meta["spans"],
+        "pageNumber": (
+            meta["boundingRegions"][0]["pageNumber"]
+            if len(meta["boundingRegions"]) > 0
+            else "None"
+        ),
+        "content": meta["content"],
+    }
+
+
+async def _resolve_paragraphs(
+    md5_hash: str,
+    rankings: list[list[dict]],
+) -> list[tuple[list[dict], list[dict]]]:
+    """
+    Paragraphs of the matches of one, or more queries
+    - paragraphs are read from the compiled paragraph store if it is on this host,
+    the others are fetched from Mongo in one query, see db.paragraphs
+    - vectors upserted before paragraphs moved to Mongo still carry their paragraph
+    Matches without metadata are given the paragraph's, as returned by POST /extract,
+    matches whose paragraph is not found are dropped.
+    Returns:
+        list[tuple[list[dict], list[dict]]]: reduced metadata, and matches, per ranking
+    """
+    store = open_paragraph_store(md5_hash)
+    paragraphs: dict[str, Paragraph] = {}
+    for match in (m for matches in rankings for m in matches):
+        position = match["id"].rpartition(":")[2]
+        if store is not None and position.isdigit() and int(position) < len(store):
+            paragraphs[match["id"]] = store.paragraph(int(position))
+    missing = list(
+        {
+            m["id"]
+            for matches in rankings
+            for m in matches
+            if m["id"] not in paragraphs and "meta" not in m.get("metadata", {})
         }
-        reduced_metas.append(reduced_meta)
+    )
+    if missing:
+        paragraphs.update(await asyncio.to_thread(get_paragraphs, missing))
+
+    results = []
+    for matches in rankings:
+        reduced_metas = []
+        for match in matches:
+            metadata = match.setdefault("metadata", {})
+            if match["id"] in paragraphs:
+                meta = paragraphs[match["id"]].model_dump()
+                if "meta" not in metadata:
+                    metadata["meta"] = paragraphs[match["id"]].model_dump_json()
+                    metadata.setdefault("model", "text-embedding-3-small")
+            elif "meta" in metadata:
+                meta = json.loads(metadata["meta"])
+            else:
+                logger.warning(f"{md5_hash=} paragraph of {match['id']} not found")
+                continue
+            reduced_metas.append(_reduce(meta))
+        results.append(
+            (reduced_metas, [m for m in matches if "meta" in m["metadata"]])
+        )
+
+    return results
 
+
+async def retrieve_paragraphs(
+    query: str,
+    user_id: str,
+    md5_hash: str,
+    mode: SearchMode = "vector",
+) -> tuple[list[dict], list[dict]]:
+    """
+    Retrieval half of get_ai_response
+    - user must be an owner of the document, see db.documents
+    - vector: query is embeded using OpenAI's text-embedding-3-small model, and cached
+    then, the embeddings are queried in Pinecone
+    - lexical: paragraphs are scored by BM25, without embedding the query,
+    see query_lexical
+    - hybrid: both rankings are fused, see fuse_matches
+    Vectors are shared by the document's owners, so they are filtered by md5_hash only
+    Returns:
+        tuple[list[dict], list[dict]]: reduced metadata for the chatbot,
+        and the raw matches from Pinecone, or the lexical index
+    Raises:
+        HTTPException: 404 if the user is not an owner of the document
+    """
+    await _check_owner(md5_hash, user_id)
+    matches = await _search(query, md5_hash, mode)
+
+    return (await _resolve_paragraphs(md5_hash, [matches]))[0]
+
+
+async def retrieve_many(
+    queries: list[str],
+    user_id: str,
+    md5_hash: str,
+    mode: SearchMode = "vector",
+) -> list[tuple[list[dict], list[dict]]]:
+    """
+    Batch variant of retrieve_paragraphs, for many queries over one document
+    - ownership is checked once
+    - queries are embedded in one OpenAI request, see get_query_embeddings
+    - searches run concurrently
+    - paragraphs of every query are resolved at once, see _resolve_paragraphs
+    Returns:
+        list[tuple[list[dict], list[dict]]]: reduced metadata, and matches, per query
+    Raises:
+        HTTPException: 404 if the user is not an owner of the document
+    """
+    await _check_owner(md5_hash, user_id)
+    vectors: list[list[float] | None] = [None] * len(queries)
+    if mode != "lexical":
+        vectors = await get_query_embeddings(queries)
+    rankings = await asyncio.gather(
+        *(_search(q, md5_hash, mode, v) for q, v in zip(queries, vectors))
+    )
+
+    return await _resolve_paragraphs(md5_hash, list(rankings))
+
+
+def _new_chatbot(reduced_metas: list[dict]) -> ChatBot:
     chatbot = ChatBot()
     chatbot.set_system_message(PROMPT)
     if len(reduced_metas) == 0:
         chatbot.set_system_message("Tell the user results not found.")
 
-    chatbot_resp = chatbot.chat(json.dumps(reduced_metas, ensure_ascii=False))
+    return chatbot
+
+
+async def get_ai_response(
+    query: str,
+    user_id: str,
+    md5_hash: str,
+    mode: SearchMode = "vector",
+    answer: AnswerMode = "chatbot",
+):
+    """
+    Get natural language response from AI.
+    If query is not found, AI will respond accordingly.
+    Note:
+        the PROMPT should be further refined, and optimized for reduced token count, and guardrails.
+    - paragraphs are retrieved, see retrieve_paragraphs
+    - then, the chatbot describes them
+    - once the query is embedded, the answer to a paraphrase of it is returned
+    if one is cached for the document's rev, see caches.SemanticCache,
+    lexical queries are not embedded, and not cached
+    - template: the chatbot is skipped, results are rendered on the server,
+    see renders.render_results, latency is bounded by retrieval
+    OpenAI, and Pinecone are called with async clients shared per process,
+    the short mongo, and redis lookups run in a thread
+    Raises:
+        HTTPException: 404 if the user is not an owner of the document
+    """
+    rev = await _check_owner(md5_hash, user_id)
+    vector = None
+    if mode != "lexical":
+        vector = await get_query_embedding(query)
+    if vector is not None and answer == "chatbot":
+        cached = await asyncio.to_thread(
+            semantic_cache.get, md5_hash, rev, mode, vector
+        )
+        if cached is not None:
+            return json.loads(cached)
+    matches = await _search(query, md5_hash, mode, vector)
+    reduced_metas, matches = (await _resolve_paragraphs(md5_hash, [matches]))[0]
+    if answer == "template":
+        return {
+            "chatbot_response": render_results(query, reduced_metas),
+            "query_responses": matches,
+        }
+    chatbot = _new_chatbot(reduced_metas)
+    chatbot_resp = await chatbot.chat(json.dumps(reduced_metas, ensure_ascii=False))
+    resp = {
+        "chatbot_response": chatbot_resp,
+        "query_responses": matches,
+    }
+    if vector is not None and matches:
+        semantic_cache.set(
+            md5_hash, rev, mode, query, vector, json.dumps(resp, ensure_ascii=False)
+        )
+
+    return resp
+
+
+async def stream_ai_response(
+    query: str,
+    user_id: str,
+    md5_hash: str,
+    mode: SearchMode = "vector",
+) -> tuple[list[dict], AsyncIterator[str]]:
+    """
+    Streaming variant of get_ai_response.
+    Paragraphs are retrieved before returning, so errors are raised before
+    anything is streamed, the chatbot's response is streamed as it is generated.
+    Returns:
+        tuple[list[dict], AsyncIterator[str]]: raw matches from Pinecone,
+        and the chatbot's response tokens
+    Raises:
+        HTTPException: 404 if the user is not an owner of the document
+    """
+    reduced_metas, matches = await retrieve_paragraphs(
+        query, user_id, md5_hash, mode
+    )
+    chatbot = _new_chatbot(reduced_metas)
+    tokens = chatbot.chat_stream(json.dumps(reduced_metas, ensure_ascii=False))
+
+    return matches, tokens
+
+
+async def get_batch_ai_response(
+    queries: list[str],
+    user_id: str,
+    md5_hash: str,
+    mode: SearchMode = "vector",
+    summarize: bool = False,
+) -> dict:
+    """
+    Batch variant of get_ai_response, paragraphs are retrieved for every query,
+    see retrieve_many, and described in a single chatbot response if summarize
+    Returns:
+        dict: ex. {"results": [{"query": str, "query_responses": list}],
+        "chatbot_response": str | None}
+    Raises:
+        HTTPException: 404 if the user is not an owner of the document
+    """
+    retrieved = await retrieve_many(queries, user_id, md5_hash, mode)
+    chatbot_resp = None
+    if summarize:
+        grouped = [
+            {"query": q, "results": reduced_metas}
+            for q, (reduced_metas, _) in zip(queries, retrieved)
+        ]
+        found = [m for reduced_metas, _ in retrieved for m in reduced_metas]
+        chatbot = _new_chatbot(found)
+        chatbot_resp = await chatbot.chat(json.dumps(grouped, ensure_ascii=False))
 
     return {
+        "results": [
+            {"query": q, "query_responses": matches}
+            for q, (_, matches) in zip(queries, retrieved)
+        ],
         "chatbot_response": chatbot_resp,
-        "query_responses": [r.to_dict() for r in query_resp["matches"]],
     }
@@ -0,0 +1,120 @@
+"""
+Deterministic rendering of /extract results, without the chatbot
+Each paragraph is rendered as its rank, page, offset, and a snippet of its content
+around the query, with the query highlighted in **bold**.
+- the query is matched after NFKC normalization, lower casing, and whitespace removal
+- if the query does not occur as is, the query's character bigrams are highlighted,
+as scored by the lexical index, see services.ocrs.lexicons
+"""
+
+import unicodedata
+
+from services.ocrs.lexicons import ngrams
+
+# characters of content shown per paragraph
+SNIPPET_CHARS = 120
+NOT_FOUND = "No results found."
+
+
+def _normalized(text: str) -> tuple[str, list[int]]:
+    """
+    Normalizes text as lexicons.ngrams does, keeping the index in text of each
+    normalized character
+    """
+    chars = []
+    positions = []
+    for i, ch in enumerate(text):
+        for c in unicodedata.normalize("NFKC", ch).lower():
+            if not c.isspace():
+                chars.append(c)
+                positions.append(i)
+
+    return "".join(chars), positions
+
+
+def highlights(content: str, query: str) -> list[tuple[int, int]]:
+    """
+    Ranges of content matching the query
+    Returns:
+        list[tuple[int, int]]: sorted, non overlapping (start, end) in content
+    """
+    norm, positions = _normalized(content)
+    needle, _ = _normalized(query)
+    if not needle or not norm:
+        return []
+    covered = [False] * len(norm)
+    start = norm.find(needle)
+    if start != -1:
+        while start != -1:
+            covered[start : start + len(needle)] = [True] * len(needle)
+            start = norm.find(needle, start + 1)
+    else:
+        for gram in set(ngrams(query)):
+            start = norm.find(gram)
+            while start != -1:
+                covered[start : start + len(gram)] = [True] * len(gram)
+                start = norm.find(gram, start + 1)
+
+    ranges: list[tuple[int, int]] = []
+    for n, is_covered in enumerate(covered):
+        if not is_covered:
+            continue
+        lo, hi = positions[n], positions[n] + 1
+        # matches spanning whitespace are highlighted as one range
+        if ranges and (
+            ranges[-1][1] >= lo or content[ranges[-1][1] : lo].isspace()
+        ):
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], hi))
+        else:
+            ranges.append((lo, hi))
+
+    return ranges
+
+
+def snippet(content: str, query: str, width: int = SNIPPET_CHARS) -> str:
+    """
+    At most width characters of content, around the first match of the query,
+    with matches in **bold**, trimmed ends are marked with "…"
+    """
+    ranges = highlights(content, query)
+    start = 0
+    if len(content) > width and ranges:
+        start = max(0, min(ranges[0][0] - width // 4, len(content) - width))
+    end = min(len(content), start + width)
+
+    parts = ["…"] if start > 0 else []
+    pos = start
+    for lo, hi in ranges:
+        lo, hi = max(lo, start), min(hi, end)
+        if lo >= hi:
+            continue
+        parts += [content[pos:lo], "**", content[lo:hi], "**"]
+        pos = hi
+    parts.append(content[pos:end])
+    if end < len(content):
+        parts.append("…")
+
+    return "".join(parts)
+
+
+def render_results(query: str, reduced_metas: list[dict]) -> str:
+    """
+    Renders the paragraphs retrieved for a query, in rank order
+    Args:
+        query (str): query
+        reduced_metas (list[dict]): see services.oai.rags.retrieve_paragraphs
+    Returns:
+        str: one line per paragraph, ex.
+        '1. page 1, offset 125: 第一節の二 **適用区域**(第一条の二)'
+    """
+    if not reduced_metas:
+        return NOT_FOUND
+    lines = []
+    for rank, meta in enumerate(reduced_metas, 1):
+        offset = meta["spans"][0]["offset"] if meta["spans"] else "None"
+        lines.append(
+            f"{rank}. page {meta['pageNumber']}, offset {offset}: "
+            f"{snippet(meta['content'], query)}"
+        )
+
+    return "\n".join(lines)
@@ -0,0 +1,129 @@
+"""
+Size-aware, parallel upserts to Pinecone
+Vectors are split into batches under Pinecone's request limits, by payload bytes
+and by vector count, and the batches are sent concurrently with a small pool.
+Only the batches that failed are retried, a slow or failed batch does not hold
+back, or resend, the others.
+SEE: https://docs.pinecone.io/reference/quotas-and-limits
+"""
+
+import json
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any
+
+from services.ocrs.chunkers import pack
+
+logger = logging.getLogger(__name__)
+
+# Pinecone rejects upsert requests larger than 2MB, or with more than 1000 vectors
+MAX_BATCH_BYTES = 2 * 1024 * 1024 - 64 * 1024  # leaves room for the envelope
+MAX_BATCH_VECTORS = 1000
+# bytes of a float32 value in a JSON payload, at most
+VALUE_BYTES = 24
+
+
+@lru_cache(maxsize=1)
+def get_upsert_pool(max_workers: int = 4) -> ThreadPoolExecutor:
+    """
+    Get the process' upsert pool, created on first use, so it is not shared by forked workers
+    """
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upsert")
+
+
+def payload_size(vector: dict) -> int:
+    """
+    Estimates the bytes of a vector in an upsert request, errs on the large side
+    Args:
+        vector (dict): {"id": str, "values": list[float], "metadata": dict}
+    Returns:
+        int: bytes
+    """
+    metadata = json.dumps(vector.get("metadata", {}), ensure_ascii=False)
+    return (
+        len(vector["id"].encode())
+        + VALUE_BYTES * len(vector["values"])
+        + len(metadata.encode())
+        + 64
+    )
+
+
+class UpsertWriter:
+    """
+    Upserts vectors to a Pinecone index, in concurrent size-aware batches
+    Args:
+        index: Pinecone index handle, see services.oai.rags.get_index
+        namespace (str): namespace
+        max_batch_bytes (int): maximum estimated payload bytes of a batch
+        max_batch_vectors (int): maximum number of vectors of a batch
+        max_retries (int): retries of a failed batch
+        backoff (float): seconds before the first retry, doubled on each retry
+    """
+
+    def __init__(
+        self,
+        index: Any,
+        namespace: str = "default",
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+        max_batch_vectors: int = MAX_BATCH_VECTORS,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.index = index
+        self.namespace = namespace
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_vectors = max_batch_vectors
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def batches(self, vectors: list[dict]) -> list[list[dict]]:
+        """
+        Splits vectors into batches, see services.ocrs.chunkers.pack
+        A vector larger than max_batch_bytes is sent alone.
+        """
+        sized = ((v, payload_size(v)) for v in vectors)
+        return list(pack(sized, self.max_batch_bytes, self.max_batch_vectors))
+
+    def _upsert(self, batch: list[dict]) -> int:
+        return self.index.upsert(vectors=batch, namespace=self.namespace).to_dict()[
+            "upserted_count"
+        ]
+
+    def upsert(self, vectors: list[dict]) -> dict:
+        """
+        Upserts vectors, retrying failed batches only
+        Args:
+            vectors (list[dict]): {"id": str, "values": list[float], "metadata": dict}
+        Returns:
+            dict: ex. {"upserted_count": 2, "batch_count": 1}
+        Raises:
+            Exception: last error of a batch that failed after max_retries
+        """
+        batches = self.batches(vectors)
+        pending = list(range(len(batches)))
+        upserted_count = 0
+        pool = get_upsert_pool()
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            futures: dict[int, Future] = {
+                i: pool.submit(self._upsert, batches[i]) for i in pending
+            }
+            failed = []
+            error = None
+            for i, future in futures.items():
+                try:
+                    upserted_count += future.result()
+                except Exception as e:
+                    logger.warning(
+                        f"upsert batch {i} of {len(batches)} failed, {attempt=}: {e!r}"
+                    )
+                    failed.append(i)
+                    error = e
+            if not failed:
+                return {"upserted_count": upserted_count, "batch_count": len(batches)}
+            pending = failed
+
+        raise error
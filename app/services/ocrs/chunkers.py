@@ -0,0 +1,156 @@
+"""
+Token-aware chunking of OCR paragraphs into bundles to be embedded in one request.
+- The tiktoken encoder is loaded once per process, see services.ocrs.utils.get_encoding
+- Token counts are computed with one encode_batch pass per window of paragraphs
+- Paragraphs are packed into bundles in one linear sweep
+- Paragraphs larger than max_token are split at sentence boundaries
+Paragraphs are consumed lazily, so a streamed document, see services.ocrs.loaders,
+is bundled with memory bounded by the window and the bundle, not the document.
+"""
+
+from itertools import islice
+from typing import Iterable, Iterator, NamedTuple, TypeVar
+
+from services.ocrs.parsers import Paragraph
+from services.ocrs.utils import num_tokens_from_strings
+
+# OpenAI's embeddings endpoint accepts at most 2048 inputs per request
+MAX_INPUTS = 2048
+# paragraphs counted per encode_batch call
+WINDOW = 512
+
+T = TypeVar("T")
+
+
+class Chunk(NamedTuple):
+    """
+    A paragraph, or a part of a paragraph too large to be embedded whole
+    source: position of the paragraph in the input
+    part: position of the part in the paragraph, 0 if not split
+    paragraph: the paragraph, or its part
+    token_count: number of tokens of the paragraph's content
+    """
+
+    source: int
+    part: int
+    paragraph: Paragraph
+    token_count: int
+
+
+def iter_chunks(
+    paragraphs: Iterable[Paragraph],
+    max_token: int = 4000,
+    encoding_name: str = "cl100k_base",
+    window: int = WINDOW,
+) -> Iterator[Chunk]:
+    """
+    Counts the tokens of every paragraph, paragraphs larger than max_token are
+    replaced by their parts, see Paragraph.split
+    Args:
+        paragraphs (Iterable[Paragraph]): paragraphs in document order
+        max_token (int): maximum token length of a paragraph
+        encoding_name (str): encoding name
+        window (int): number of paragraphs counted in one encode_batch pass
+    Yields:
+        Chunk: paragraphs, or their parts, in document order
+    """
+    paragraphs = iter(paragraphs)
+    source = 0
+    while batch := list(islice(paragraphs, window)):
+        token_counts = num_tokens_from_strings(
+            [p.content for p in batch], encoding_name
+        )
+        for paragraph, token_count in zip(batch, token_counts):
+            if token_count <= max_token:
+                yield Chunk(source, 0, paragraph, token_count)
+            else:
+                parts = paragraph.split(max_token, encoding_name)
+                part_counts = num_tokens_from_strings(
+                    [p.content for p in parts], encoding_name
+                )
+                for part, (p, n) in enumerate(zip(parts, part_counts)):
+                    yield Chunk(source, part, p, n)
+            source += 1
+
+
+def pack(
+    items: Iterable[tuple[T, int]],
+    max_token: int = 4000,
+    max_inputs: int = MAX_INPUTS,
+) -> Iterator[list[T]]:
+    """
+    Packs items into bundles that are less than, or equal to max_token, in one sweep.
+    Bundles are never empty, and keep the order of items.
+    Args:
+        items (Iterable[tuple[T, int]]): items, and their token count
+        max_token (int): maximum token length of a bundle
+        max_inputs (int): maximum number of items in a bundle
+    Yields:
+        list[T]: bundle of items
+    """
+    bundle: list[T] = []
+    total_tokens = 0
+    for item, token_count in items:
+        if bundle and (
+            total_tokens + token_count > max_token or len(bundle) >= max_inputs
+        ):
+            yield bundle
+            bundle = []
+            total_tokens = 0
+        bundle.append(item)
+        total_tokens += token_count
+    if bundle:
+        yield bundle
+
+
+def iter_bundles(
+    paragraphs: Iterable[Paragraph],
+    max_token: int = 4000,
+    encoding_name: str = "cl100k_base",
+    max_inputs: int = MAX_INPUTS,
+) -> Iterator[list[Chunk]]:
+    """
+    Bundles paragraphs into lists of Chunk(s) that are less than, or equal to max_token.
+    Bundles are never empty, and keep the document order.
+    Args:
+        paragraphs (Iterable[Paragraph]): paragraphs in document order
+        max_token (int): maximum token length of a bundle
+        encoding_name (str): encoding name
+        max_inputs (int): maximum number of paragraphs in a bundle
+    Yields:
+        list[Chunk]: bundle of Chunk(s)
+    """
+    chunks = iter_chunks(paragraphs, max_token, encoding_name)
+    yield from pack(((c, c.token_count) for c in chunks), max_token, max_inputs)
+
+
+def iter_bundle_ranges(
+    token_counts: Iterable[int],
+    max_token: int = 4000,
+    max_inputs: int = MAX_INPUTS,
+) -> Iterator[tuple[int, int]]:
+    """
+    Bundles precomputed token counts, see services.ocrs.stores.ParagraphStore
+    Yields:
+        tuple[int, int]: position of the bundle's first paragraph, and its length
+    """
+    for bundle in pack(enumerate(token_counts), max_token, max_inputs):
+        yield bundle[0], len(bundle)
+
+
+def bundle_paragraphs(
+    paragraphs: Iterable[Paragraph],
+    max_token: int = 4000,
+    encoding_name: str = "cl100k_base",
+    max_inputs: int = MAX_INPUTS,
+) -> list[list[Paragraph]]:
+    """
+    Bundles paragraphs into lists of Paragraph(s) that are less than, or equal to max_token.
+    See iter_bundles
+    Returns:
+        list[list[Paragraph]]: bundles of Paragraph(s)
+    """
+    return [
+        [chunk.paragraph for chunk in bundle]
+        for bundle in iter_bundles(paragraphs, max_token, encoding_name, max_inputs)
+    ]
@@ -0,0 +1,172 @@
+"""
+Lexical index of a document's paragraphs, for exact references such as
+"第一節の二 適用区域(第一条の二)", which embeddings may rank below similar sections.
+- paragraphs are tokenized into character bigrams, Japanese has no word boundaries,
+after NFKC normalization, and whitespace removal
+- an inverted index, bigram -> (paragraph, term frequency), is compiled once
+per document from its paragraph store, next to it in ARTIFACT_DIR
+- queries are scored with BM25
+Entry n of the index is entry n of the paragraph store, ie. vector f"{md5}:{n}".
+"""
+
+import math
+import os
+import tempfile
+import unicodedata
+from collections import Counter
+
+import numpy as np
+from services.env_man import ENVS
+from services.ocrs.stores import ensure_paragraph_store
+
+NGRAM = 2
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+# indexes opened by open_lexical_index, by md5
+_open_indexes: dict[str, "LexicalIndex"] = {}
+
+
+def lexical_index_path(md5_hash: str) -> str:
+    return os.path.join(ENVS["ARTIFACT_DIR"], f"{md5_hash}.lex.npz")
+
+
+def ngrams(text: str, n: int = NGRAM) -> list[str]:
+    """
+    Character n-grams of a text, after NFKC normalization, lower casing,
+    and whitespace removal. Texts shorter than n are a single gram.
+    """
+    text = "".join(unicodedata.normalize("NFKC", text).lower().split())
+    if len(text) <= n:
+        return [text] if text else []
+
+    return [text[i : i + n] for i in range(len(text) - n + 1)]
+
+
+def compile_lexical_index(contents: list[str], path: str) -> int:
+    """
+    Compiles the inverted index of paragraphs, written atomically to path
+    Args:
+        contents (list[str]): paragraph contents, in store order
+        path (str): path of the index
+    Returns:
+        int: number of distinct grams
+    """
+    postings: dict[str, list[tuple[int, int]]] = {}
+    lengths = np.zeros(len(contents), dtype=np.int32)
+    for n, content in enumerate(contents):
+        grams = Counter(ngrams(content))
+        lengths[n] = sum(grams.values())
+        for gram, tf in grams.items():
+            postings.setdefault(gram, []).append((n, tf))
+
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    for i, term in enumerate(terms):
+        offsets[i + 1] = offsets[i] + len(postings[term])
+    entries = np.array(
+        [entry for term in terms for entry in postings[term]], dtype=np.int32
+    ).reshape(-1, 2)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(
+            f,
+            terms=np.array(terms, dtype=str),
+            offsets=offsets,
+            entries=entries,
+            lengths=lengths,
+        )
+    os.replace(tmp_path, path)
+
+    return len(terms)
+
+
+class LexicalIndex:
+    """
+    Read-only BM25 index of a document, see compile_lexical_index
+    Args:
+        path (str): path of the index
+    """
+
+    def __init__(self, path: str):
+        self.inode = os.stat(path).st_ino
+        with np.load(path) as data:
+            self.terms = data["terms"]
+            self.offsets = data["offsets"]
+            self.entries = data["entries"]
+            self.lengths = data["lengths"]
+        self.avg_length = max(float(self.lengths.mean()), 1.0) if len(self) else 1.0
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def _postings(self, gram: str) -> np.ndarray | None:
+        i = int(np.searchsorted(self.terms, gram))
+        if i == len(self.terms) or self.terms[i] != gram:
+            return None
+        return self.entries[self.offsets[i] : self.offsets[i + 1]]
+
+    def search(self, query: str, top_k: int) -> list[tuple[int, float]]:
+        """
+        Scores paragraphs with BM25 over the query's distinct grams
+        Args:
+            query (str): query
+            top_k (int): number of results to return
+        Returns:
+            list[tuple[int, float]]: entry, and BM25 score, best first,
+            paragraphs sharing no gram with the query are not returned
+        """
+        scores = np.zeros(len(self), dtype=np.float64)
+        for gram in set(ngrams(query)):
+            postings = self._postings(gram)
+            if postings is None:
+                continue
+            docs, tfs = postings[:, 0], postings[:, 1].astype(np.float64)
+            df = len(docs)
+            idf = math.log(1 + (len(self) - df + 0.5) / (df + 0.5))
+            norm = K1 * (1 - B + B * self.lengths[docs] / self.avg_length)
+            scores[docs] += idf * tfs * (K1 + 1) / (tfs + norm)
+        hits = np.flatnonzero(scores)
+        if len(hits) == 0:
+            return []
+        top = hits[np.argsort(-scores[hits], kind="stable")[:top_k]]
+
+        return [(int(n), float(scores[n])) for n in top]
+
+
+def open_lexical_index(md5_hash: str) -> LexicalIndex | None:
+    """
+    Opens a document's lexical index, kept open per process.
+    The index is reopened if it was recompiled since it was opened.
+    Returns:
+        LexicalIndex | None: index, None if the document is not compiled here
+    """
+    path = lexical_index_path(md5_hash)
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+    index = _open_indexes.get(md5_hash)
+    if index is None or index.inode != inode:
+        index = LexicalIndex(path)
+        _open_indexes[md5_hash] = index
+
+    return index
+
+
+def ensure_lexical_index(md5_hash: str) -> LexicalIndex:
+    """
+    Opens a document's lexical index, compiling it from the paragraph store
+    if it does not exist, see ensure_paragraph_store
+    """
+    index = open_lexical_index(md5_hash)
+    if index is not None:
+        return index
+    store = ensure_paragraph_store(md5_hash)
+    contents = [store.content(n) for n in range(len(store))]
+    compile_lexical_index(contents, lexical_index_path(md5_hash))
+
+    return open_lexical_index(md5_hash)
@@ -0,0 +1,160 @@
+"""
+Streaming loader of OCR results.
+Walks the OCR JSON incrementally, and yields validated Paragraph(s) of
+analyzeResult.paragraphs only. content, pages, styles and other fields are
+scanned past without being parsed, or kept in memory.
+Peak memory is bounded by CHUNK_SIZE, and the largest paragraph, not by the document.
+"""
+
+import json
+import re
+from typing import Iterator, TextIO
+
+from services.ocrs.parsers import Paragraph
+
+CHUNK_SIZE = 1 << 16
+# strings longer than this are skipped without being kept, keys are always shorter
+MAX_KEY_LEN = 256
+PARAGRAPHS_PATH = ("analyzeResult", "paragraphs")
+
+SKIP_RE = re.compile(r'[^"{}\[\],]*')
+QUOTE_OR_ESCAPE_RE = re.compile(r'["\\]')
+ELEMENT_SEP_RE = re.compile(r"[\s,]*")
+
+
+class _Reader:
+    """
+    Buffered reader over a text file, only keeps the unconsumed part of the buffer
+    """
+
+    def __init__(self, f: TextIO):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+
+    def fill(self, keep: int | None = None) -> bool:
+        """
+        Reads the next chunk, the buffer before keep, defaults to pos, is dropped.
+        Returns:
+            bool: False at the end of the file
+        """
+        keep = self.pos if keep is None else keep
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            return False
+        self.buf = self.buf[keep:] + chunk
+        self.pos -= keep
+
+        return True
+
+    def read_string(self) -> str | None:
+        """
+        Consumes the JSON string starting at pos.
+        Returns:
+            str | None: decoded string, None if longer than MAX_KEY_LEN
+        """
+        self.pos += 1
+        start = self.pos
+        is_long = False
+        while True:
+            m = QUOTE_OR_ESCAPE_RE.search(self.buf, self.pos)
+            if m is None or (m.group() == "\\" and m.end() == len(self.buf)):
+                # string continues in the next chunk, a trailing backslash is retried
+                self.pos = len(self.buf) if m is None else m.start()
+                is_long = is_long or self.pos - start > MAX_KEY_LEN
+                keep = self.pos if is_long else start - 1
+                if not self.fill(keep):
+                    raise ValueError("Unterminated string in OCR result")
+                start -= keep
+                continue
+            if m.group() == "\\":
+                self.pos = m.end() + 1
+                continue
+            self.pos = m.end()
+            if is_long or self.pos - start > MAX_KEY_LEN:
+                return None
+
+            return json.loads(self.buf[start - 1 : self.pos])
+
+    def iter_elements(self) -> Iterator[dict]:
+        """
+        Decodes the elements of the JSON array whose opening bracket was consumed
+        Yields:
+            dict: decoded element
+        """
+        decoder = json.JSONDecoder()
+        while True:
+            self.pos = ELEMENT_SEP_RE.match(self.buf, self.pos).end()
+            if self.pos == len(self.buf):
+                if not self.fill():
+                    raise ValueError("Unterminated array in OCR result")
+                continue
+            if self.buf[self.pos] == "]":
+                self.pos += 1
+                return
+            try:
+                element, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # element continues in the next chunk
+                if not self.fill():
+                    raise
+                continue
+            self.pos = end
+            yield element
+
+
+def iter_json_array(
+    f: TextIO,
+    path: tuple[str, ...] = PARAGRAPHS_PATH,
+) -> Iterator[dict]:
+    """
+    Yields the elements of the JSON array at path, ex. ("analyzeResult", "paragraphs")
+    Reading stops once the array is consumed.
+    Args:
+        f (TextIO): JSON file
+        path (tuple[str, ...]): keys from the root object to the array
+    Yields:
+        dict: decoded element
+    """
+    reader = _Reader(f)
+    # frames of open containers: [bracket, current key, expecting a key]
+    stack: list[list] = []
+    while True:
+        reader.pos = SKIP_RE.match(reader.buf, reader.pos).end()
+        if reader.pos == len(reader.buf):
+            if not reader.fill():
+                return
+            continue
+        c = reader.buf[reader.pos]
+        if c == '"':
+            s = reader.read_string()
+            if stack and stack[-1][0] == "{" and stack[-1][2]:
+                stack[-1][1] = s
+                stack[-1][2] = False
+            continue
+        reader.pos += 1
+        if c == "[" and tuple(frame[1] for frame in stack) == path:
+            yield from reader.iter_elements()
+            return
+        if c in "{[":
+            stack.append([c, None, c == "{"])
+        elif c in "}]":
+            stack.pop()
+        elif stack and stack[-1][0] == "{":
+            # comma, a key follows
+            stack[-1][2] = True
+
+
+def iter_paragraphs(fp: str, start: int = 0) -> Iterator[Paragraph]:
+    """
+    Yields validated Paragraph(s) of an OCR result file, see OcrResult
+    Args:
+        fp (str): path of the OCR result JSON
+        start (int): paragraphs before start are skipped without being validated
+    Yields:
+        Paragraph: paragraphs in document order
+    """
+    with open(fp, "r", encoding="utf-8") as f:
+        for i, element in enumerate(iter_json_array(f)):
+            if i >= start:
+                yield Paragraph.model_validate(element)
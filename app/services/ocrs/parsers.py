@@ -5,7 +5,11 @@ Handles parsers for ocrs endpoints. Ensures that the OCR results are validated a
 from collections import deque
 
 from pydantic import BaseModel
-from services.ocrs.utils import num_tokens_from_string
+from services.ocrs.utils import (
+    num_tokens_from_string,
+    num_tokens_from_strings,
+    split_sentences,
+)
 
 
 class Span(BaseModel):
@@ -27,6 +31,96 @@ class Paragraph(BaseModel):
     boundingRegions: list[BoundingRegion]
     content: str
 
+    def _slice_spans(self, start: int, end: int) -> list[Span]:
+        """
+        Narrows the spans to the content between start and end.
+        Content is assumed to be the concatenation of the spans.
+        Args:
+            start (int): start index of the content
+            end (int): end index of the content
+        Returns:
+            list[Span]: spans covering content[start:end]
+        """
+        spans = []
+        pos = 0
+        for span in self.spans:
+            lo = max(start, pos)
+            hi = min(end, pos + span.length)
+            if lo < hi:
+                spans.append(Span(offset=span.offset + lo - pos, length=hi - lo))
+            pos += span.length
+
+        return spans
+
+    def _halve(
+        self,
+        start: int,
+        end: int,
+        max_token: int,
+        encoding_name: str,
+    ) -> list[tuple[int, int, int]]:
+        """
+        Splits content[start:end] in halves until each half is less than,
+        or equal to max_token. Used for sentences larger than max_token.
+        Returns:
+            list[tuple[int, int, int]]: (start, end, token count) of each half
+        """
+        token_count = num_tokens_from_string(self.content[start:end], encoding_name)
+        if token_count <= max_token or end - start <= 1:
+            return [(start, end, token_count)]
+        mid = (start + end) // 2
+
+        return self._halve(start, mid, max_token, encoding_name) + self._halve(
+            mid, end, max_token, encoding_name
+        )
+
+    def split(
+        self,
+        max_token: int,
+        encoding_name: str = "cl100k_base",
+    ) -> list["Paragraph"]:
+        """
+        Splits the paragraph into Paragraph(s) that are less than, or equal to max_token.
+        Content is split at sentence boundaries, sentences are packed back together
+        as long as they fit. A sentence larger than max_token is split in halves.
+        Bounding regions are kept as is, spans are narrowed to each part.
+        Args:
+            max_token (int): maximum token length
+            encoding_name (str): encoding name
+        Returns:
+            list[Paragraph]: list of Paragraph(s) that are less than or equal to max_token
+        """
+        sentences = split_sentences(self.content)
+        token_counts = num_tokens_from_strings(sentences, encoding_name)
+        ranges: list[tuple[int, int, int]] = []
+        pos = 0
+        for sentence, token_count in zip(sentences, token_counts):
+            end = pos + len(sentence)
+            if token_count > max_token:
+                ranges.extend(self._halve(pos, end, max_token, encoding_name))
+            else:
+                ranges.append((pos, end, token_count))
+            pos = end
+
+        merged: list[tuple[int, int]] = []
+        total_tokens = 0
+        for start, end, token_count in ranges:
+            if merged and total_tokens + token_count <= max_token:
+                merged[-1] = (merged[-1][0], end)
+                total_tokens += token_count
+            else:
+                merged.append((start, end))
+                total_tokens = token_count
+
+        return [
+            Paragraph(
+                spans=self._slice_spans(start, end),
+                boundingRegions=self.boundingRegions,
+                content=self.content[start:end],
+            )
+            for start, end in merged
+        ]
+
 
 class AnalyzeResult(BaseModel):
     """
@@ -83,7 +177,10 @@ class OcrResult(BaseModel):
         Construct the queue with deque(OcrResult.AnalyzeResult.Paragraphs).
         Use this to construct a list of Paragraph(s) to be vectorized.
         The OpenAI's max token is 8191.
+        A paragraph larger than max_token is split, see Paragraph.split
         WARN: Mutates the queue
+        Note: services.ocrs.chunkers.bundle_paragraphs bundles a whole document
+        in a single pass, and is preferred over calling this in a loop.
         Args:
             queue (deque[Paragraph]): a queue of Paragraph(s)
             max_token (int): maximum token length
@@ -96,6 +193,9 @@ class OcrResult(BaseModel):
         while queue:
             paragraph = queue.popleft()
             token_count = num_tokens_from_string(paragraph.content, encoding_name)
+            if token_count > max_token:
+                queue.extendleft(reversed(paragraph.split(max_token, encoding_name)))
+                continue
             if total_tokens + token_count > max_token:
                 queue.appendleft(paragraph)
                 break
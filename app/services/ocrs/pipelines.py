@@ -0,0 +1,157 @@
+"""
+Pipelined embed-and-upsert of bundles within a worker.
+Embedding a bundle and upserting the previous one are network waits on different
+services, so they overlap instead of running strictly in sequence:
+- embed: at most embed_concurrency bundles are being embedded at once
+- queue: embedded bundles wait for an upsert slot, at most queue_size of them,
+so a slow upsert stage holds back embedding instead of buffering vectors
+- upsert: at most upsert_concurrency bundles are being upserted at once
+Stages run the sync clients in threads, see asyncio.to_thread.
+Time spent in each stage is recorded, see PipelineStats.
+"""
+
+import asyncio
+import time
+from typing import Callable, Iterable, TypeVar
+
+T = TypeVar("T")
+E = TypeVar("E")
+
+
+class PipelineStats:
+    """
+    Per-stage timings of a pipeline run
+    - seconds: time spent in the stage's calls, summed over bundles
+    - max_seconds: slowest call of the stage
+    - wait_seconds: time embedded bundles waited in the queue for an upsert slot,
+    high when upsert is the bottleneck, near 0 when embed is
+    - wall_seconds: duration of the run
+    """
+
+    def __init__(self):
+        self.stages = {
+            stage: {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+            for stage in ("embed", "upsert")
+        }
+        self.wait_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    def record(self, stage: str, seconds: float) -> None:
+        s = self.stages[stage]
+        s["count"] += 1
+        s["seconds"] += seconds
+        s["max_seconds"] = max(s["max_seconds"], seconds)
+
+    def to_dict(self) -> dict:
+        return {
+            **{stage: dict(s) for stage, s in self.stages.items()},
+            "wait_seconds": self.wait_seconds,
+            "wall_seconds": self.wall_seconds,
+        }
+
+
+async def _run_pipeline(
+    items: Iterable[T],
+    embed: Callable[[T], E],
+    upsert: Callable[[E], dict],
+    embed_concurrency: int,
+    upsert_concurrency: int,
+    queue_size: int,
+    stats: PipelineStats,
+) -> list[dict]:
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    embed_slots = asyncio.Semaphore(embed_concurrency)
+    results: list[dict] = []
+
+    async def _embed(item: T) -> None:
+        # the slot is held until the bundle is queued, bounding embedded bundles in memory
+        try:
+            start = time.perf_counter()
+            embedded = await asyncio.to_thread(embed, item)
+            stats.record("embed", time.perf_counter() - start)
+            await queue.put((embedded, time.perf_counter()))
+        finally:
+            embed_slots.release()
+
+    async def _upsert() -> None:
+        while (entry := await queue.get()) is not None:
+            embedded, queued_at = entry
+            start = time.perf_counter()
+            stats.wait_seconds += start - queued_at
+            results.append(await asyncio.to_thread(upsert, embedded))
+            stats.record("upsert", time.perf_counter() - start)
+
+    async with asyncio.TaskGroup() as tg:
+        upserters = [tg.create_task(_upsert()) for _ in range(upsert_concurrency)]
+        embedders = []
+        for item in items:
+            await embed_slots.acquire()
+            embedders.append(tg.create_task(_embed(item)))
+        await asyncio.gather(*embedders)
+        for _ in upserters:
+            await queue.put(None)
+
+    return results
+
+
+def run_pipeline(
+    items: Iterable[T],
+    embed: Callable[[T], E],
+    upsert: Callable[[E], dict],
+    embed_concurrency: int = 2,
+    upsert_concurrency: int = 2,
+    queue_size: int = 2,
+) -> tuple[list[dict], PipelineStats]:
+    """
+    Embeds and upserts items, ex. bundles, with both stages overlapping
+    Args:
+        items (Iterable[T]): items to embed
+        embed (Callable[[T], E]): embeds an item, ex. with get_embeddings
+        upsert (Callable[[E], dict]): upserts an embedded item, ex. with insert_embeddings
+        embed_concurrency (int): maximum number of items being embedded
+        upsert_concurrency (int): maximum number of items being upserted
+        queue_size (int): maximum number of embedded items waiting to be upserted
+    Returns:
+        tuple[list[dict], PipelineStats]: upsert responses, in completion order, and timings
+    Raises:
+        Exception: the first error of either stage, pending items are cancelled
+    """
+    stats = PipelineStats()
+    start = time.perf_counter()
+    try:
+        results = asyncio.run(
+            _run_pipeline(
+                items,
+                embed,
+                upsert,
+                embed_concurrency,
+                upsert_concurrency,
+                queue_size,
+                stats,
+            )
+        )
+    except ExceptionGroup as eg:
+        raise eg.exceptions[0]
+    finally:
+        stats.wall_seconds = time.perf_counter() - start
+
+    return results, stats
+
+
+def merge_timings(timings: Iterable[dict]) -> dict:
+    """
+    Sums the timings of pipeline runs, see PipelineStats.to_dict
+    max_seconds is the maximum of the runs, wall_seconds is summed over runs
+    """
+    merged = PipelineStats().to_dict()
+    for t in timings:
+        for stage in ("embed", "upsert"):
+            merged[stage]["count"] += t[stage]["count"]
+            merged[stage]["seconds"] += t[stage]["seconds"]
+            merged[stage]["max_seconds"] = max(
+                merged[stage]["max_seconds"], t[stage]["max_seconds"]
+            )
+        merged["wait_seconds"] += t["wait_seconds"]
+        merged["wall_seconds"] += t["wall_seconds"]
+
+    return merged
@@ -0,0 +1,302 @@
+"""
+Compiled paragraph store, one file per document (md5).
+The OCR result is streamed, chunked, see services.ocrs.chunkers, and tokenized once,
+then written to a compact binary file that is memory-mapped by readers.
+Entry n of the store is the paragraph, or part, embedded as vector f"{md5}:{n}".
+Layout, little-endian:
+- header: HEADER_FORMAT
+- entries: ENTRY_FORMAT per paragraph
+- spans: SPAN_FORMAT per span
+- regions: REGION_FORMAT per bounding region
+- polygons: float64 per coordinate
+- text: utf-8 paragraph contents, back to back
+Readers slice the memory map directly, only the requested content is decoded.
+"""
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from typing import Iterator
+
+from data.data_map import MOCK_DATA_MAP
+from services.env_man import ENVS
+from services.ocrs.chunkers import iter_chunks
+from services.ocrs.loaders import iter_paragraphs
+from services.ocrs.parsers import BoundingRegion, Paragraph, Span
+
+# stores opened by open_paragraph_store, by md5
+_open_stores: dict[str, "ParagraphStore"] = {}
+
+MAGIC = b"PGST"
+VERSION = 1
+# magic, version, count, max_token, encoding name, section offsets
+HEADER_FORMAT = struct.Struct("<4sHxxII16sQQQQQ")
+# text start, text length, span start, span count, region start, region count,
+# token count, source, part
+ENTRY_FORMAT = struct.Struct("<QIIIIIIII")
+SPAN_FORMAT = struct.Struct("<II")
+# page number, polygon start, polygon length
+REGION_FORMAT = struct.Struct("<III")
+POLYGON_FORMAT = struct.Struct("<d")
+
+
+def store_path(md5_hash: str) -> str:
+    """
+    Returns the path of a document's compiled paragraph store
+    """
+    return os.path.join(ENVS["ARTIFACT_DIR"], f"{md5_hash}.pgs")
+
+
+def compile_paragraph_store(
+    fp: str,
+    path: str,
+    max_token: int = 4000,
+    encoding_name: str = "cl100k_base",
+) -> int:
+    """
+    Compiles an OCR result into a paragraph store.
+    The file is written next to path, then renamed, so readers never see a partial store.
+    Args:
+        fp (str): path of the OCR result JSON
+        path (str): path of the store
+        max_token (int): paragraphs larger than max_token are split, see iter_chunks
+        encoding_name (str): encoding name
+    Returns:
+        int: number of entries
+    """
+    entries = bytearray()
+    spans = bytearray()
+    regions = bytearray()
+    polygons = bytearray()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    count = 0
+    with tempfile.TemporaryFile() as text:
+        text_len = 0
+        for chunk in iter_chunks(iter_paragraphs(fp), max_token, encoding_name):
+            p = chunk.paragraph
+            content = p.content.encode("utf-8")
+            entries += ENTRY_FORMAT.pack(
+                text_len,
+                len(content),
+                len(spans) // SPAN_FORMAT.size,
+                len(p.spans),
+                len(regions) // REGION_FORMAT.size,
+                len(p.boundingRegions),
+                chunk.token_count,
+                chunk.source,
+                chunk.part,
+            )
+            for span in p.spans:
+                spans += SPAN_FORMAT.pack(span.offset, span.length)
+            for region in p.boundingRegions:
+                regions += REGION_FORMAT.pack(
+                    region.pageNumber,
+                    len(polygons) // POLYGON_FORMAT.size,
+                    len(region.polygon),
+                )
+                polygons += struct.pack(f"<{len(region.polygon)}d", *region.polygon)
+            text.write(content)
+            text_len += len(content)
+            count += 1
+
+        offsets = []
+        pos = HEADER_FORMAT.size
+        for section in (entries, spans, regions, polygons):
+            offsets.append(pos)
+            pos += len(section)
+        offsets.append(pos)
+        header = HEADER_FORMAT.pack(
+            MAGIC,
+            VERSION,
+            count,
+            max_token,
+            encoding_name.encode(),
+            *offsets,
+        )
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+        with os.fdopen(fd, "wb") as out:
+            out.write(header)
+            for section in (entries, spans, regions, polygons):
+                out.write(section)
+            text.seek(0)
+            shutil.copyfileobj(text, out)
+    os.replace(tmp_path, path)
+
+    return count
+
+
+class ParagraphStore:
+    """
+    Read-only, memory-mapped paragraph store, see compile_paragraph_store
+    Args:
+        path (str): path of the store
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        (
+            magic,
+            version,
+            self.count,
+            self.max_token,
+            encoding_name,
+            self._entries_off,
+            self._spans_off,
+            self._regions_off,
+            self._polygons_off,
+            self._text_off,
+        ) = HEADER_FORMAT.unpack_from(self._view)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a paragraph store v{VERSION}")
+        self.encoding_name = encoding_name.rstrip(b"\0").decode()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __enter__(self) -> "ParagraphStore":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._view.release()
+        self._mmap.close()
+
+    def _entry(self, n: int) -> tuple[int, ...]:
+        if not 0 <= n < self.count:
+            raise IndexError(n)
+        return ENTRY_FORMAT.unpack_from(
+            self._view, self._entries_off + n * ENTRY_FORMAT.size
+        )
+
+    def token_counts(self) -> list[int]:
+        """
+        Returns the token count of every entry, in document order
+        """
+        table = self._view[self._entries_off : self._spans_off]
+        return [entry[6] for entry in ENTRY_FORMAT.iter_unpack(table)]
+
+    def content(self, n: int) -> str:
+        text_start, text_len, *_ = self._entry(n)
+        start = self._text_off + text_start
+        return str(self._view[start : start + text_len], "utf-8")
+
+    def page_number(self, n: int) -> int | None:
+        """
+        Returns the page number of the entry's first bounding region, None if it has none
+        """
+        _, _, _, _, region_start, region_count, *_ = self._entry(n)
+        if region_count == 0:
+            return None
+        offset = self._regions_off + region_start * REGION_FORMAT.size
+        return REGION_FORMAT.unpack_from(self._view, offset)[0]
+
+    def paragraph(self, n: int) -> Paragraph:
+        """
+        Returns the entry as a Paragraph
+        """
+        (
+            text_start,
+            text_len,
+            span_start,
+            span_count,
+            region_start,
+            region_count,
+            *_,
+        ) = self._entry(n)
+        spans = [
+            Span(offset=offset, length=length)
+            for offset, length in SPAN_FORMAT.iter_unpack(
+                self._view[
+                    self._spans_off
+                    + span_start * SPAN_FORMAT.size : self._spans_off
+                    + (span_start + span_count) * SPAN_FORMAT.size
+                ]
+            )
+        ]
+        regions = []
+        for page, poly_start, poly_len in REGION_FORMAT.iter_unpack(
+            self._view[
+                self._regions_off
+                + region_start * REGION_FORMAT.size : self._regions_off
+                + (region_start + region_count) * REGION_FORMAT.size
+            ]
+        ):
+            polygon = struct.unpack_from(
+                f"<{poly_len}d",
+                self._view,
+                self._polygons_off + poly_start * POLYGON_FORMAT.size,
+            )
+            regions.append(BoundingRegion(pageNumber=page, polygon=list(polygon)))
+        start = self._text_off + text_start
+
+        return Paragraph(
+            spans=spans,
+            boundingRegions=regions,
+            content=str(self._view[start : start + text_len], "utf-8"),
+        )
+
+    def iter_range(self, start: int, stop: int) -> Iterator[Paragraph]:
+        """
+        Yields the entries from start to stop, exclusive, as Paragraph(s)
+        """
+        for n in range(start, min(stop, self.count)):
+            yield self.paragraph(n)
+
+
+def ensure_paragraph_store(
+    md5_hash: str,
+    max_token: int = 4000,
+    encoding_name: str = "cl100k_base",
+) -> ParagraphStore:
+    """
+    Opens a document's paragraph store, compiling it first if it does not exist,
+    or was compiled with other chunking parameters.
+    Stores are local to the host, unless ARTIFACT_DIR is a shared volume,
+    each host compiles a document at most once.
+    Args:
+        md5_hash (str): md5 hash of the document, see MOCK_DATA_MAP
+        max_token (int): see compile_paragraph_store
+        encoding_name (str): see compile_paragraph_store
+    Returns:
+        ParagraphStore: store
+    """
+    store = open_paragraph_store(md5_hash)
+    if (
+        store is not None
+        and store.max_token == max_token
+        and store.encoding_name == encoding_name
+    ):
+        return store
+    compile_paragraph_store(
+        MOCK_DATA_MAP[md5_hash], store_path(md5_hash), max_token, encoding_name
+    )
+
+    return open_paragraph_store(md5_hash)
+
+
+def open_paragraph_store(md5_hash: str) -> ParagraphStore | None:
+    """
+    Opens a document's paragraph store, kept open per process.
+    The store is reopened if it was recompiled since it was opened.
+    Returns:
+        ParagraphStore | None: store, None if the document is not compiled on this host
+    """
+    path = store_path(md5_hash)
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+    store = _open_stores.get(md5_hash)
+    if store is None or store.inode != inode:
+        store = ParagraphStore(path)
+        _open_stores[md5_hash] = store
+
+    return store
@@ -2,8 +2,27 @@
 Contains utility functions for the OCRs module.
 """
 
+import re
+from functools import lru_cache
+
 import tiktoken
 
+# Sentence ends, delimiters are kept with the sentence they close.
+# Full-width punctuations end a sentence on their own, ASCII ones must be
+# followed by whitespace so decimals like 1.5 are not split.
+SENTENCE_END_RE = re.compile(r"[。！？．]\s*|[.!?]\s+|\n+")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding, loaded once per process.
+    Args:
+        encoding_name (str): encoding name
+    Returns:
+        tiktoken.Encoding: encoding
+    """
+    return tiktoken.get_encoding(encoding_name)
+
 
 def num_tokens_from_string(string: str, encoding_name: str) -> int:
     """Returns the number of tokens in a text string.
@@ -14,6 +33,40 @@ def num_tokens_from_string(string: str, encoding_name: str) -> int:
     Returns:
         int: number of tokens
     """
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(encoding_name)
     num_tokens = len(encoding.encode(string))
     return num_tokens
+
+
+def num_tokens_from_strings(strings: list[str], encoding_name: str) -> list[int]:
+    """Returns the number of tokens of each text string in one encode_batch pass.
+    Args:
+        strings (list[str]): text strings
+        encoding_name (str): encoding name
+    Returns:
+        list[int]: number of tokens of each text string
+    """
+    if not strings:
+        return []
+    encoding = get_encoding(encoding_name)
+    return [len(tokens) for tokens in encoding.encode_batch(strings)]
+
+
+def split_sentences(string: str) -> list[str]:
+    """Splits a text string into sentences.
+    Joining the sentences gives back the original string.
+    Args:
+        string (str): text string
+    Returns:
+        list[str]: sentences
+    """
+    sentences = []
+    start = 0
+    for m in SENTENCE_END_RE.finditer(string):
+        if m.end() > start:
+            sentences.append(string[start : m.end()])
+            start = m.end()
+    if start < len(string):
+        sentences.append(string[start:])
+
+    return sentences
@@ -3,40 +3,75 @@ Handles file uploads to S3
 """
 
 import logging
+import os
+import re
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import lru_cache
 from hashlib import md5
-from typing import BinaryIO, Union
+from typing import Union
+from urllib.parse import unquote, urlsplit
 
 import boto3
+import httpx
 import nanoid
 from botocore.client import Config
 from botocore.exceptions import ClientError
 from data.data_map import MOCK_DATA_MAP
-from db.uploads import IUploads, insert_upload
+from db.uploads import IUploads, insert_upload, query_upload_by
 from fastapi import HTTPException, UploadFile
 from pydantic import validate_call
 from serializers.ocrs import FileMeta
 from services.env_man import ENVS
+from validators.ocrs import MAX_SIZE, validate_file_type
 
+# bytes hashed per read when streaming an external file
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
-@validate_call
-def get_signed_url(bucket: str, key: str, expires_in: int = 3600) -> str:
+# extension of content-addressed keys, by sniffed content type, see content_key
+CONTENT_TYPE_EXTENSIONS = {
+    "application/pdf": "pdf",
+    "image/tiff": "tiff",
+    "image/jpeg": "jpg",
+    "image/png": "png",
+}
+MD5_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+def get_s3_client():
     """
-    Generate a signed url for a file
-    Args:
-        bucket: Bucket name
-        key: S3 object name
-        expires_in: Expiry time in seconds
+    Get the process' S3 client, connections are pooled across uploads,
+    and the client is shared by threads, up to S3_MAX_POOL_CONNECTIONS at once.
+    Created on first use in each process, a forked worker does not use its
+    parent's client, see _get_s3_client
     """
-    client = boto3.client(
+    return _get_s3_client(os.getpid())
+
+
+@lru_cache(maxsize=1)
+def _get_s3_client(pid: int):
+    session = boto3.session.Session()
+    return session.client(
         "s3",
         config=Config(
             signature_version="v4",
             s3={
                 "addressing_style": "path",
             },
+            max_pool_connections=ENVS["S3_MAX_POOL_CONNECTIONS"],
         ),
     )
-    url = client.generate_presigned_url(
+
+
+@validate_call
+def get_signed_url(bucket: str, key: str, expires_in: int = 3600) -> str:
+    """
+    Generate a signed url for a file
+    Args:
+        bucket: Bucket name
+        key: S3 object name
+        expires_in: Expiry time in seconds
+    """
+    url = get_s3_client().generate_presigned_url(
         "get_object",
         Params={"Bucket": bucket, "Key": key},
         ExpiresIn=expires_in,
@@ -45,22 +80,139 @@ def get_signed_url(bucket: str, key: str, expires_in: int = 3600) -> str:
     return url
 
 
-def upload_file(bucket: str, key: str, f: BinaryIO) -> bool:
+def get_part_pool() -> ThreadPoolExecutor:
+    """
+    Get the process' pool of multipart part uploads, shared by concurrent uploads
+    Threads do not survive a fork, a forked worker creates its own pool
+    """
+    return _get_part_pool(os.getpid())
+
+
+@lru_cache(maxsize=1)
+def _get_part_pool(pid: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=ENVS["S3_MAX_POOL_CONNECTIONS"], thread_name_prefix="s3part"
+    )
+
+
+class MultipartUpload:
     """
-    Upload a file to an S3 bucket
+    Streams a file to S3, part by part, as it is read
+    Parts are uploaded in the background, at most concurrency at once,
+    so memory is bounded by part_size * (concurrency + 2), whatever the file size.
+    The last part is held until complete, a file of a single part is sent with
+    one put_object, and nothing is sent if it is aborted.
     Args:
-        bucket: Bucket to upload to
-        key: S3 object name ex. "path/sample.pdf"
-        f: File to upload
+        bucket (str): bucket
+        key (str): S3 object name
+        content_type (str): content type of the object
+        part_size (int): bytes per part, at least 5MB, S3's minimum
+        concurrency (int): parts uploaded at once
+        client: S3 client, see get_s3_client
     """
-    client = boto3.client("s3")
-    try:
-        client.put_object(Bucket=bucket, Key=key, Body=f)
-    except ClientError as e:
-        logging.error(e)
-        return False
 
-    return True
+    def __init__(
+        self,
+        bucket: str,
+        key: str,
+        content_type: str,
+        part_size: int | None = None,
+        concurrency: int | None = None,
+        client=None,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size or ENVS["S3_PART_SIZE"]
+        self.concurrency = concurrency or ENVS["S3_UPLOAD_CONCURRENCY"]
+        self.client = client or get_s3_client()
+        self.upload_id: str | None = None
+        self.buffer = bytearray()
+        self.futures: list[Future] = []
+        self.parts: list[dict] = []
+
+    def _upload_part(self, number: int, body: bytes) -> dict:
+        resp = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=body,
+        )
+        return {"PartNumber": number, "ETag": resp["ETag"]}
+
+    def _send(self, body: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type
+            )["UploadId"]
+        while len(self.futures) >= self.concurrency:
+            self.parts.append(self.futures.pop(0).result())
+        number = len(self.parts) + len(self.futures) + 1
+        self.futures.append(get_part_pool().submit(self._upload_part, number, body))
+
+    def write(self, data: bytes) -> None:
+        """
+        Buffers data, full parts are sent, except the last one
+        """
+        self.buffer += data
+        while len(self.buffer) > self.part_size:
+            self._send(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+
+    def complete(self, key: str | None = None) -> None:
+        """
+        Sends the last part, and completes the upload
+        Args:
+            key (str | None): final S3 object name, if only known once the file
+            is read, ex. a content-addressed key. A file of a single part is sent
+            to it directly, a multipart upload is completed at self.key, then
+            copied by S3, without sending the file again
+        """
+        key = key or self.key
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=bytes(self.buffer),
+                ContentType=self.content_type,
+            )
+            return
+        self._send(bytes(self.buffer))
+        self.parts += [f.result() for f in self.futures]
+        self.futures = []
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+        if key != self.key:
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=key,
+                CopySource={"Bucket": self.bucket, "Key": self.key},
+            )
+            self.client.delete_object(Bucket=self.bucket, Key=self.key)
+
+    def abort(self) -> None:
+        """
+        Drops the upload, parts already sent are deleted by S3
+        Parts being sent are waited for, S3 may keep a part uploaded after the abort
+        """
+        for f in self.futures:
+            f.cancel()
+        # errors of the parts are ignored, the upload is dropped anyway
+        wait(self.futures)
+        self.futures = []
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+                )
+            except ClientError as e:
+                logging.error(e)
+        self.buffer = bytearray()
 
 
 @validate_call
@@ -76,6 +228,91 @@ def gen_file_url(bucket: str, key: str) -> str:
     return f"{bucket_url}/{bucket}/{key}"
 
 
+def content_key(namespace: str, md5_hash: str, content_type: str) -> str:
+    """
+    Content-addressed S3 object name, identical files share one object
+    ex. f"{namespace}/{md5}.pdf"
+    """
+    return f"{namespace}/{md5_hash}.{CONTENT_TYPE_EXTENSIONS[content_type]}"
+
+
+def to_file_meta(upload: IUploads) -> FileMeta:
+    """
+    File metadata of an upload record, with a signed url
+    """
+    file_meta = upload.model_dump()
+    key = parse_bucket_key(upload.url)
+    file_meta["url"] = get_signed_url(ENVS["AWS_BUCKET_NAME"], key)
+
+    return FileMeta(**file_meta)
+
+
+def reuse_upload(md5_hash: str, user_id: str, file_name: str) -> FileMeta | None:
+    """
+    Get the file metadata of an already stored file, without storing it again
+    - the user's own upload of the file, if any
+    - otherwise, a new upload record for the user, pointing to another user's object
+    Only call it with the md5 of bytes the server hashed, a client-claimed md5
+    would give access to another user's file, see preflight_upload
+    Args:
+        md5_hash: md5 hash of the file
+        user_id: owner's user id
+        file_name: original file name, of the new upload record
+    Returns:
+        FileMeta | None: File metadata, None if the file is not stored
+    """
+    upload = query_upload_by(md5=md5_hash, user_id=user_id)
+    if upload is not None:
+        return to_file_meta(upload)
+    stored = query_upload_by(md5=md5_hash)
+    if stored is None:
+        return None
+    upload = IUploads(
+        id=nanoid.generate(),
+        ext=file_name.split(".")[-1],
+        md5=md5_hash,
+        file_name=file_name,
+        url=stored.url,
+        user_id=user_id,
+        schema_version=1,
+    )
+    insert_upload(upload)
+
+    return to_file_meta(upload)
+
+
+def preflight_upload(
+    md5_hash: str,
+    size: int,
+    user_id: str,
+    file_name: str,
+) -> tuple[str, str | None, FileMeta | None]:
+    """
+    Checks an upload before the file is sent, from its md5, and size
+    computed by the client
+    Args:
+        md5_hash: md5 hash of the file
+        size: size of the file in bytes
+        user_id: owner's user id
+        file_name: original file name
+    Returns:
+        tuple[str, str | None, FileMeta | None]: status, detail, and file metadata
+        - "rejected", and why, the upload would be rejected
+        - "exists", and the file metadata, the user already uploaded the file
+        - "proceed", the file should be uploaded, even if another user stored it,
+        the md5 is not proof the user holds the file, see reuse_upload
+    """
+    if size > MAX_SIZE:
+        return "rejected", "File too large", None
+    if md5_hash not in MOCK_DATA_MAP.keys():
+        return "rejected", "Only sample files are allowed for upload", None
+    upload = query_upload_by(md5=md5_hash, user_id=user_id)
+    if upload is not None:
+        return "exists", None, to_file_meta(upload)
+
+    return "proceed", None, None
+
+
 @validate_call
 def handle_file_upload(
     f: UploadFile,
@@ -83,40 +320,86 @@ def handle_file_upload(
     namespace: str = "tektome/uploads",
 ) -> Union[FileMeta, False]:
     """
-    Handles file upload
-    - Calculate the md5 hash of the file
-    - Upload the file to S3
+    Handles file upload, in a single pass over the spooled file
+    - Sniff the content type from the file's magic bytes
+    - Read the file part by part, enforcing the size limit
+    - Calculate the md5 hash of the file, as parts are read
+    - Upload each part to S3 as it is read, see MultipartUpload
+    - Abort the upload if the file is not a sample file, or is already stored,
+    see reuse_upload, complete it at its content-addressed key otherwise
     - Store file's metadata in mongodb
     Args:
         f: File to upload
         user_id: Owner's user id
-        namespace: namespace ex sub.domain.tld/<namespace>/<file_id>.<ext>
+        namespace: namespace ex sub.domain.tld/<namespace>/<md5>.<ext>
     Returns:
         FileMeta | False: File metadata or False if failed
     """
     file_id = nanoid.generate()
-    f.file.seek(0)
-    md5_hash = md5(f.file.read()).hexdigest()
     file_name = f.filename
-    ext = file_name.split(".")[-1]
-    key = f"{namespace}/{file_id}.{ext}"
-
-    if md5_hash not in MOCK_DATA_MAP.keys():
-        raise HTTPException(
-            status_code=413,
-            detail="Only sample files are allowed for upload",
-        )
+    content_type = validate_file_type(f)
 
+    # parts of large files are staged until the md5, and so the key, is known
+    upload = MultipartUpload(
+        ENVS["AWS_BUCKET_NAME"], f"{namespace}/staging/{file_id}", content_type
+    )
+    h = md5()
+    size = 0
     try:
         f.file.seek(0)
-        upload_file(ENVS["AWS_BUCKET_NAME"], key, f.file)
+        while chunk := f.file.read(upload.part_size):
+            size += len(chunk)
+            if size > MAX_SIZE:
+                raise HTTPException(
+                    status_code=413,
+                    detail="File too large",
+                )
+            h.update(chunk)
+            upload.write(chunk)
+        md5_hash = h.hexdigest()
+        if md5_hash not in MOCK_DATA_MAP.keys():
+            raise HTTPException(
+                status_code=413,
+                detail="Only sample files are allowed for upload",
+            )
+        file_meta = reuse_upload(md5_hash, user_id, file_name)
+        if file_meta is not None:
+            upload.abort()
+            return file_meta
+        key = content_key(namespace, md5_hash, content_type)
+        upload.complete(key)
+    except HTTPException:
+        upload.abort()
+        raise
     except Exception as e:
         logging.error(e)
+        upload.abort()
         return False
 
+    return store_upload(file_id, md5_hash, user_id, file_name, key)
+
+
+def store_upload(
+    file_id: str,
+    md5_hash: str,
+    user_id: str,
+    file_name: str,
+    key: str,
+) -> FileMeta:
+    """
+    Store the metadata of a file uploaded to S3 in mongodb
+    Args:
+        file_id: file id
+        md5_hash: md5 hash of the file
+        user_id: owner's user id
+        file_name: original file name
+        key: S3 object name, see content_key
+    Returns:
+        FileMeta: File metadata
+    """
     db_payload = IUploads(
         id=file_id,
-        ext=ext,
+        ext=file_name.split(".")[-1],
         md5=md5_hash,
         file_name=file_name,
         url=gen_file_url(ENVS["AWS_BUCKET_NAME"], key),
@@ -124,8 +407,90 @@ def handle_file_upload(
         schema_version=1,
     )
     insert_upload(db_payload)
-    file_meta = db_payload.model_dump()
-    file_meta["url"] = get_signed_url(ENVS["AWS_BUCKET_NAME"], key)
-    ret = FileMeta(**file_meta)
 
-    return ret
+    return to_file_meta(db_payload)
+
+
+def parse_bucket_key(url: str) -> str | None:
+    """
+    Get the S3 object name of a url to the bucket, public or signed
+    ex. f"{AWS_BUCKET_URL}/{bucket}/{key}", f"{AWS_ENDPOINT_URL}/{bucket}/{key}?X-Amz-..."
+    Args:
+        url: file url
+    Returns:
+        str | None: S3 object name, None if the url is not to the bucket
+    """
+    parts = urlsplit(url)
+    path = f"{parts.scheme}://{parts.netloc}{unquote(parts.path)}"
+    bucket = ENVS["AWS_BUCKET_NAME"]
+    for base in (ENVS["AWS_BUCKET_URL"], ENVS["AWS_ENDPOINT_URL"]):
+        prefix = f"{base.rstrip('/')}/{bucket}/"
+        if path.startswith(prefix) and len(path) > len(prefix):
+            return path[len(prefix) :]
+
+    return None
+
+
+def resolve_upload(
+    user_id: str,
+    url: str | None = None,
+    file_id: str | None = None,
+) -> IUploads | None:
+    """
+    Get a user's upload record by file id, or by a url to the bucket,
+    so the file does not have to be downloaded to find its md5.
+    Keys are f"{namespace}/{md5}.{ext}", see content_key,
+    or f"{namespace}/{file_id}.{ext}" for files uploaded before
+    Args:
+        user_id: owner's user id
+        url: url to the file, public or signed
+        file_id: file id
+    Returns:
+        IUploads | None: upload record, None if not found, or the url is external
+    """
+    if file_id is None and url is not None:
+        key = parse_bucket_key(url)
+        if key is None:
+            return None
+        file_id = os.path.splitext(os.path.basename(key))[0]
+        if MD5_PATTERN.fullmatch(file_id):
+            return query_upload_by(md5=file_id, user_id=user_id)
+    if file_id is None:
+        return None
+
+    return query_upload_by(id=file_id, user_id=user_id)
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Get the process' http client, connections are pooled across downloads.
+    Created on first use in each process, so pools are not shared by forked workers.
+    Redirects are not followed, urls are given by users, a redirect could point
+    the worker to internal hosts.
+    """
+    return _get_http_client(os.getpid())
+
+
+@lru_cache(maxsize=1)
+def _get_http_client(pid: int) -> httpx.Client:
+    return httpx.Client(timeout=httpx.Timeout(10, read=60))
+
+
+def hash_url(url: str) -> str:
+    """
+    Calculate the md5 hash of a remote file.
+    The body is streamed through the hash, and never fully buffered.
+    Args:
+        url: file url
+    Returns:
+        str: md5 hash
+    Raises:
+        httpx.HTTPError: if the file could not be downloaded
+    """
+    h = md5()
+    with get_http_client().stream("GET", url) as r:
+        r.raise_for_status()
+        for chunk in r.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+            h.update(chunk)
+
+    return h.hexdigest()
@@ -0,0 +1,320 @@
+"""
+Resumable upload sessions, for large files over unreliable connections
+A session maps onto an S3 multipart upload:
+- create_upload_session: starts the multipart upload, at a staging key
+- put_upload_part: uploads one part, parts may be sent in any order, in parallel,
+and sent again if a connection dropped
+- get_upload_session: parts received so far, to resume an upload
+- complete_upload_session: completes the multipart upload, hashes the file,
+and stores it as POST /upload does, see services.storages.handle_file_upload
+Session state is kept in redis, shared by every gateway process:
+- f"uploadsession:{id}": user_id, file_name, size, part_size, namespace, key,
+upload_id, and completion flags
+- f"uploadsession:{id}:parts": part number -> ETag
+Sessions expire SESSION_TTL after their last part, the bucket should abort
+incomplete multipart uploads with a lifecycle rule.
+"""
+
+import math
+from hashlib import md5
+
+import nanoid
+from data.data_map import MOCK_DATA_MAP
+from db.clients import rdb
+from fastapi import HTTPException
+from serializers.ocrs import FileMeta
+from services.env_man import ENVS
+from services.storages import (
+    DOWNLOAD_CHUNK_SIZE,
+    content_key,
+    get_s3_client,
+    reuse_upload,
+    store_upload,
+)
+from validators.ocrs import ALLOW_TYPES, MAX_SIZE, SNIFF_BYTES, sniff_content_type
+
+# seconds a session is kept after its last part
+SESSION_TTL = 24 * 60 * 60
+# S3 rejects parts smaller than 5MB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def _session_key(session_id: str) -> str:
+    return f"uploadsession:{session_id}"
+
+
+def _parts_key(session_id: str) -> str:
+    return f"uploadsession:{session_id}:parts"
+
+
+def _session_out(session_id: str, session: dict, parts: list[int]) -> dict:
+    size, part_size = int(session["size"]), int(session["part_size"])
+    return {
+        "session_id": session_id,
+        "size": size,
+        "part_size": part_size,
+        "part_count": max(1, math.ceil(size / part_size)),
+        "received": sorted(parts),
+    }
+
+
+def _get_session(session_id: str, user_id: str) -> dict:
+    """
+    Raises:
+        HTTPException: 404 if the session does not exist, expired,
+        or is another user's
+    """
+    session = rdb.hgetall(_session_key(session_id))
+    if not session or session["user_id"] != user_id:
+        raise HTTPException(
+            status_code=404,
+            detail="Upload session not found",
+        )
+
+    return session
+
+
+def create_upload_session(
+    user_id: str,
+    file_name: str,
+    size: int,
+    namespace: str = "tektome/uploads",
+) -> dict:
+    """
+    Start a resumable upload
+    Args:
+        user_id: owner's user id
+        file_name: original file name
+        size: size of the file in bytes
+        namespace: namespace of the file's key, see services.storages.content_key
+    Returns:
+        dict: session, ex. {"session_id": str, "size": int, "part_size": int,
+        "part_count": int, "received": []}
+    Raises:
+        HTTPException: 413 if the file is too large
+    """
+    if size > MAX_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail="File too large",
+        )
+    session_id = nanoid.generate()
+    key = f"{namespace}/staging/{session_id}"
+    upload_id = get_s3_client().create_multipart_upload(
+        Bucket=ENVS["AWS_BUCKET_NAME"], Key=key
+    )["UploadId"]
+    session = {
+        "user_id": user_id,
+        "file_name": file_name,
+        "size": size,
+        "part_size": max(ENVS["S3_PART_SIZE"], MIN_PART_SIZE),
+        "namespace": namespace,
+        "key": key,
+        "upload_id": upload_id,
+    }
+    pipe = rdb.pipeline()
+    pipe.hset(_session_key(session_id), mapping=session)
+    pipe.expire(_session_key(session_id), SESSION_TTL)
+    pipe.execute()
+
+    return _session_out(session_id, session, [])
+
+
+def get_upload_session(session_id: str, user_id: str) -> dict:
+    """
+    Get a session, and the parts received so far
+    Raises:
+        HTTPException: 404 if the session does not exist
+    """
+    session = _get_session(session_id, user_id)
+    parts = rdb.hkeys(_parts_key(session_id))
+
+    return _session_out(session_id, session, [int(n) for n in parts])
+
+
+def _part_size(session_id: str, session: dict, number: int) -> int:
+    out = _session_out(session_id, session, [])
+    size, part_size, part_count = out["size"], out["part_size"], out["part_count"]
+    if not 1 <= number <= part_count:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Part number must be between 1 and {part_count}",
+        )
+
+    return part_size if number < part_count else size - part_size * (number - 1)
+
+
+def get_part_size(session_id: str, user_id: str, number: int) -> int:
+    """
+    Size a part of a session's file must have, checked before its body is read
+    Args:
+        session_id: session id
+        user_id: owner's user id
+        number: part number, from 1 to part_count
+    Returns:
+        int: part_size, the last part holds the rest of the file
+    Raises:
+        HTTPException: 404 if the session does not exist, 400 if the part number
+        is invalid
+    """
+    return _part_size(session_id, _get_session(session_id, user_id), number)
+
+
+def put_upload_part(session_id: str, user_id: str, number: int, body: bytes) -> dict:
+    """
+    Upload a part of a session's file, a part sent again replaces the previous one
+    Args:
+        session_id: session id
+        user_id: owner's user id
+        number: part number, from 1 to part_count
+        body: part_size bytes, the last part holds the rest of the file
+    Returns:
+        dict: session, see get_upload_session
+    Raises:
+        HTTPException: 404 if the session does not exist, 400 if the part number,
+        or size is invalid
+    """
+    session = _get_session(session_id, user_id)
+    expected = _part_size(session_id, session, number)
+    if len(body) != expected:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Part {number} must be {expected} bytes",
+        )
+    resp = get_s3_client().upload_part(
+        Bucket=ENVS["AWS_BUCKET_NAME"],
+        Key=session["key"],
+        UploadId=session["upload_id"],
+        PartNumber=number,
+        Body=body,
+    )
+    pipe = rdb.pipeline()
+    pipe.hset(_parts_key(session_id), str(number), resp["ETag"])
+    pipe.expire(_parts_key(session_id), SESSION_TTL)
+    pipe.expire(_session_key(session_id), SESSION_TTL)
+    pipe.hkeys(_parts_key(session_id))
+    parts = pipe.execute()[-1]
+
+    return _session_out(session_id, session, [int(n) for n in parts])
+
+
+def _hash_object(key: str) -> tuple[str, str | None]:
+    """
+    md5 hash, and sniffed content type of an object, streamed from S3
+    """
+    body = get_s3_client().get_object(Bucket=ENVS["AWS_BUCKET_NAME"], Key=key)["Body"]
+    h = md5()
+    head = b""
+    for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+        if len(head) < SNIFF_BYTES:
+            head += chunk[:SNIFF_BYTES]
+        h.update(chunk)
+
+    return h.hexdigest(), sniff_content_type(head)
+
+
+def _drop_session(session_id: str) -> None:
+    rdb.delete(_session_key(session_id), _parts_key(session_id))
+
+
+def complete_upload_session(session_id: str, user_id: str) -> FileMeta:
+    """
+    Complete a session's upload, once every part is received
+    The file is checked, and stored, as POST /upload does:
+    - only sample files, of allowed types, are accepted
+    - a file already stored is not stored again, see services.storages.reuse_upload
+    - the file is moved to its content-addressed key, and its upload record is created
+    Returns:
+        FileMeta: File metadata
+    Raises:
+        HTTPException: 404 if the session does not exist, 409 if parts are missing,
+        or the session is being completed, 413 if the file is not a sample file,
+        406 if its type is not allowed
+    """
+    session = _get_session(session_id, user_id)
+    etags = rdb.hgetall(_parts_key(session_id))
+    part_count = _session_out(session_id, session, [])["part_count"]
+    if len(etags) < part_count:
+        raise HTTPException(
+            status_code=409,
+            detail=f"{part_count - len(etags)} parts missing",
+        )
+    if not rdb.hsetnx(_session_key(session_id), "completing", 1):
+        raise HTTPException(
+            status_code=409,
+            detail="Upload session is being completed",
+        )
+
+    client = get_s3_client()
+    bucket, key = ENVS["AWS_BUCKET_NAME"], session["key"]
+    try:
+        # a retried completion, after a transient error, does not complete again
+        if "completed" not in session:
+            client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=session["upload_id"],
+                MultipartUpload={
+                    "Parts": [
+                        {"PartNumber": n, "ETag": etags[str(n)]}
+                        for n in range(1, part_count + 1)
+                    ]
+                },
+            )
+            rdb.hset(_session_key(session_id), "completed", 1)
+        md5_hash, content_type = _hash_object(key)
+        if md5_hash not in MOCK_DATA_MAP.keys():
+            _reject(session_id, key, 413, "Only sample files are allowed for upload")
+        if content_type not in ALLOW_TYPES:
+            _reject(session_id, key, 406, "Invalid file type")
+        file_meta = reuse_upload(md5_hash, user_id, session["file_name"])
+        if file_meta is None:
+            final_key = content_key(session["namespace"], md5_hash, content_type)
+            client.copy_object(
+                Bucket=bucket,
+                Key=final_key,
+                CopySource={"Bucket": bucket, "Key": key},
+                ContentType=content_type,
+                MetadataDirective="REPLACE",
+            )
+            file_meta = store_upload(
+                session_id, md5_hash, user_id, session["file_name"], final_key
+            )
+    except HTTPException:
+        raise
+    except Exception:
+        rdb.hdel(_session_key(session_id), "completing")
+        raise
+    client.delete_object(Bucket=bucket, Key=key)
+    _drop_session(session_id)
+
+    return file_meta
+
+
+def _reject(session_id: str, key: str, status_code: int, detail: str) -> None:
+    """
+    Deletes a rejected file, and its session
+    Raises:
+        HTTPException: always
+    """
+    get_s3_client().delete_object(Bucket=ENVS["AWS_BUCKET_NAME"], Key=key)
+    _drop_session(session_id)
+    raise HTTPException(
+        status_code=status_code,
+        detail=detail,
+    )
+
+
+def abort_upload_session(session_id: str, user_id: str) -> None:
+    """
+    Abort a session's upload, parts received are deleted by S3
+    Raises:
+        HTTPException: 404 if the session does not exist
+    """
+    session = _get_session(session_id, user_id)
+    get_s3_client().abort_multipart_upload(
+        Bucket=ENVS["AWS_BUCKET_NAME"],
+        Key=session["key"],
+        UploadId=session["upload_id"],
+    )
+    _drop_session(session_id)
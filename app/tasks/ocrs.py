@@ -1,63 +1,95 @@
 """
-Handles OCR 
+Handles OCR
 OCR and Embed could be separated into two tasks, but for simplicity, we combine them into one task.
+Embedding is fanned out across workers:
+- mock_ocr_and_embed_to_pc: coordinator, validates the request and bundles the paragraphs
+- embed_bundles: embeds, and upserts a shard of bundles to Pinecone, pipelined
+- finalize_ocr: chord callback, marks the document as SUCCESS once every bundle landed
+- on_ocr_error: chord errback, resets the document so OCR can be requested again
+Vectors are stored once per document (md5), and shared by every user who uploaded it.
+The first user's task ingests the document, later users are only added to its owners.
 """
 
-import json
 import logging
-from collections import deque
-from hashlib import md5
 
 import httpx
-from data.data_map import MOCK_DATA_MAP
+from celery import chord, group
+from db.documents import claim_document, renew_claim, set_document_status
+from db.paragraphs import insert_paragraphs
 from db.uploads import query_upload_by, set_ocr_status
 from pydantic_core import Url
 from scheduler import app
+from services.env_man import ENVS
+from services.oai.indexes import compile_vector_index
 from services.oai.rags import get_embeddings, insert_embeddings
-from services.ocrs.parsers import OcrResult, Paragraph
+from services.ocrs.chunkers import iter_bundle_ranges
+from services.ocrs.lexicons import ensure_lexical_index
+from services.ocrs.pipelines import merge_timings, run_pipeline
+from services.ocrs.stores import ensure_paragraph_store
+from services.storages import hash_url
 from tasks.interfaces import ITaskResponse
 
 logger = logging.getLogger(__name__)
 
+# seconds between checks of a document being ingested by another user's task
+WAIT_FOR_DOCUMENT_COUNTDOWN = 5
+# checks before giving up, a stale claim is taken over after DOCUMENT_CLAIM_LEASE
+MAX_DOCUMENT_WAITS = ENVS["DOCUMENT_CLAIM_LEASE"] * 2 // WAIT_FOR_DOCUMENT_COUNTDOWN
 
-@app.task
-def mock_ocr_and_embed_to_pc(url: Url, user_id: str) -> ITaskResponse.from_orm:
+
+@app.task(bind=True, max_retries=MAX_DOCUMENT_WAITS)
+def mock_ocr_and_embed_to_pc(
+    self,
+    url: Url,
+    user_id: str,
+    wait_for_document: bool = False,
+    md5_hash: str | None = None,
+) -> ITaskResponse.from_orm:
     """
     Mock OCR and Embed to Pinecone
     Celery task cannot return non-json serializable objects.
     We return dict here, but we still do type checks.
     - file must exist in the bucket before calling this function
     - Any arbitary url not from the bucket is denied
+    - md5_hash is given when POST /ocr resolved the url to an upload record,
+    the file is not downloaded, see services.storages.resolve_upload
+    - Otherwise the file is streamed through an md5 hash, and not kept
     - If the file is not uploaded yet, return 404
     - If the file is uploaded, mock the ocr result and embed to Pinecone
+    - If the document was already embedded for another user, the user is added
+    to the document's owners, and the task succeeds without calling OpenAI or Pinecone
+    - If the document is being embedded by another user's task, the task retries
+    until that ingestion is done, or its claim expires and is taken over,
+    see db.documents.claim_document. The upload is marked FAILED after
+    MAX_DOCUMENT_WAITS retries
     - When embedding, we chunk the paragraphs into chunks of less than 8000 tokens
-    then batch embed
-    - vector, and metadata are inserted into Pinecone
+    then fan out one embed_bundles task per BUNDLES_PER_TASK chunks
+    - The task is replaced by a chord, so its task_id reports on the whole document,
+    and resolves to finalize_ocr's result once every bundle is inserted
     - logging to track the procress where it is likely to fail
-    Note:
-    Storing a lot of metadata in Pinecone may be simple, but more costly.
-    Alternatively, metadata can be stored in local db.
-    More investigations must be done to determine the better approach.
+    - Paragraphs are stored in Mongo, see db.paragraphs, Pinecone only keeps
+    the metadata queries are filtered by
     Args:
         url (Url): url to the file
         user_id (str): user id
+        wait_for_document (bool): set on retries, while another task ingests the document
+        md5_hash (str | None): md5 hash of the file, if known
     Returns:
         dict: response dict in the shape of ITaskResponse
     """
-    r = httpx.get(url)
-    try:
-        r.raise_for_status()
-    except httpx.HTTPStatusError as _:
-        ret = {
-            "data": None,
-            "error": {
-                "status_code": 400,
-                "detail": "invalid url",
-            },
-        }
-        return ITaskResponse(**ret).model_dump()
+    if md5_hash is None:
+        try:
+            md5_hash = hash_url(url)
+        except httpx.HTTPError as _:
+            ret = {
+                "data": None,
+                "error": {
+                    "status_code": 400,
+                    "detail": "invalid url",
+                },
+            }
+            return ITaskResponse(**ret).model_dump()
 
-    md5_hash = md5(r.content).hexdigest()
     upload = query_upload_by(md5=md5_hash, user_id=user_id)
     if upload is None:
         ret = {
@@ -68,7 +100,7 @@ def mock_ocr_and_embed_to_pc(url: Url, user_id: str) -> ITaskResponse.from_orm:
             },
         }
         return ITaskResponse(**ret).model_dump()
-    if upload and upload.ocr_status != "NOT_STARTED":
+    if upload.ocr_status not in ("NOT_STARTED", "FAILED") and not wait_for_document:
         ret = {
             "data": None,
             "error": {
@@ -79,44 +111,184 @@ def mock_ocr_and_embed_to_pc(url: Url, user_id: str) -> ITaskResponse.from_orm:
         return ITaskResponse(**ret).model_dump()
     set_ocr_status(md5_hash, user_id, "IN_PROGRESS")
 
-    fp = MOCK_DATA_MAP.get(md5_hash)
-    with open(fp, "r") as f:
-        ocr_result = OcrResult(**json.load(f))
-
-    queue = deque(ocr_result.analyzeResult.paragraphs)
+    claimed, document = claim_document(
+        md5_hash, user_id, lease=ENVS["DOCUMENT_CLAIM_LEASE"]
+    )
+    if document.ocr_status == "SUCCESS":
+        logger.info(f"{user_id=} {md5_hash=} document already embedded, shared")
+        set_ocr_status(md5_hash, user_id, "SUCCESS")
+        data = {"upserted_count": 0, "bundle_count": 0, "shared": True}
+        return ITaskResponse(data=data, error=None).model_dump()
+    if not claimed and self.request.retries >= self.max_retries:
+        logger.error(f"{user_id=} {md5_hash=} document still in progress, gave up")
+        set_ocr_status(md5_hash, user_id, "FAILED")
+        ret = {
+            "data": None,
+            "error": {
+                "status_code": 504,
+                "detail": "Timed out waiting for the document's OCR",
+            },
+        }
+        return ITaskResponse(**ret).model_dump()
+    if not claimed:
+        logger.info(f"{user_id=} {md5_hash=} document in progress, waiting")
+        raise self.retry(
+            args=(url, user_id),
+            kwargs={"wait_for_document": True, "md5_hash": md5_hash},
+            countdown=WAIT_FOR_DOCUMENT_COUNTDOWN,
+        )
 
     # seperate paragraphs into chunks of less than 8000 tokens
-    # TODO: optimization, each bundle can be sent to a different worker to parallelize
-    # but it is out of scope right now
-    bundled_paragraphs: list[Paragraph] = []
-    while queue:
-        bundled_paragraphs.append(OcrResult.yield_paragraphs(queue))
-    logger.info(f"{user_id=} {md5_hash=} {len(bundled_paragraphs)=} task started")
-    for i, bundle in enumerate(bundled_paragraphs):
-        contents = [p.content for p in bundle]
-        metadata = []
-        for p in bundle:
-            p: Paragraph
-            meta = {
-                "user_id": user_id,
-                "md5_hash": md5_hash,
-                "meta": p.model_dump_json(),
-                "model": "text-embedding-3-small",
-            }
-            metadata.append(meta)
-        logger.info(f"{user_id=} {md5_hash=} {len(metadata)=} embedding {i} started")
-        vectors = get_embeddings(contents)
-        logger.info(f"{user_id=} {md5_hash=} {len(metadata)=} embedding {i} done")
-        vectors = [v.model_dump() for v in vectors]
-        logger.info(f"{user_id=} {md5_hash=} {len(metadata)=} inserting {i} started")
-        data = insert_embeddings(
-            vectors,
-            metadata,
-            index="default",
-            namespace="default",
-        )
-        logger.info(f"{user_id=} {md5_hash=} {len(metadata)=} inserting {i} done")
-    logger.info(f"{user_id=} {md5_hash=} {len(bundled_paragraphs)=} task done")
+    # the document is compiled once into a paragraph store, with token counts,
+    # only the position of each bundle is sent to embed_bundles
+    store = ensure_paragraph_store(md5_hash)
+    # the lexical index is compiled from the store, for lexical, and hybrid /extract
+    ensure_lexical_index(md5_hash)
+    bundle_ranges = list(iter_bundle_ranges(store.token_counts(), store.max_token))
+    logger.info(f"{user_id=} {md5_hash=} {len(bundle_ranges)=} task started")
+    if not bundle_ranges:
+        return finalize_ocr([], user_id, md5_hash)
+
+    # every BUNDLES_PER_TASK bundles are sent to a different worker, which pipelines them
+    # vector ids are the paragraph's position in the document, see _embed_range
+    n = ENVS["BUNDLES_PER_TASK"]
+    header = group(
+        embed_bundles.s(user_id, md5_hash, i, bundle_ranges[k : k + n])
+        for i, k in enumerate(range(0, len(bundle_ranges), n))
+    )
+    body = finalize_ocr.s(user_id, md5_hash).on_error(
+        on_ocr_error.s(user_id, md5_hash)
+    )
+
+    return self.replace(chord(header, body))
+
+
+def _embed_range(
+    md5_hash: str, start: int, count: int
+) -> tuple[int, list, list, list, list]:
+    """
+    Embed a bundle of paragraphs, read from the document's paragraph store
+    Vector ids are f"{md5_hash}:{n}", n being the paragraph's position in the document,
+    so retried bundles overwrite their own vectors instead of duplicating them.
+    Returns:
+        tuple: start, paragraphs, vectors, metadata, and ids
+    """
+    store = ensure_paragraph_store(md5_hash)
+    paragraphs = list(store.iter_range(start, start + count))
+    contents = [p.content for p in paragraphs]
+    ids = [f"{md5_hash}:{start + n}" for n in range(len(paragraphs))]
+    # only the fields queries are filtered by, paragraphs are fetched from Mongo
+    metadata = [{"md5_hash": md5_hash} for _ in paragraphs]
+    vectors = [v.model_dump() for v in get_embeddings(contents)]
+
+    return start, paragraphs, vectors, metadata, ids
+
+
+def _upsert_range(md5_hash: str, embedded: tuple[int, list, list, list, list]) -> dict:
+    start, paragraphs, vectors, metadata, ids = embedded
+    # paragraphs are written first, a matched vector always has its paragraph
+    insert_paragraphs(md5_hash, start, paragraphs)
+    return insert_embeddings(
+        vectors,
+        metadata,
+        index="default",
+        namespace="default",
+        ids=ids,
+    )
+
+
+@app.task
+def embed_bundles(
+    user_id: str,
+    md5_hash: str,
+    i: int,
+    bundle_ranges: list[list[int]],
+) -> dict:
+    """
+    Embed bundles of paragraphs, and insert the vectors into Pinecone
+    Bundles are pipelined, one bundle is embedded while the previous one is upserted,
+    see services.ocrs.pipelines. In-flight limits are set by EMBED_CONCURRENCY,
+    UPSERT_CONCURRENCY and PIPELINE_QUEUE_SIZE.
+    Args:
+        user_id (str): user id, for logging, vectors are shared by the document's owners
+        md5_hash (str): md5 hash of the document
+        i (int): task index, for logging
+        bundle_ranges (list[list[int]]): position of each bundle's first paragraph
+        in the document, and its length
+    Returns:
+        dict: ex. {"upserted_count": 2, "bundle_count": 1, "timings": {...}}
+    """
+    logger.info(f"{user_id=} {md5_hash=} {len(bundle_ranges)=} pipeline {i} started")
+    # a long ingestion keeps its claim, see db.documents.claim_document
+    renew_claim(md5_hash)
+    results, stats = run_pipeline(
+        bundle_ranges,
+        lambda r: _embed_range(md5_hash, *r),
+        lambda embedded: _upsert_range(md5_hash, embedded),
+        embed_concurrency=ENVS["EMBED_CONCURRENCY"],
+        upsert_concurrency=ENVS["UPSERT_CONCURRENCY"],
+        queue_size=ENVS["PIPELINE_QUEUE_SIZE"],
+    )
+    timings = stats.to_dict()
+    logger.info(f"{user_id=} {md5_hash=} pipeline {i} done {timings=}")
+
+    return {
+        "upserted_count": sum(r.get("upserted_count", 0) for r in results),
+        "bundle_count": len(results),
+        "timings": timings,
+    }
+
+
+@app.task
+def finalize_ocr(
+    results: list[dict],
+    user_id: str,
+    md5_hash: str,
+) -> ITaskResponse.from_orm:
+    """
+    Chord callback, called once every embed_bundles of a document succeeded
+    Stage timings of every embed_bundles task are summed, see PipelineStats
+    The document's local vector index is compiled, unless VECTOR_BACKEND is "pinecone"
+    Args:
+        results (list[dict]): responses of every embed_bundles task
+        user_id (str): user id
+        md5_hash (str): md5 hash of the document
+    Returns:
+        dict: response dict in the shape of ITaskResponse
+    """
+    upserted_count = sum(r.get("upserted_count", 0) for r in results)
+    bundle_count = sum(r.get("bundle_count", 0) for r in results)
+    timings = merge_timings(r["timings"] for r in results if "timings" in r)
+    if ENVS["VECTOR_BACKEND"] != "pinecone":
+        count = len(ensure_paragraph_store(md5_hash))
+        rows = compile_vector_index(md5_hash, count)
+        logger.info(f"{user_id=} {md5_hash=} {rows=} of {count=} local index compiled")
+    logger.info(f"{user_id=} {md5_hash=} {len(results)=} task done {timings=}")
+    set_document_status(md5_hash, "SUCCESS")
     set_ocr_status(md5_hash, user_id, "SUCCESS")
+    data = {
+        "upserted_count": upserted_count,
+        "bundle_count": bundle_count,
+        "timings": timings,
+    }
 
     return ITaskResponse(data=data, error=None).model_dump()
+
+
+@app.task
+def on_ocr_error(request, exc, traceback, user_id: str, md5_hash: str) -> None:
+    """
+    Chord errback, called when any embed_bundles of a document failed.
+    Resets the ocr status, so the user can request OCR again.
+    Tasks of other owners waiting for the document will claim it on their next retry.
+    Vectors of the bundles that succeeded are left in Pinecone.
+    Args:
+        request: failed task's request
+        exc: raised exception
+        traceback: traceback
+        user_id (str): user id
+        md5_hash (str): md5 hash of the document
+    """
+    logger.error(f"{user_id=} {md5_hash=} task {request.id} failed: {exc!r}")
+    set_document_status(md5_hash, "NOT_STARTED")
+    set_ocr_status(md5_hash, user_id, "NOT_STARTED")
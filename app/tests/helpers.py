@@ -0,0 +1,85 @@
+"""
+Factories, and fakes shared by tests
+"""
+
+from services.ocrs.parsers import Paragraph
+
+
+def make_ocr_result(n: int) -> dict:
+    paragraphs = [
+        {
+            "spans": [{"offset": i * 10, "length": 10}],
+            "boundingRegions": [{"pageNumber": i // 5 + 1, "polygon": [0.5] * 8}],
+            "content": f'第{i}条 "引用" \\ 適用区域',
+        }
+        for i in range(n)
+    ]
+    return {
+        "status": "succeeded",
+        "createdDateTime": "2024-06-03T15:05:25Z",
+        "lastUpdatedDateTime": "2024-06-03T15:05:27Z",
+        "analyzeResult": {
+            "apiVersion": "2024-02-29-preview",
+            "modelId": "prebuilt-layout",
+            "stringIndexType": "utf16CodeUnit",
+            "content": 'content with "paragraphs": [ ] { } \\ ' * 1000,
+            "pages": [{"paragraphs": [{"content": "not a paragraph"}]}],
+            "paragraphs": paragraphs,
+            "styles": [],
+            "contentFormat": "text",
+        },
+    }
+
+
+def make_paragraph(content: str, offset: int = 0) -> Paragraph:
+    return Paragraph(
+        spans=[{"offset": offset, "length": len(content)}],
+        boundingRegions=[{"pageNumber": 1, "polygon": [0, 0, 1, 0, 1, 1, 0, 1]}],
+        content=content,
+    )
+
+
+class FakeBody:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def iter_chunks(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i : i + chunk_size]
+
+
+class FakeS3:
+    """
+    Records the calls of MultipartUpload
+    """
+
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+        self.parts: dict[int, bytes] = {}
+        self.aborted = False
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None):
+        return {"UploadId": "upload"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts[PartNumber] = Body
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+        self.objects[Key] = b"".join(self.parts[n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.objects[Key] = self.objects[CopySource["Key"]]
+
+    def get_object(self, Bucket, Key):
+        return {"Body": FakeBody(self.objects[Key])}
+
+    def delete_object(self, Bucket, Key):
+        del self.objects[Key]
@@ -0,0 +1,151 @@
+"""
+Test caches
+"""
+
+import asyncio
+import time
+
+import nanoid
+from openai.types import CreateEmbeddingResponse, Embedding
+from services.caches import LRUCache
+from services.oai.caches import (
+    EmbeddingCache,
+    ExtractCache,
+    SemanticCache,
+    embedding_key,
+)
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(maxsize=2, ttl=1)
+    cache.set("a", 1)
+    time.sleep(1.1)
+    assert cache.get("a") is None
+
+
+def test_embedding_key_normalized():
+    assert embedding_key("第一条　適用", "m") == embedding_key(" 第一条 適用 ", "m")
+    assert embedding_key("第一条", "m") != embedding_key("第一条", "m", 256)
+    assert embedding_key("第一条", "m") != embedding_key("第一条", "n")
+
+
+def test_embedding_cache_partial_hit():
+    """
+    Only misses are embedded, in one call
+    """
+    cache = EmbeddingCache("test" + nanoid.generate(), 10, 10)
+    calls = []
+
+    def embed(texts):
+        calls.append(texts)
+        return [[float(len(t)), 0.5] for t in texts]
+
+    prefix = nanoid.generate()
+    assert cache.get_or_embed([prefix + "a"], "m", None, embed) == [[len(prefix) + 1, 0.5]]
+    cache.memory.clear()
+    vectors = cache.get_or_embed(
+        [prefix + "a", prefix + "bb", prefix + "bb"], "m", None, embed
+    )
+    assert calls == [[prefix + "a"], [prefix + "bb"]]
+    assert vectors[1] == vectors[2] == [len(prefix) + 2, 0.5]
+    stats = cache.stats()
+    assert stats["hits_redis"] == 1
+    assert stats["misses"] == 2
+    assert stats["hit_chars"] == len(prefix) + 1
+
+
+def test_embedding_cache_async_memory_hit(monkeypatch):
+    """
+    A memory hit does not read redis, stats are written after returning
+    """
+    cache = EmbeddingCache("test" + nanoid.generate(), 10, 10)
+
+    async def embed(texts):
+        return [[1.0] for _ in texts]
+
+    def get_many(keys):
+        raise AssertionError("redis read on a memory hit")
+
+    async def run():
+        await cache.aget_or_embed(["適用"], "m", None, embed)
+        monkeypatch.setattr(cache.redis, "get_many", get_many)
+        assert await cache.aget_or_embed(["適用"], "m", None, embed) == [[1.0]]
+        await asyncio.gather(*cache._pending)
+
+    asyncio.run(run())
+    stats = cache.stats()
+    assert stats["hits_memory"] == 1 and stats["hit_chars"] == 2
+
+
+def test_query_embedding_cache_hit(monkeypatch):
+    """
+    A repeated query, after normalization, is not sent to OpenAI
+    """
+    from services.oai import rags
+
+    calls = []
+
+    class Embeddings:
+        async def create(self, input, model, **kwargs):
+            calls.append(input)
+            data = [
+                Embedding(embedding=[0.25, 0.5], index=i, object="embedding")
+                for i in range(len(input))
+            ]
+            return CreateEmbeddingResponse(
+                data=data,
+                model=model,
+                object="list",
+                usage={"prompt_tokens": 1, "total_tokens": 1},
+            )
+
+    class Client:
+        embeddings = Embeddings()
+
+    monkeypatch.setattr(rags, "get_async_openai_client", Client)
+    query = "適用区域" + nanoid.generate()
+    assert asyncio.run(rags.get_query_embedding(query)) == [0.25, 0.5]
+    assert asyncio.run(rags.get_query_embedding(f" {query}　")) == [0.25, 0.5]
+    assert calls == [[query]]
+
+
+def test_extract_cache_ocr_rev():
+    """
+    A response cached before the ocr status changed is not served
+    """
+    cache = ExtractCache("test" + nanoid.generate(), 10)
+    md5 = nanoid.generate()
+    cache.set("user", md5, 1, "第一条 適用", '{"a": 1}')
+    assert cache.get("user", md5, 1, " 第一条　適用") == '{"a": 1}'
+    assert cache.get("user", md5, 2, "第一条 適用") is None
+    assert cache.get("other", md5, 1, "第一条 適用") is None
+
+
+def test_semantic_cache_similarity():
+    cache = SemanticCache(max_documents=2, max_entries=2, threshold=0.9)
+    md5_hash = nanoid.generate()
+    cache.set(md5_hash, 1, "vector", "適用区域", [1.0, 0.0, 0.0], "a")
+    cache.set(md5_hash, 1, "vector", "第二節", [0.0, 1.0, 0.0], "b")
+    # a paraphrase hits the most similar answered query
+    assert cache.get(md5_hash, 1, "vector", [0.95, 0.1, 0.0]) == "a"
+    assert cache.get(md5_hash, 1, "vector", [0.6, 0.6, 0.5]) is None
+    assert cache.get(md5_hash, 1, "hybrid", [1.0, 0.0, 0.0]) is None
+    assert cache.get(nanoid.generate(), 1, "vector", [1.0, 0.0, 0.0]) is None
+    # "第二節" is the least recently hit, and is evicted
+    cache.set(md5_hash, 1, "vector", "第三節", [0.0, 0.0, 1.0], "c")
+    assert cache.get(md5_hash, 1, "vector", [0.0, 1.0, 0.0]) is None
+    assert cache.get(md5_hash, 1, "vector", [1.0, 0.0, 0.0]) == "a"
+    assert 0 < cache.stats()["hit_rate"] < 1
+    # answers cached before the document was re-ingested are not read
+    assert cache.get(md5_hash, 2, "vector", [1.0, 0.0, 0.0]) is None
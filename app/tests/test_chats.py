@@ -2,6 +2,9 @@
 Test ChatBot Class
 """
 
+import asyncio
+from types import SimpleNamespace
+
 import pytest
 
 from services.oai.chats import ChatBot
@@ -14,4 +17,30 @@ def test_chat():
     """
     chatbot = ChatBot()
     chatbot.set_system_message("You are a bot")
-    chatbot.chat("Hello")
+    asyncio.run(chatbot.chat("Hello"))
+
+
+def test_chat_stream():
+    """
+    Tokens are yielded as they arrive, and the full response is kept in the history
+    """
+
+    def chunk(content):
+        delta = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    class Completions:
+        async def create(self, model, messages, stream):
+            async def _stream():
+                for content in ["第一条", None, " 適用"]:
+                    yield chunk(content)
+
+            return _stream()
+
+    async def collect(chatbot):
+        return [token async for token in chatbot.chat_stream("Hello")]
+
+    chatbot = ChatBot()
+    chatbot.client = SimpleNamespace(chat=SimpleNamespace(completions=Completions()))
+    assert asyncio.run(collect(chatbot)) == ["第一条", " 適用"]
+    assert chatbot.messages[-1] == {"role": "assistant", "content": "第一条 適用"}
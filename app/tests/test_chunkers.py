@@ -0,0 +1,69 @@
+"""
+Test paragraph chunking
+"""
+
+from collections import deque
+from itertools import islice
+
+from services.ocrs.chunkers import bundle_paragraphs, iter_bundles, iter_chunks
+from services.ocrs.parsers import OcrResult
+from services.ocrs.utils import num_tokens_from_string, split_sentences
+from tests.helpers import make_paragraph
+
+
+def test_split_sentences():
+    text = "第一条 この条例は適用する。第二条 削除。Section 1.5 applies. Done"
+    sentences = split_sentences(text)
+    assert "".join(sentences) == text
+    assert sentences[0] == "第一条 この条例は適用する。"
+    assert sentences[-1] == "Done"
+    assert "Section 1.5 applies. " in sentences
+
+
+def test_paragraph_split():
+    p = make_paragraph("建築物の敷地は道路に接しなければならない。" * 50, offset=100)
+    parts = p.split(max_token=40)
+    assert len(parts) > 1
+    assert "".join(part.content for part in parts) == p.content
+    for part in parts:
+        assert num_tokens_from_string(part.content, "cl100k_base") <= 40
+    assert parts[0].spans[0].offset == 100
+    assert parts[1].spans[0].offset == 100 + len(parts[0].content)
+
+
+def test_bundle_paragraphs():
+    paragraphs = [make_paragraph(f"第{i}条 適用区域") for i in range(100)]
+    paragraphs.append(make_paragraph("適用除外。" * 500))
+    bundles = bundle_paragraphs(paragraphs, max_token=100)
+    assert all(bundles)
+    flattened = [p.content for bundle in bundles for p in bundle]
+    assert flattened[:100] == [p.content for p in paragraphs[:100]]
+    for bundle in bundles:
+        total = sum(num_tokens_from_string(p.content, "cl100k_base") for p in bundle)
+        assert total <= 100
+
+
+def test_yield_paragraphs_oversized():
+    """
+    An oversized paragraph must not stop the queue from draining
+    """
+    queue = deque([make_paragraph("適用除外。" * 500), make_paragraph("附則")])
+    bundles = []
+    while queue:
+        bundles.append(OcrResult.yield_paragraphs(queue, max_token=100))
+    assert all(bundles)
+    assert bundles[-1][-1].content == "附則"
+
+
+def test_iter_bundles_ranges():
+    """
+    A bundle can be rebuilt from its first chunk's source, part, and its length
+    """
+    paragraphs = [make_paragraph(f"第{i}条 適用区域") for i in range(30)]
+    paragraphs.insert(10, make_paragraph("適用除外。" * 500))
+    bundles = list(iter_bundles(paragraphs, max_token=100))
+    for bundle in bundles:
+        source, part = bundle[0].source, bundle[0].part
+        chunks = iter_chunks(paragraphs[source:], max_token=100)
+        rebuilt = list(islice(chunks, part, part + len(bundle)))
+        assert [c.paragraph for c in rebuilt] == [c.paragraph for c in bundle]
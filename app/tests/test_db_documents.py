@@ -0,0 +1,70 @@
+"""
+Test documents collection
+"""
+
+import nanoid
+from db.clients import get_mongo_db
+from db.documents import (
+    claim_document,
+    create_indexes,
+    get_document_rev,
+    is_document_owner,
+    renew_claim,
+    set_document_status,
+)
+from scheduler import create_indexes as create_worker_indexes
+
+
+def test_claim_document():
+    create_indexes()
+    md5_hash = nanoid.generate()
+    claimed, document = claim_document(md5_hash, "user_a")
+    assert claimed is True
+    assert document.ocr_status == "IN_PROGRESS"
+
+    claimed, document = claim_document(md5_hash, "user_b")
+    assert claimed is False
+    assert document.owners == ["user_a", "user_b"]
+
+    set_document_status(md5_hash, "NOT_STARTED")
+    claimed, _ = claim_document(md5_hash, "user_b")
+    assert claimed is True
+
+
+def test_claim_document_lease():
+    md5_hash = nanoid.generate()
+    claim_document(md5_hash, "user_a")
+    assert renew_claim(md5_hash)
+    claimed, _ = claim_document(md5_hash, "user_b")
+    assert claimed is False
+
+    # the claim expired, its worker is assumed dead, the claim is taken over
+    claimed, document = claim_document(md5_hash, "user_b", lease=-1)
+    assert claimed is True and document.ocr_status == "IN_PROGRESS"
+    set_document_status(md5_hash, "SUCCESS")
+    assert not renew_claim(md5_hash)
+    assert claim_document(md5_hash, "user_c", lease=-1)[0] is False
+
+
+def test_is_document_owner():
+    md5_hash = nanoid.generate()
+    claim_document(md5_hash, "user_a")
+    assert is_document_owner(md5_hash, "user_a")
+    assert not is_document_owner(md5_hash, "user_b")
+
+
+def test_get_document_rev():
+    md5_hash = nanoid.generate()
+    claim_document(md5_hash, "user_a")
+    rev = get_document_rev(md5_hash, "user_a")
+    assert get_document_rev(md5_hash, "user_b") is None
+    # a re-ingestion changes the rev, cached answers are not read again
+    set_document_status(md5_hash, "NOT_STARTED")
+    assert get_document_rev(md5_hash, "user_a") == rev + 1
+
+
+def test_worker_creates_indexes():
+    # claim_document runs in workers, which may start before the gateway
+    create_worker_indexes()
+    indexes = get_mongo_db()["documents"].index_information()
+    assert indexes["md5_1"]["unique"]
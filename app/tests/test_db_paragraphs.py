@@ -0,0 +1,21 @@
+"""
+Test paragraphs collection
+"""
+
+import nanoid
+from db.paragraphs import create_indexes, get_paragraphs, insert_paragraphs
+from tests.helpers import make_paragraph
+
+
+def test_insert_and_get_paragraphs():
+    create_indexes()
+    md5_hash = nanoid.generate()
+    bundle = [make_paragraph("一"), make_paragraph("二")]
+    assert insert_paragraphs(md5_hash, 3, bundle) == 2
+    # retried bundles replace their paragraphs
+    assert insert_paragraphs(md5_hash, 3, bundle) == 2
+
+    paragraphs = get_paragraphs([f"{md5_hash}:4", f"{md5_hash}:3", f"{md5_hash}:9"])
+    assert sorted(paragraphs) == [f"{md5_hash}:3", f"{md5_hash}:4"]
+    assert paragraphs[f"{md5_hash}:4"] == make_paragraph("二")
+    assert get_paragraphs([]) == {}
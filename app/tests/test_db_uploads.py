@@ -4,7 +4,14 @@ Test DB Classes
 
 from hashlib import md5
 import nanoid
-from db.uploads import IUploads, insert_upload, query_upload_by, set_ocr_status
+from db.clients import get_mongo_client, get_mongo_db
+from db.uploads import (
+    IUploads,
+    create_indexes,
+    insert_upload,
+    query_upload_by,
+    set_ocr_status,
+)
 
 
 def test_insert_upload():
@@ -65,3 +72,17 @@ def test_set_ocr_status():
     assert resp is True
     resp = query_upload_by(md5=md5_hash)
     assert resp.ocr_status == "PENDING"
+    assert resp.ocr_rev == 1
+
+
+def test_mongo_client_shared():
+    assert get_mongo_client() is get_mongo_client()
+    assert get_mongo_db().client is get_mongo_client()
+
+
+def test_create_indexes():
+    create_indexes()
+    create_indexes()
+    indexes = get_mongo_db()["uploads"].index_information()
+    assert "user_id_1_id_1_ocr_status_1" in indexes
+    assert "md5_1_user_id_1" in indexes
@@ -0,0 +1,35 @@
+"""
+Test the local vector index
+"""
+
+import numpy as np
+from services.env_man import ENVS
+from services.oai.indexes import (
+    compile_vector_index,
+    open_vector_index,
+    write_fragment,
+)
+
+
+def test_local_vector_index(tmp_path, monkeypatch):
+    monkeypatch.setitem(ENVS, "ARTIFACT_DIR", str(tmp_path))
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(50, 16)).astype(np.float32)
+    assert open_vector_index("md5") is None
+
+    # bundles land in any order, a retried bundle overwrites its fragment
+    write_fragment("md5", list(range(20, 50)), vectors[20:].tolist())
+    write_fragment("md5", list(range(0, 20)), (vectors[:20] * 0).tolist())
+    write_fragment("md5", list(range(0, 20)), vectors[:20].tolist())
+    assert compile_vector_index("md5", 50) == 50
+
+    index = open_vector_index("md5")
+    assert len(index) == 50
+    query = vectors[7] + rng.normal(scale=0.01, size=16)
+    matches = index.query(query.tolist(), top_k=3)
+    assert matches[0][0] == 7
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = normalized @ (query / np.linalg.norm(query))
+    assert [n for n, _ in matches] == list(np.argsort(-scores)[:3])
+    assert abs(matches[0][1] - scores[7]) < 1e-5
+    assert open_vector_index("md5") is index
@@ -0,0 +1,40 @@
+"""
+Test the lexical index
+"""
+
+from services.ocrs.lexicons import LexicalIndex, compile_lexical_index, ngrams
+
+
+def test_ngrams_normalized():
+    assert ngrams("第一条　ＡＢ") == ngrams("第一条 ab") == ["第一", "一条", "条a", "ab"]
+    assert ngrams("条") == ["条"]
+    assert ngrams(" ") == []
+
+
+def test_lexical_index_exact_reference(tmp_path):
+    contents = [
+        "第一節 総則",
+        "第一節の二 適用区域(第一条の二)",
+        "第一節の三 適用除外(第一条の三)",
+        "この条例は、建築基準法の規定に基づき適用区域を定める。" * 3,
+        "附則",
+    ]
+    path = str(tmp_path / "md5.lex.npz")
+    assert compile_lexical_index(contents, path) > 0
+    index = LexicalIndex(path)
+    assert len(index) == len(contents)
+
+    matches = index.search("第一節の二 適用区域(第一条の二)", top_k=3)
+    assert matches[0][0] == 1
+    assert len(matches) == 3
+    assert matches[0][1] > matches[1][1]
+    assert index.search("存在しない語句", top_k=3) == []
+
+
+def test_fuse_matches():
+    from services.oai.rags import fuse_matches
+
+    vector = [{"id": "a", "score": 0.9}, {"id": "b", "score": 0.8}]
+    lexical = [{"id": "b", "score": 12.0}, {"id": "c", "score": 3.0}]
+    fused = fuse_matches([vector, lexical], top_k=2)
+    assert [m["id"] for m in fused] == ["b", "a"]
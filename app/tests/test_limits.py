@@ -2,8 +2,11 @@
 Test the limits service
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 import nanoid
-from services.limits import is_rate_limited
+import pytest
+from services.limits import LIMITERS, is_rate_limited
 
 
 def test_is_rate_limited():
@@ -13,3 +16,44 @@ def test_is_rate_limited():
     for _ in range(limit):
         assert not is_rate_limited(key, limit, window)
     assert is_rate_limited(key, limit, window)
+
+
+def test_is_rate_limited_cost():
+    key = "test" + nanoid.generate()
+    assert not is_rate_limited(key, 10, 3, cost=7)
+    # a batch larger than what is left is rejected, and consumes nothing
+    assert is_rate_limited(key, 10, 3, cost=4)
+    assert not is_rate_limited(key, 10, 3, cost=3)
+    assert is_rate_limited(key, 10, 3)
+    assert is_rate_limited("test" + nanoid.generate(), 10, 3, cost=11)
+
+
+@pytest.mark.parametrize("algorithm", ["sliding_window", "token_bucket"])
+def test_is_rate_limited_concurrent(algorithm):
+    key = "test" + nanoid.generate()
+    limit = 50
+
+    def hit(_):
+        return sum(
+            not is_rate_limited(key, limit, 3600, algorithm=algorithm)
+            for _ in range(10)
+        )
+
+    with ThreadPoolExecutor(16) as pool:
+        allowed = sum(pool.map(hit, range(16)))
+    assert allowed == limit
+
+
+def test_rate_limiter_local(monkeypatch):
+    limiter = LIMITERS["sliding_window"]
+    key = "test" + nanoid.generate()
+    assert not limiter.hit(key, 2, 3600, cost=2)
+    assert limiter.hit(key, 2, 3600)
+
+    # a rejected key is rejected again without redis, until its retry delay
+    def script(**kwargs):
+        raise AssertionError("redis called")
+
+    monkeypatch.setattr(limiter, "_script", script)
+    assert limiter.hit(key, 2, 3600)
+    assert limiter.hit(key, 2, 3600, cost=2)
@@ -0,0 +1,29 @@
+"""
+Test streaming OCR result loader
+"""
+
+import io
+import json
+
+import pytest
+from services.ocrs import loaders
+from services.ocrs.loaders import iter_json_array, iter_paragraphs
+from services.ocrs.parsers import OcrResult
+from tests.helpers import make_ocr_result
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 64, 1 << 16])
+def test_iter_json_array(monkeypatch, chunk_size):
+    monkeypatch.setattr(loaders, "CHUNK_SIZE", chunk_size)
+    ocr_result = make_ocr_result(20)
+    f = io.StringIO(json.dumps(ocr_result, ensure_ascii=False, indent=2))
+    assert list(iter_json_array(f)) == ocr_result["analyzeResult"]["paragraphs"]
+
+
+def test_iter_paragraphs(tmp_path):
+    ocr_result = make_ocr_result(20)
+    fp = tmp_path / "ocr.json"
+    fp.write_text(json.dumps(ocr_result, ensure_ascii=False), encoding="utf-8")
+    expected = OcrResult(**ocr_result).analyzeResult.paragraphs
+    assert list(iter_paragraphs(str(fp))) == expected
+    assert list(iter_paragraphs(str(fp), start=15)) == expected[15:]
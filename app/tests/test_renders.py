@@ -0,0 +1,39 @@
+"""
+Test rendering of /extract results without the chatbot
+"""
+
+from services.oai.renders import NOT_FOUND, highlights, render_results, snippet
+
+
+def test_highlights():
+    content = "第一節の二 適用区域(第一条の二)"
+    assert highlights(content, "適用区域") == [(6, 10)]
+    # full-width, and whitespace differences are ignored
+    assert highlights("ＡＢ Ｃ", "abc") == [(0, 4)]
+    # without an exact match, the query's bigrams are highlighted
+    assert highlights(content, "区域の適用") == [(6, 10)]
+    assert highlights(content, "無関係") == []
+
+
+def test_snippet_window():
+    content = "あ" * 200 + "適用区域" + "い" * 200
+    text = snippet(content, "適用区域", width=40)
+    assert text.startswith("…") and text.endswith("…")
+    assert "**適用区域**" in text
+    assert snippet("短い", "適用区域") == "短い"
+
+
+def test_render_results():
+    metas = [
+        {
+            "spans": [{"offset": 125, "length": 17}],
+            "pageNumber": 1,
+            "content": "第一節の二 適用区域(第一条の二)",
+        },
+        {"spans": [], "pageNumber": "None", "content": "適用区域"},
+    ]
+    assert render_results("適用区域", metas) == (
+        "1. page 1, offset 125: 第一節の二 **適用区域**(第一条の二)\n"
+        "2. page None, offset None: **適用区域**"
+    )
+    assert render_results("適用区域", []) == NOT_FOUND
@@ -0,0 +1,52 @@
+"""
+Test the gateway's routes in process
+"""
+
+from fastapi.testclient import TestClient
+from main import app
+from services import uploads
+from services.env_man import ENVS
+from tests.helpers import FakeS3
+
+client = TestClient(app)
+headers = {"Authorization": "Bearer johndoe"}
+
+
+def test_upload_session_routes(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(uploads, "get_s3_client", lambda: s3)
+    monkeypatch.setattr(uploads, "MIN_PART_SIZE", 4)
+    monkeypatch.setitem(ENVS, "S3_PART_SIZE", 4)
+    data = b"%PDF-" + bytes(range(5))
+
+    r = client.post(
+        "/upload/sessions", json={"file_name": "a.pdf", "size": 10}, headers=headers
+    )
+    assert r.status_code == 200
+    session_id = r.json()["session_id"]
+    assert r.json()["part_count"] == 3
+
+    # parts of the wrong size, or without Content-Length, are not read
+    r = client.put(
+        f"/upload/sessions/{session_id}/parts/2", content=data[3:8], headers=headers
+    )
+    assert r.status_code == 400
+    r = client.put(
+        f"/upload/sessions/{session_id}/parts/2",
+        content=iter([data[4:8]]),
+        headers=headers,
+    )
+    assert r.status_code == 411 and s3.parts == {}
+    r = client.put(
+        f"/upload/sessions/{session_id}/parts/2", content=data[4:8], headers=headers
+    )
+    assert r.status_code == 200 and r.json()["received"] == [2]
+    r = client.get(f"/upload/sessions/{session_id}", headers=headers)
+    assert r.json()["received"] == [2]
+    r = client.post(f"/upload/sessions/{session_id}/complete", headers=headers)
+    assert r.status_code == 409
+
+    r = client.delete(f"/upload/sessions/{session_id}", headers=headers)
+    assert r.status_code == 200 and s3.aborted
+    r = client.get(f"/upload/sessions/{session_id}", headers=headers)
+    assert r.status_code == 404
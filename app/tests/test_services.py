@@ -2,7 +2,30 @@
 Tests for services module.
 """
 
-from services.storages import get_signed_url
+import time
+from hashlib import md5
+
+import httpx
+import nanoid
+import pytest
+from db.uploads import IUploads, insert_upload
+from fastapi import HTTPException
+from services import storages, uploads
+from services.env_man import ENVS
+from services.storages import (
+    DOWNLOAD_CHUNK_SIZE,
+    MultipartUpload,
+    content_key,
+    gen_file_url,
+    get_signed_url,
+    hash_url,
+    parse_bucket_key,
+    preflight_upload,
+    resolve_upload,
+    reuse_upload,
+)
+from tests.helpers import FakeS3
+from validators.ocrs import sniff_content_type
 
 
 def test_get_signed_url():
@@ -13,3 +36,169 @@ def test_get_signed_url():
     result = get_signed_url(bucket, key, expires_in)
 
     assert isinstance(result, str)
+
+
+def test_s3_client_per_process(monkeypatch):
+    client = storages.get_s3_client()
+    assert storages.get_s3_client() is client
+    # a forked process does not use its parent's client
+    monkeypatch.setattr(storages.os, "getpid", lambda: -1)
+    assert storages.get_s3_client() is not client
+
+
+def test_parse_bucket_key():
+    bucket = ENVS["AWS_BUCKET_NAME"]
+    key = "tektome/uploads/9TMF2cDwGHg1yAz3aNtg_.pdf"
+    public_url = gen_file_url(bucket, key)
+    signed_url = f"{ENVS['AWS_ENDPOINT_URL']}/{bucket}/{key}?X-Amz-Signature=abc"
+
+    assert parse_bucket_key(public_url) == key
+    assert parse_bucket_key(signed_url) == key
+    assert parse_bucket_key(f"https://example.com/{bucket}/{key}") is None
+    assert parse_bucket_key(f"{ENVS['AWS_BUCKET_URL']}/other/{key}") is None
+
+
+def test_hash_url(monkeypatch):
+    content = b"%PDF-1.7" * (DOWNLOAD_CHUNK_SIZE // 4)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/missing.pdf":
+            return httpx.Response(404)
+        if request.url.path == "/redirect.pdf":
+            return httpx.Response(302, headers={"Location": "http://169.254.169.254/"})
+        return httpx.Response(200, content=content)
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(storages, "get_http_client", lambda: client)
+
+    assert hash_url("https://example.com/file.pdf") == md5(content).hexdigest()
+    with pytest.raises(httpx.HTTPStatusError):
+        hash_url("https://example.com/missing.pdf")
+    # redirects are not followed, they could point to internal hosts
+    assert not storages._get_http_client(-1).follow_redirects
+    with pytest.raises(httpx.HTTPStatusError):
+        hash_url("https://example.com/redirect.pdf")
+
+
+def test_multipart_upload():
+    client = FakeS3()
+    upload = MultipartUpload("b", "k", "application/pdf", 4, 2, client=client)
+    data = bytes(range(30))
+    for i in range(0, len(data), 3):
+        upload.write(data[i : i + 3])
+    upload.complete()
+    assert client.objects["k"] == data
+    assert all(len(client.parts[n]) == 4 for n in range(1, len(client.parts)))
+
+    # a file of a single part is sent once, and nothing is sent if aborted
+    client = FakeS3()
+    upload = MultipartUpload("b", "k", "application/pdf", 4, 2, client=client)
+    upload.write(b"%PDF")
+    upload.complete()
+    assert client.objects == {"k": b"%PDF"} and client.parts == {}
+    upload = MultipartUpload("b", "k2", "application/pdf", 4, 2, client=client)
+    upload.write(data)
+    upload.abort()
+    assert client.aborted and "k2" not in client.objects
+
+    # a multipart upload is completed at its staging key, then moved to key
+    client = FakeS3()
+    upload = MultipartUpload("b", "staging", "application/pdf", 4, 2, client=client)
+    upload.write(data)
+    upload.complete("content")
+    assert client.objects == {"content": data}
+
+
+def test_multipart_upload_abort():
+    # parts being sent when aborted are waited for, S3 may keep late parts
+    class SlowS3(FakeS3):
+        started = 0
+
+        def upload_part(self, **kwargs):
+            self.started += 1
+            time.sleep(0.05)
+            return super().upload_part(**kwargs)
+
+        def abort_multipart_upload(self, **kwargs):
+            self.aborted = len(self.parts)
+
+    client = SlowS3()
+    upload = MultipartUpload("b", "k", "application/pdf", 4, 2, client=client)
+    upload.write(bytes(range(13)))
+    while client.started < 3:
+        time.sleep(0.01)
+    upload.abort()
+    assert client.aborted == 3
+
+
+def test_sniff_content_type():
+    assert sniff_content_type(b"%PDF-1.7\n") == "application/pdf"
+    assert sniff_content_type(b"\x89PNG\r\n\x1a\n") == "image/png"
+    assert sniff_content_type(b"II*\x00") == "image/tiff"
+    assert sniff_content_type(b"<html>") is None
+
+
+def test_preflight_upload():
+    md5_hash = next(iter(storages.MOCK_DATA_MAP))
+    user_id = nanoid.generate()
+    assert preflight_upload(md5_hash, 200 << 20, user_id, "a.pdf")[0] == "rejected"
+    assert preflight_upload("0" * 32, 10, user_id, "a.pdf")[0] == "rejected"
+
+    key = content_key("tektome/uploads", md5_hash, "application/pdf")
+    insert_upload(
+        IUploads(
+            id=nanoid.generate(),
+            ext="pdf",
+            md5=md5_hash,
+            file_name="a.pdf",
+            url=gen_file_url(ENVS["AWS_BUCKET_NAME"], key),
+            user_id=nanoid.generate(),
+            schema_version=1,
+        )
+    )
+    # the file is stored for another user, it must still be sent by the user,
+    # its upload record is created once the bytes are hashed
+    assert preflight_upload(md5_hash, 10, user_id, "b.pdf")[0] == "proceed"
+    file = reuse_upload(md5_hash, user_id, "b.pdf")
+    assert file.user_id == user_id and file.md5 == md5_hash
+    assert preflight_upload(md5_hash, 10, user_id, "b.pdf")[0] == "exists"
+    assert resolve_upload(user_id, file_id=file.id).md5 == md5_hash
+    url = gen_file_url(ENVS["AWS_BUCKET_NAME"], key)
+    assert resolve_upload(user_id, url=url).id == file.id
+    assert preflight_upload(md5_hash, 10, user_id, "c.pdf")[2].id == file.id
+
+
+def test_upload_session(monkeypatch):
+    client = FakeS3()
+    monkeypatch.setattr(uploads, "get_s3_client", lambda: client)
+    monkeypatch.setattr(uploads, "MIN_PART_SIZE", 4)
+    monkeypatch.setitem(ENVS, "S3_PART_SIZE", 4)
+    user_id = nanoid.generate()
+    data = b"%PDF-" + bytes(range(5))
+    session = uploads.create_upload_session(user_id, "a.pdf", len(data))
+    session_id = session["session_id"]
+    assert session["part_count"] == 3 and session["received"] == []
+
+    # parts are sent in any order, the last part holds the rest of the file
+    with pytest.raises(HTTPException) as e:
+        uploads.put_upload_part(session_id, user_id, 3, data[8:9])
+    assert e.value.status_code == 400
+    uploads.put_upload_part(session_id, user_id, 3, data[8:])
+    session = uploads.put_upload_part(session_id, user_id, 1, data[:4])
+    assert session["received"] == [1, 3]
+    with pytest.raises(HTTPException) as e:
+        uploads.get_upload_session(session_id, nanoid.generate())
+    assert e.value.status_code == 404
+    with pytest.raises(HTTPException) as e:
+        uploads.complete_upload_session(session_id, user_id)
+    assert e.value.status_code == 409
+
+    # the file is not a sample file, it is deleted with its session
+    uploads.put_upload_part(session_id, user_id, 2, data[4:8])
+    with pytest.raises(HTTPException) as e:
+        uploads.complete_upload_session(session_id, user_id)
+    assert e.value.status_code == 413
+    assert client.objects == {}
+    with pytest.raises(HTTPException) as e:
+        uploads.get_upload_session(session_id, user_id)
+    assert e.value.status_code == 404
@@ -0,0 +1,34 @@
+"""
+Test compiled paragraph stores
+"""
+
+import json
+
+from services.ocrs.chunkers import iter_chunks
+from services.ocrs.loaders import iter_paragraphs
+from services.ocrs.stores import ParagraphStore, compile_paragraph_store
+from tests.helpers import make_ocr_result
+
+
+def test_compile_paragraph_store(tmp_path):
+    ocr_result = make_ocr_result(30)
+    ocr_result["analyzeResult"]["paragraphs"][3]["content"] = "適用除外。" * 500
+    ocr_result["analyzeResult"]["paragraphs"][4]["boundingRegions"] = []
+    fp = tmp_path / "ocr.json"
+    fp.write_text(json.dumps(ocr_result, ensure_ascii=False), encoding="utf-8")
+    path = str(tmp_path / "ocr.pgs")
+
+    count = compile_paragraph_store(str(fp), path, max_token=100)
+    chunks = list(iter_chunks(iter_paragraphs(str(fp)), max_token=100))
+    assert count == len(chunks) > 30
+
+    with ParagraphStore(path) as store:
+        assert len(store) == count
+        assert store.max_token == 100
+        assert store.encoding_name == "cl100k_base"
+        assert store.token_counts() == [c.token_count for c in chunks]
+        assert list(store.iter_range(0, count)) == [c.paragraph for c in chunks]
+        assert store.content(count - 1) == chunks[-1].paragraph.content
+        assert store.page_number(0) == 1
+        n = next(i for i, c in enumerate(chunks) if c.source == 4)
+        assert store.page_number(n) is None
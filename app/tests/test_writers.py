@@ -0,0 +1,65 @@
+"""
+Test size-aware Pinecone upserts
+"""
+
+import pytest
+from services.oai.writers import UpsertWriter, payload_size
+
+
+class UpsertResponse(dict):
+    def to_dict(self) -> dict:
+        return dict(self)
+
+
+class FlakyIndex:
+    """
+    Index whose first upsert of every batch containing fail_id fails
+    """
+
+    def __init__(self, fail_id: str | None = None, always: bool = False):
+        self.fail_id = fail_id
+        self.always = always
+        self.calls: list[list[str]] = []
+
+    def upsert(self, vectors: list[dict], namespace: str) -> UpsertResponse:
+        ids = [v["id"] for v in vectors]
+        self.calls.append(ids)
+        if self.fail_id in ids and (self.always or self.calls.count(ids) == 1):
+            raise ConnectionError(self.fail_id)
+        return UpsertResponse(upserted_count=len(vectors))
+
+
+def make_vectors(n: int) -> list[dict]:
+    return [
+        {"id": f"md5:{i}", "values": [0.1] * 8, "metadata": {"meta": "適用区域" * 10}}
+        for i in range(n)
+    ]
+
+
+def test_upsert_writer_batches():
+    vectors = make_vectors(25)
+    size = payload_size(vectors[0])
+    writer = UpsertWriter(FlakyIndex(), max_batch_bytes=size * 4, max_batch_vectors=3)
+    batches = writer.batches(vectors)
+    assert all(len(b) <= 3 for b in batches)
+    assert [v for b in batches for v in b] == vectors
+    writer = UpsertWriter(FlakyIndex(), max_batch_bytes=size * 2, max_batch_vectors=3)
+    assert all(len(b) <= 2 for b in writer.batches(vectors))
+
+
+def test_upsert_writer_retries_failed_batches_only():
+    index = FlakyIndex(fail_id="md5:7")
+    writer = UpsertWriter(index, max_batch_vectors=5, backoff=0)
+    resp = writer.upsert(make_vectors(25))
+    assert resp == {"upserted_count": 25, "batch_count": 5}
+    # 5 batches, and one retry of the batch that failed
+    assert len(index.calls) == 6
+    assert index.calls[-1] == [f"md5:{i}" for i in range(5, 10)]
+
+
+def test_upsert_writer_gives_up():
+    writer = UpsertWriter(
+        FlakyIndex(fail_id="md5:0", always=True), max_retries=2, backoff=0
+    )
+    with pytest.raises(ConnectionError):
+        writer.upsert(make_vectors(3))
@@ -2,61 +2,104 @@
 Extra validators for OCRs endpoints
 """
 
+import os
+
 from fastapi import HTTPException, UploadFile
 
+ALLOW_TYPES = [
+    "application/pdf",
+    "image/tiff",
+    "image/jpeg",
+    "image/png",
+]
+MAX_FILES = 5
+MAX_SIZE = 100 * 1024 * 1024  # 100MB
+
+# leading bytes of each allowed type, content_type sent by the client is not trusted
+MAGIC_BYTES = [
+    (b"%PDF-", "application/pdf"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+]
+SNIFF_BYTES = 8
+
+
+def sniff_content_type(head: bytes) -> str | None:
+    """
+    Content type of a file from its leading bytes
+    Args:
+        head (bytes): first SNIFF_BYTES bytes of the file, at least
+    Returns:
+        str | None: content type, None if not one of ALLOW_TYPES
+    """
+    for magic, content_type in MAGIC_BYTES:
+        if head.startswith(magic):
+            return content_type
+
+    return None
+
 
 def validate_file_size(file: UploadFile, max_size: int) -> bool:
     """
     File size validator for /upload endpoint
+    The size is read from the spooled file's end, the file is not read.
     Args:
         file (UploadFile): UploadFile
     Returns:
         bool: True if valid
     """
-    file_size = 0
-    for chunk in file.file:
-        file_size += len(chunk)
-        if file_size > max_size:
-            raise HTTPException(
-                status_code=413,
-                detail="File too large",
-            )
+    file_size = file.size
+    if file_size is None:
+        file_size = file.file.seek(0, os.SEEK_END)
+        file.file.seek(0)
+    if file_size > max_size:
+        raise HTTPException(
+            status_code=413,
+            detail="File too large",
+        )
 
     return True
 
 
+def validate_file_type(file: UploadFile) -> str:
+    """
+    File type validator for /upload endpoint, see sniff_content_type
+    Args:
+        file (UploadFile): UploadFile
+    Returns:
+        str: content type
+    """
+    file.file.seek(0)
+    content_type = sniff_content_type(file.file.read(SNIFF_BYTES))
+    file.file.seek(0)
+    if content_type not in ALLOW_TYPES:
+        raise HTTPException(
+            status_code=406,
+            detail="Invalid file type",
+        )
+
+    return content_type
+
+
 def validate_files(files: list[UploadFile] = []) -> bool:
     """
     File validator for /upload endpoint
+    Files are not read, the size limit is enforced again while uploading,
+    see services.storages.handle_file_upload
     Args:
         files (list[UploadFile]): list of UploadFile
     Returns:
         bool: True if valid
     """
-    ALLOW_TYPES = [
-        "application/pdf",
-        "image/tiff",
-        "image/jpeg",
-        "image/png",
-    ]
-    MAX_FILES = 5
-    MAX_SIZE = 100 * 1024 * 1024  # 10MB
-
     if len(files) > MAX_FILES:
         raise HTTPException(
             status_code=413,
             detail="Too many files. Max 5 files allowed.",
         )
     for file in files:
-        if not validate_file_size(file, MAX_SIZE):
-            raise HTTPException(
-                status_code=413,
-                detail="File too large",
-            )
-        if file.content_type not in ALLOW_TYPES:
-            raise HTTPException(
-                status_code=406,
-                detail="Invalid file type",
-            )
+        validate_file_size(file, MAX_SIZE)
+        validate_file_type(file)
 
     return True